@@ -0,0 +1,384 @@
+"""This script benchmarks the GOCDB and APEL parsing functions offline"""
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import xml.dom.minidom
+from datetime import datetime
+from optparse import OptionParser
+import metrics_apel
+import metrics_gocdb
+from functools import partial
+from common import PARALLEL_SETTINGS, configure_parallel, \
+    iter_chunked_elements, parse_sharded
+
+
+COUNTRIES = ['United Kingdom', 'France', 'Germany', 'Italy', 'Spain',
+             'Netherlands', 'Poland', 'Czech Republic', 'Greece', 'Portugal',
+             'Switzerland', 'Sweden', 'Turkey', 'Brazil', 'Taiwan']
+SERVICE_TYPES = ['APEL', 'gLite-APEL', 'eu.egi.cloud.accounting',
+                 'eu.egi.storage.accounting', 'CREAM-CE', 'SRM', 'Top-BDII',
+                 'site-BDII', 'ARC-CE', 'webdav']
+SCOPES = ['EGI', 'Local', 'wlcg', 'atlas', 'cms', 'lhcb', 'alice']
+ENTITY_TYPES = ['site', 'ngi', 'project', 'servicegroup']
+ROLES = ['Site Administrator', 'Site Operations Manager', 'NGI Operations '
+         'Manager', 'Security Officer', 'Service Group Administrator']
+
+
+def _site(number):
+    """Returns the name and country of the site with a given number"""
+    # A few thousand sites at most, so names repeat as they do in GOCDB
+    site = number % 5000
+    return ('SITE-%04d' % site, COUNTRIES[site % len(COUNTRIES)])
+
+
+def generate_service_endpoints(number):
+    """
+    This function generates a get_service_endpoint reply.
+
+    Params
+    ------
+    number: int
+            The number of SERVICE_ENDPOINT elements to generate
+    Returns
+    -------
+    xml: bytes
+         The reply, with every field GOCDBPI returns for an endpoint
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<results>\n']
+    for index in range(number):
+        sitename, country = _site(index // 3)
+        service_type = SERVICE_TYPES[index % len(SERVICE_TYPES)]
+        scopes = ''.join('<SCOPE>%s</SCOPE>' % scope for scope in
+                         SCOPES[index % 3:index % 3 + 1 + index % 2])
+        hostdn = '' if index % 50 == 49 else \
+            '<HOSTDN>/C=UK/O=eScience/CN=host%d.example.org</HOSTDN>' % index
+        parts.append(
+            '<SERVICE_ENDPOINT PRIMARY_KEY="%(index)dG0">'
+            '<PRIMARY_KEY>%(index)dG0</PRIMARY_KEY>'
+            '<HOSTNAME>host%(index)d.example.org</HOSTNAME>'
+            '<GOCDB_PORTAL_URL>https://goc.egi.eu/portal/index.php?'
+            'Page_Type=Service&amp;id=%(index)d</GOCDB_PORTAL_URL>'
+            '<BETA>%(beta)s</BETA>'
+            '<SERVICE_TYPE>%(service_type)s</SERVICE_TYPE>'
+            '<CORE/>'
+            '<IN_PRODUCTION>%(production)s</IN_PRODUCTION>'
+            '<NODE_MONITORED>%(monitored)s</NODE_MONITORED>'
+            '<NOTIFICATIONS>Y</NOTIFICATIONS>'
+            '<SITENAME>%(sitename)s</SITENAME>'
+            '<COUNTRY_NAME>%(country)s</COUNTRY_NAME>'
+            '<COUNTRY_CODE>%(code)s</COUNTRY_CODE>'
+            '<ROC_NAME>NGI_%(code)s</ROC_NAME>'
+            '<URL/><ENDPOINTS/>'
+            '<SCOPES>%(scopes)s</SCOPES>'
+            '<EXTENSIONS/>%(hostdn)s'
+            '</SERVICE_ENDPOINT>\n' % {
+                'index': index,
+                'beta': 'Y' if index % 20 == 0 else 'N',
+                'service_type': service_type,
+                'production': 'N' if index % 10 == 0 else 'Y',
+                'monitored': 'N' if index % 15 == 0 else 'Y',
+                'sitename': sitename,
+                'country': country,
+                'code': country[:2].upper(),
+                'scopes': scopes,
+                'hostdn': hostdn,
+            })
+    parts.append('</results>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def generate_sites(number):
+    """Generates a get_site_list reply with "number" SITE elements"""
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<results>\n']
+    for index in range(number):
+        sitename, country = _site(index)
+        parts.append(
+            '<SITE ID="%d" PRIMARY_KEY="%dG0" NAME="%s" COUNTRY="%s" '
+            'COUNTRY_CODE="%s" ROC="NGI_%s" SUBGRID="" '
+            'GIIS_URL="ldap://bdii.example.org:2170/Mds-Vo-name=%s,o=grid"/>\n'
+            % (index, index, sitename, country, country[:2].upper(),
+               country[:2].upper(), sitename))
+    parts.append('</results>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def generate_site_counts(number):
+    """Generates a get_site_count_per_country reply with "number" SITEs"""
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<results>\n']
+    for index in range(number):
+        parts.append('<SITE><COUNTRY>Country %d</COUNTRY>'
+                     '<COUNT>%d</COUNT></SITE>\n' % (index, index % 3))
+    parts.append('</results>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def generate_users(number):
+    """Generates a get_user reply with "number" EGEE_USER elements"""
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<results>\n']
+    for index in range(number):
+        sitename, _ = _site(index)
+        roles = []
+        # Most users have no role, some have many
+        for role in range(index % 7 - 3 if index % 7 > 3 else 0):
+            roles.append(
+                '<USER_ROLE><USER_ROLE>%s</USER_ROLE>'
+                '<ON_ENTITY>%s</ON_ENTITY><ENTITY_TYPE>%s</ENTITY_TYPE>'
+                '<PRIMARY_KEY>%d</PRIMARY_KEY><RECOGNISED_IN_PROJECTS>'
+                '<PROJECT ID="1">EGI</PROJECT></RECOGNISED_IN_PROJECTS>'
+                '</USER_ROLE>' % (ROLES[role % len(ROLES)], sitename,
+                                  ENTITY_TYPES[role % len(ENTITY_TYPES)],
+                                  index * 10 + role))
+        parts.append(
+            '<EGEE_USER ID="%(index)dG0" PRIMARY_KEY="%(index)dG0">'
+            '<FORENAME>User</FORENAME><SURNAME>%(index)d</SURNAME>'
+            '<TITLE/><DESCRIPTION></DESCRIPTION>'
+            '<GOCDB_PORTAL_URL>https://goc.egi.eu/portal/index.php?'
+            'Page_Type=User&amp;id=%(index)d</GOCDB_PORTAL_URL>'
+            '<EMAIL>user%(index)d@example.org</EMAIL><TEL>%(index)d</TEL>'
+            '<WORKING_HOURS_START/><WORKING_HOURS_END/>'
+            '<CERTDN>/C=UK/O=eScience/CN=user %(index)d</CERTDN>'
+            '<SSOUSERNAME>user%(index)d</SSOUSERNAME><APPROVED/><ACTIVE/>'
+            '<HOMESITE>%(homesite)s</HOMESITE>%(roles)s</EGEE_USER>\n' % {
+                'index': index,
+                'homesite': sitename if index % 4 else '',
+                'roles': ''.join(roles),
+            })
+    parts.append('</results>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def _dom(data):
+    """Returns the minidom document of some XML"""
+    return xml.dom.minidom.parseString(data)
+
+
+def _chunks(data):
+    """Returns some XML split into the chunks a streamed reply arrives in"""
+    return [data[start:start + 65536] for start in range(0, len(data), 65536)]
+
+
+def _merged(consumer, states):
+    """Merges the states of a sharded parse into a consumer"""
+    for state in states:
+        consumer.merge_state(state)
+    return consumer
+
+
+def _endpoint_nodes(data):
+    """Returns the SERVICE_ENDPOINT NodeList of some XML"""
+    return _dom(data).getElementsByTagName('SERVICE_ENDPOINT')
+
+
+# Each case is (name, generator, setup, function). "setup" turns the
+# generated XML into the function's argument and is not timed, so DOM
+# based functions are measured apart from the DOM parse itself.
+CASES = [
+    ('minidom.parseString[SERVICE_ENDPOINT]', generate_service_endpoints,
+     None, _dom),
+    ('metrics_apel.get_sites', generate_service_endpoints, _endpoint_nodes,
+     lambda nodes: metrics_apel.get_sites('APEL', nodes)),
+    ('metrics_apel.get_services', generate_service_endpoints,
+     _endpoint_nodes, lambda nodes: metrics_apel.get_services('APEL', nodes)),
+    ('metrics_apel.get_countries', generate_service_endpoints,
+     _endpoint_nodes,
+     lambda nodes: metrics_apel.get_countries('APEL', nodes)),
+    ('metrics_apel.get_endpoint_metrics_stream', generate_service_endpoints,
+     io.BytesIO,
+     lambda source: metrics_apel.get_endpoint_metrics_stream('APEL',
+                                                             source)),
+    ('metrics_apel.EndpointTable[iterparse]', generate_service_endpoints,
+     io.BytesIO, lambda source: metrics_apel.EndpointTable().add_elements(
+         metrics_apel.iter_service_endpoints(source))),
+    ('metrics_apel.EndpointTable.aggregator_for', generate_service_endpoints,
+     lambda data: metrics_apel.EndpointTable().add_elements(
+         metrics_apel.iter_service_endpoints(io.BytesIO(data))),
+     lambda table: [table.aggregator_for(service_type)
+                    for service_type in SERVICE_TYPES]),
+    ('metrics_apel.EndpointTable[stream]', generate_service_endpoints,
+     _chunks, lambda chunks: metrics_apel.EndpointTable().add_elements(
+         iter_chunked_elements(chunks, 'SERVICE_ENDPOINT'))),
+    # The parallel cases always shard, whatever the size of the input
+    ('metrics_apel.EndpointTable[parallel]', generate_service_endpoints,
+     None, lambda data: _merged(metrics_apel.EndpointTable(), parse_sharded(
+         data, 'SERVICE_ENDPOINT', partial(metrics_apel.endpoint_state,
+                                           metrics_apel.EndpointTable()),
+         threshold=0))),
+    ('minidom.parseString[SITE]', generate_sites, None, _dom),
+    ('metrics_gocdb.get_sites', generate_sites, _dom,
+     metrics_gocdb.get_sites),
+    ('metrics_gocdb.get_countries', generate_site_counts, _dom,
+     metrics_gocdb.get_countries),
+    ('minidom.parseString[EGEE_USER]', generate_users, None, _dom),
+    ('metrics_gocdb._parse_get_user_xml', generate_users, _dom,
+     metrics_gocdb._parse_get_user_xml),
+    ('metrics_gocdb._parse_get_user_xml_roles', generate_users, _dom,
+     metrics_gocdb._parse_get_user_xml_roles),
+    ('metrics_gocdb.UserStats.parse_xml', generate_users, _dom,
+     lambda xml_obj: metrics_gocdb.UserStats().parse_xml(xml_obj)),
+    ('metrics_gocdb.UserStats.parse', generate_users, io.BytesIO,
+     lambda source: metrics_gocdb.UserStats().parse(source)),
+    ('metrics_gocdb.UserStats[stream]', generate_users, _chunks,
+     lambda chunks: metrics_gocdb.UserStats().add_records(
+         iter_chunked_elements(chunks, 'EGEE_USER'))),
+    ('metrics_gocdb.UserStats[parallel]', generate_users, None,
+     lambda data: _merged(metrics_gocdb.UserStats(), parse_sharded(
+         data, 'EGEE_USER', metrics_gocdb._user_state, threshold=0))),
+]
+
+# The serial case each parallel case's speedup is measured against
+PARALLEL_BASELINES = {
+    'metrics_apel.EndpointTable[parallel]':
+        'metrics_apel.EndpointTable[iterparse]',
+    'metrics_gocdb.UserStats[parallel]': 'metrics_gocdb.UserStats.parse',
+}
+
+
+def measure(function, setup, data, repeat):
+    """
+    This function times a parsing function and records its peak memory.
+
+    Params
+    ------
+    function: function
+              The function to benchmark
+    setup: function
+           Turns the XML into the function's argument, or None to pass
+           the XML itself
+    data: bytes
+          The generated XML
+    repeat: int
+            How many timed runs to make; the fastest one is reported
+    Returns
+    -------
+    result: dict
+            The best time in seconds and the peak memory in bytes
+
+    Notes
+    -----
+    The timed runs are made without tracemalloc, which slows allocation
+    down, and the peak memory is taken from one more, traced run. The
+    peak memory of a parallel case is that of this process only, not of
+    its workers.
+    """
+    timings = []
+    for _ in range(repeat):
+        argument = setup(data) if setup else data
+        started = time.perf_counter()
+        function(argument)
+        timings.append(time.perf_counter() - started)
+
+    argument = setup(data) if setup else data
+    tracemalloc.start()
+    function(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': min(timings), 'peak_bytes': peak}
+
+
+def _git_commit():
+    """Returns the current git commit, or None outside a git checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, repeat=3, selected=None):
+    """
+    This function runs every benchmark case at every size.
+
+    Params
+    ------
+    sizes: list
+           The numbers of elements to generate
+    repeat: int
+            How many timed runs to make for each case
+    selected: string
+              Only run the cases whose name contains this, if given
+    Returns
+    -------
+    report: dict
+            The environment, a result per case and size and the speedup of
+            each parallel case over its serial baseline, ready to be
+            written as JSON
+    """
+    results = []
+    for size in sizes:
+        generated = {}
+        for name, generator, setup, function in CASES:
+            if selected and selected not in name:
+                continue
+            if generator not in generated:
+                generated[generator] = generator(size)
+            result = measure(function, setup, generated[generator], repeat)
+            result.update({
+                'case': name,
+                'elements': size,
+                'input_bytes': len(generated[generator]),
+            })
+            results.append(result)
+            print('%-48s %9d %10.4fs %12d bytes' % (
+                name, size, result['seconds'], result['peak_bytes']))
+
+    seconds = dict(((result['case'], result['elements']), result['seconds'])
+                   for result in results)
+    workers = PARALLEL_SETTINGS['workers'] or os.cpu_count()
+    speedups = []
+    for case, baseline in sorted(PARALLEL_BASELINES.items()):
+        for size in sizes:
+            if (case, size) not in seconds or (baseline, size) not in seconds:
+                continue
+            speedups.append({
+                'case': case,
+                'baseline': baseline,
+                'elements': size,
+                'workers': workers,
+                'speedup': seconds[(baseline, size)] / seconds[(case, size)],
+            })
+            print('%-48s %9d %9.2fx on %d workers' % (
+                case, size, speedups[-1]['speedup'], workers))
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now().isoformat(),
+        'results': results,
+        'speedups': speedups,
+    }
+
+
+def build_parser():
+    """Returns the command line option parser of this script"""
+    parser = OptionParser()
+    parser.add_option("-s", "--sizes", dest="sizes",
+                      default="1000,10000,100000",
+                      help=("Comma separated numbers of elements to "
+                            "generate, up to 1000000."))
+    parser.add_option("-r", "--repeat", dest="repeat", default="3",
+                      help="How many timed runs to make of each case.")
+    parser.add_option("-j", "--workers", dest="workers", default="0",
+                      help=("How many processes the parallel cases use, 0 "
+                            "for one per core."))
+    parser.add_option("-k", "--select", dest="select", default=None,
+                      help="Only run the cases whose name contains this.")
+    parser.add_option("-o", "--output", dest="output",
+                      default="benchmark_results.json",
+                      help="Where to write the results as JSON.")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    (options, args) = parser.parse_args()
+    configure_parallel(workers=int(options.workers) or None)
+    report = run_benchmarks([int(size) for size in options.sizes.split(',')],
+                            int(options.repeat), options.select)
+    with open(options.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
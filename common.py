@@ -2,48 +2,1544 @@
 This script holds the common functions between the GOCDB and
 APEL metric collecting scripts
 """
+import atexit
+import hashlib
+import io
 import logging
+import logging.handlers
 import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from xml.etree import ElementTree
+from urllib.parse import urlparse
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ElasticsearchException
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import resource
+except ImportError:
+    resource = None
 
 logger = logging.getLogger(__name__)
 
-class GetData(object):
-    """This class is used to fetch data"""
-    def __init__(self, data, location, url):
-        self.data = data
-        self.location = location
+GOCDB_URL = 'https://goc.egi.eu/gocdbpi/'
+
+class FieldExtractor(object):
+    """
+    This class reads chosen fields out of a record in one pass.
+
+    It is built once from the tags of the fields wanted, and "extract"
+    then looks only at the direct children of each record, so nothing is
+    searched twice. Records may be minidom nodes or ElementTree elements.
+    Fields that are lists of child elements, such as SCOPES/SCOPE, are
+    read into Python lists.
+    """
+    def __init__(self, fields, lists=None):
+        self.fields = frozenset(fields)
+        self.lists = dict(lists or {})
+
+    def extract(self, record):
+        """
+        Returns the fields of a single record.
+
+        Params
+        ------
+        record: minidom node or ElementTree element
+                The record to read, such as a SERVICE_ENDPOINT
+        Returns
+        -------
+        fields: dict
+                The text of each wanted field the record has, keyed by
+                tag. A field that is present but empty is read as "", and
+                a missing one is left out.
+        """
+        fields = {}
+        if hasattr(record, 'childNodes'):
+            for child in record.childNodes:
+                if child.nodeType != child.ELEMENT_NODE:
+                    continue
+                tag = child.tagName
+                if tag in self.fields:
+                    fields[tag] = _node_text(child)
+                elif tag in self.lists:
+                    fields[tag] = [
+                        _node_text(item) for item in child.childNodes
+                        if item.nodeType == item.ELEMENT_NODE and
+                        item.tagName == self.lists[tag] and item.firstChild
+                    ]
+            return fields
+
+        for child in record:
+            tag = child.tag
+            if tag in self.fields:
+                fields[tag] = child.text or ''
+            elif tag in self.lists:
+                fields[tag] = [item.text for item in child
+                               if item.tag == self.lists[tag] and item.text]
+        return fields
+
+
+def _node_text(node):
+    """Returns the text of a minidom node, as "GetData" used to"""
+    return node.firstChild.nodeValue if node.firstChild else ''
+
+
+def log_missing(log, missing, records):
+    """
+    This function logs, once, how many records lacked each field.
+
+    Params
+    ------
+    log: logging.Logger
+         Where to log the warning
+    missing: dict
+             The number of records that lacked each field
+    records: string
+             What the records are, such as "APEL endpoints"
+    """
+    counts = ', '.join('%d without %s' % (count, tag)
+                       for tag, count in sorted(missing.items()) if count)
+    if counts:
+        log.warning('Some %s are incomplete: %s', records, counts)
+
+
+# Held by "ResponseCache.evict", with a lock file, as the collectors may
+# share a cache directory and run at the same time
+_evict_lock = threading.Lock()
+
+
+class ResponseCache(object):
+    """
+    This class keeps GOCDBPI replies on disk between runs.
+
+    Each reply is stored under a hash of its full url (method and query)
+    along with its ETag and Last-Modified headers, which are sent back to
+    the server so an unchanged reply costs a 304 instead of the payload.
+    Parsed results can be stored next to a reply and are reused for as
+    long as its body is unchanged. Entries older than "ttl" seconds are
+    evicted, then the least recently used ones until the cache fits in
+    "max_bytes".
+    """
+    def __init__(self, directory, ttl=7 * 24 * 3600, max_bytes=256 * 2**20):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            # Private get_user replies end up here, so keep it to ourselves
+            os.makedirs(directory, 0o700)
+
+    def _path(self, url, suffix):
+        """Returns the path of a cache file for a url"""
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + suffix)
+
+    def _write(self, path, data):
+        """Writes a cache file atomically, readable only by its owner"""
+        temp_path = path + '.%d.tmp' % os.getpid()
+        handle = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+        with os.fdopen(handle, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(temp_path, path)
+
+    def lookup(self, url):
+        """Returns the stored metadata for a url, or None"""
+        try:
+            with open(self._path(url, '.json')) as meta_file:
+                meta = json.load(meta_file)
+        except (IOError, ValueError):
+            return None
+        if not os.path.exists(self._path(url, '.body')):
+            return None
+        # An entry about to be revalidated is the newest, so another
+        # run's "evict" leaves it for the 304 to be answered from
+        try:
+            self.touch(url)
+        except FileNotFoundError:
+            return None
+        return meta
+
+    def conditional_headers(self, meta):
+        """Returns the revalidation headers for stored metadata"""
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def store(self, url, response):
+        """Stores the body and validators of a 200 response"""
+        content = response.content
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_type': response.headers.get('Content-Type'),
+            'digest': hashlib.sha1(content).hexdigest(),
+            'stored_at': time.time(),
+        }
+        self._write(self._path(url, '.body'), content)
+        self._write(self._path(url, '.json'), json.dumps(meta).encode('utf-8'))
+        return meta
+
+    def cached_response(self, url, meta, response):
+        """Turns a 304 response into a 200 response holding the stored body"""
+        with open(self._path(url, '.body'), 'rb') as body_file:
+            content = body_file.read()
+        self.touch(url)
+        response.status_code = 200
+        response._content = content
+        response._content_consumed = True
+        if meta.get('content_type'):
+            response.headers['Content-Type'] = meta['content_type']
+        return response
+
+    def body_path(self, url):
+        """Returns the path of the stored body of a url"""
+        return self._path(url, '.body')
+
+    def touch(self, url):
+        """Marks the entry of a url as just used"""
+        os.utime(self._path(url, '.json'), None)
+
+    def writer(self, url, response):
+        """Returns a "BodyWriter" that stores a body as it is read"""
+        return BodyWriter(self, url, response)
+
+    def load_parsed(self, response, name, version=1):
+        """Returns a stored parsed result if the body has not changed"""
+        return self.load_parsed_for(
+            response.url, hashlib.sha1(response.content).hexdigest(), name,
+            version)
+
+    def _parsed_path(self, url, name, version):
+        """Returns the path of a parsed result, by name and format"""
+        return self._path(url, '.%s.v%d.parsed' % (name, version))
+
+    def load_parsed_for(self, url, digest, name, version=1):
+        """Returns the result stored for a url's body with a given sha1"""
+        path = self._parsed_path(url, name, version)
+        try:
+            with open(path) as parsed_file:
+                parsed = json.load(parsed_file)
+        except (IOError, ValueError):
+            return None
+        if parsed.get('digest') != digest:
+            return None
+        return parsed['result']
+
+    def store_parsed(self, response, name, result, version=1):
+        """Stores a parsed result against the body it was parsed from"""
+        self.store_parsed_for(response.url,
+                              hashlib.sha1(response.content).hexdigest(),
+                              name, result, version)
+
+    def store_parsed_for(self, url, digest, name, result, version=1):
+        """
+        Stores a parsed result against the sha1 of a url's body.
+
+        "version" is the format of the result, which is part of its key,
+        so a result stored before its parse function changed is not read.
+        """
+        parsed = {
+            'digest': digest,
+            'result': result,
+        }
+        self._write(self._parsed_path(url, name, version),
+                    json.dumps(parsed).encode('utf-8'))
+
+    def load_timing(self, name):
+        """
+        Returns the last recorded timing of a name, or None.
+
+        A timing is a dictionary holding the "seconds" taken and when it
+        was "stored_at".
+        """
+        try:
+            with open(os.path.join(self.directory,
+                                   name + '.timing')) as timing_file:
+                return json.load(timing_file)
+        except (IOError, ValueError):
+            return None
+
+    def store_timing(self, name, seconds):
+        """Records how long something, such as a fetch, took this run"""
+        timing = {
+            'seconds': seconds,
+            'stored_at': time.time(),
+        }
+        self._write(os.path.join(self.directory, name + '.timing'),
+                    json.dumps(timing).encode('utf-8'))
+
+    def evict(self):
+        """
+        Removes expired entries, then the oldest until under max_bytes.
+
+        Both collectors share the cache directory and may run at once, so
+        eviction holds a lock on "evict.lock" in it, and files another run
+        removes or renames in the meantime are passed over.
+        """
+        with _evict_lock, open(os.path.join(self.directory, 'evict.lock'),
+                               'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._evict()
+
+    def _evict(self):
+        """Does the work of "evict", under its lock"""
+        now = time.time()
+        groups = {}
+        for name in os.listdir(self.directory):
+            # Every file of an entry starts with the 40 character url hash,
+            # anything else, such as a collector's snapshot, is left alone.
+            # So are the temporary files of writes still in progress.
+            if name[40:41] != '.' or \
+                    name[:40].strip('0123456789abcdef') or \
+                    name.endswith('.tmp'):
+                continue
+            groups.setdefault(name[:40], []).append(
+                os.path.join(self.directory, name))
+
+        entries = []
+        for key, paths in groups.items():
+            try:
+                last_used = os.path.getmtime(
+                    os.path.join(self.directory, key + '.json'))
+            except FileNotFoundError:
+                last_used = 0
+            size = 0
+            for path in paths:
+                try:
+                    size = size + os.path.getsize(path)
+                except FileNotFoundError:
+                    pass
+            entries.append((last_used, size, paths))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for last_used, size, paths in entries:
+            if now - last_used <= self.ttl and total <= self.max_bytes:
+                continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total = total - size
+
+
+class BodyWriter(object):
+    """
+    This class stores a reply in a "ResponseCache" while it is streamed.
+
+    Chunks are written to a private temporary file and hashed as they
+    arrive. "commit" then moves the body into place with its metadata,
+    and "abort" throws it away, so a reply cut short is never cached.
+    """
+    def __init__(self, cache, url, response):
+        self.cache = cache
         self.url = url
-    def data_finder(self):
-        """This function fetches the data"""
+        self.response = response
+        self.sha1 = hashlib.sha1()
+        self.path = cache.body_path(url)
+        self.temp_path = self.path + '.%d.%d.tmp' % (os.getpid(),
+                                                      threading.get_ident())
+        handle = os.open(self.temp_path,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.body_file = os.fdopen(handle, 'wb')
+
+    def write(self, chunk):
+        """Adds a chunk of the body"""
+        self.body_file.write(chunk)
+        self.sha1.update(chunk)
+
+    def commit(self):
+        """Stores the body and its metadata, returning the metadata"""
+        self.body_file.close()
+        meta = {
+            'url': self.url,
+            'etag': self.response.headers.get('ETag'),
+            'last_modified': self.response.headers.get('Last-Modified'),
+            'content_type': self.response.headers.get('Content-Type'),
+            'digest': self.sha1.hexdigest(),
+            'stored_at': time.time(),
+        }
+        os.replace(self.temp_path, self.path)
+        self.cache._write(self.cache._path(self.url, '.json'),
+                          json.dumps(meta).encode('utf-8'))
+        return meta
+
+    def abort(self):
+        """Throws the partial body away"""
+        self.body_file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+# What a cached result in an older format raises when it is loaded
+STALE_RESULT_ERRORS = (KeyError, TypeError, ValueError)
+
+
+def _load_cached(name, result, load):
+    """Passes a cached result to "load", returns False if it is unreadable"""
+    if load is None:
+        return True
+    try:
+        load(result)
+    except STALE_RESULT_ERRORS as error:
+        logger.warning('Parsing again, the cached %s result cannot be '
+                       'read: %r', name, error)
+        return False
+    return True
+
+
+def parse_cached(cache, response, name, parse, version=1, load=None):
+    """
+    This function parses a reply, reusing the cached result if unchanged.
+
+    Params
+    ------
+    cache: ResponseCache
+           The cache the reply came through, or None
+    response: requests response object
+              The reply to parse
+    name: string
+          Identifies the parse function, as one reply can be parsed
+          several ways
+    parse: function
+           Takes the response and returns a JSON serialisable result
+    version: int
+             The format of the result. It is raised whenever the result
+             changes shape, so results cached in the old one are not used.
+    load: function
+          Is called with the result, such as a consumer's "merge_state".
+          A cached result it raises one of STALE_RESULT_ERRORS on, before
+          changing anything, is treated as a miss.
+    Returns
+    -------
+    The result of parse(response)
+    """
+    if cache is not None:
+        result = cache.load_parsed(response, name, version)
+        if result is not None and _load_cached(name, result, load):
+            return result
+    result = parse(response)
+    if cache is not None:
+        cache.store_parsed(response, name, result, version)
+    if load is not None:
+        load(result)
+    return result
+
+
+def iter_elements(source, tag):
+    """
+    This function streams the elements with a given tag out of a GOCDB reply.
+
+    Params
+    ------
+    source: file-like object
+            This holds the raw XML returned by GOCDBPI
+    tag: string
+         The tag of the records to yield, such as SITE or EGEE_USER
+    Returns
+    -------
+    A generator of ElementTree elements, one per record.
+
+    Notes
+    -----
+    Each element is cleared and detached from the document root once the
+    caller has finished with it, so memory use does not grow with the size
+    of the reply.
+    """
+    context = ElementTree.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event == 'end' and element.tag == tag:
+            yield element
+            element.clear()
+            root.clear()
+
+
+PARALLEL_SETTINGS = {
+    # Worker processes for sharded parsing, None for one per core
+    'workers': None,
+    # Replies smaller than this are parsed in this process
+    'threshold': 8 * 2**20,
+}
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def configure_parallel(**settings):
+    """
+    This function changes the settings of sharded parsing.
+
+    Params
+    ------
+    settings: keyword arguments
+              Any of the keys of PARALLEL_SETTINGS
+
+    Notes
+    -----
+    If the number of workers changes, the shared process pool is dropped
+    so the next "get_process_pool" starts one with the new settings. The
+    daemon calls this on every run, so a pool with the same settings is
+    kept, along with its warm workers.
+    """
+    with _process_pool_lock:
+        changed = ('workers' in settings and
+                   settings['workers'] != PARALLEL_SETTINGS['workers'])
+        PARALLEL_SETTINGS.update(settings)
+    if changed:
+        _drop_process_pool()
+
+
+def _drop_process_pool(pool=None):
+    """
+    Shuts the shared process pool down, so the next call starts another.
+
+    If "pool" is given, it is only dropped if it is still the shared one,
+    so a run that saw it break does not drop the pool another run has
+    already replaced it with.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None or pool not in (None, _process_pool):
+            return
+        pool, _process_pool = _process_pool, None
+    # Parses already submitted to the pool are left to finish
+    pool.shutdown(wait=False)
+
+
+def get_process_pool():
+    """
+    Returns the process pool shared by every sharded parse of a run.
+
+    Its workers are started from a fork server where there is one, as
+    forking a process that runs fetch and logging threads can copy their
+    locks in a held state.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            try:
+                context = multiprocessing.get_context('forkserver')
+            except ValueError:
+                context = None
+            _process_pool = ProcessPoolExecutor(
+                max_workers=PARALLEL_SETTINGS['workers'] or os.cpu_count(),
+                mp_context=context)
+        return _process_pool
+
+
+def _stop_process_pool():
+    """Stops the workers of the shared process pool, at exit"""
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+atexit.register(_stop_process_pool)
+
+
+def _find_record(content, opening, start):
+    """Returns the offset of the next record opening tag, or -1"""
+    while True:
+        position = content.find(opening, start)
+        after = content[position + len(opening):position + len(opening) + 1]
+        # <SITE must not match <SITENAME
+        if position < 0 or after in (b' ', b'>', b'/', b'\n', b'\r', b'\t'):
+            return position
+        start = position + 1
+
+
+def split_records(content, tag, shards):
+    """
+    This function splits a GOCDB reply into smaller replies.
+
+    Params
+    ------
+    content: bytes
+             The raw XML returned by GOCDBPI
+    tag: string
+         The tag of its records, such as SERVICE_ENDPOINT or EGEE_USER
+    shards: int
+            How many replies to split it into, at most
+    Returns
+    -------
+    shards: list
+            Replies of about the same size, each holding a run of whole
+            records in a root element, in their original order
+
+    Notes
+    -----
+    The reply is cut at the opening tags of records found with a plain
+    byte search, so no tree is built. Records do not nest in GOCDB
+    replies and tags cannot occur in their text, so every cut falls
+    between two records. The meta block before the first record is left
+    out.
+    """
+    opening = ('<' + tag).encode('utf-8')
+    first = _find_record(content, opening, 0)
+    # The closing tag of the root element
+    end = content.rfind(b'</')
+    if first < 0 or shards < 2:
+        return [content]
+
+    shard_size = (end - first) // shards + 1
+    pieces = []
+    start = first
+    while start < end:
+        cut = -1
+        if start + shard_size < end:
+            cut = _find_record(content, opening, start + shard_size)
+        if cut < 0 or cut > end:
+            cut = end
+        pieces.append(b'<results>' + content[start:cut] + b'</results>')
+        start = cut
+    return pieces
+
+
+def _parse_shard(parse, tag, shard):
+    """Runs "parse" on the records of a shard, in a worker process"""
+    return parse(iter_elements(io.BytesIO(shard), tag))
+
+
+def parse_sharded(content, tag, parse, workers=None, threshold=None):
+    """
+    This function parses a GOCDB reply on every core.
+
+    Params
+    ------
+    content: bytes
+             The raw XML returned by GOCDBPI
+    tag: string
+         The tag of its records, such as SERVICE_ENDPOINT or EGEE_USER
+    parse: function
+           Takes ElementTree records and returns a picklable result, such
+           as the "to_state" of an aggregator. It must be defined at the
+           top level of a module, or be a functools.partial of one, to
+           reach the worker processes.
+    workers, threshold: int
+                        Override PARALLEL_SETTINGS for this call
+    Returns
+    -------
+    results: list
+             The result of each shard, in document order, ready to be
+             merged. A reply smaller than "threshold" is parsed here, as
+             a single shard.
+    """
+    if threshold is None:
+        threshold = PARALLEL_SETTINGS['threshold']
+    if workers is None:
+        workers = PARALLEL_SETTINGS['workers'] or os.cpu_count()
+    if workers < 2 or len(content) < threshold:
+        return [_parse_shard(parse, tag, content)]
+    shards = split_records(content, tag, workers)
+    pool = get_process_pool()
+    try:
+        return list(pool.map(
+            _parse_shard, [parse] * len(shards), [tag] * len(shards),
+            shards))
+    except BrokenProcessPool as error:
+        # A worker died, of memory most likely; the next call starts a
+        # new pool and this reply is parsed here
+        logger.error('Sharded parsing failed, parsing %s records in one '
+                     'process: %s', tag, error)
+        _drop_process_pool(pool)
+        return [_parse_shard(parse, tag, content)]
+    except RuntimeError as error:
+        # The pool was shut down by another run changing the settings,
+        # or at exit, after this run was handed it
+        logger.warning('Process pool unavailable, parsing %s records in '
+                       'one process: %s', tag, error)
+        return [_parse_shard(parse, tag, content)]
+
+
+class FetchError(requests.exceptions.ConnectionError):
+    """
+    This exception is raised when GOCDB cannot be reached in time.
+
+    It is a ConnectionError, so the collectors' existing handlers skip
+    the metrics that needed the reply.
+    """
+
+
+# Failures worth retrying; anything else is a bug or a bad request
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+
+
+class CircuitBreaker(object):
+    """
+    This class stops calls to a service that keeps failing.
+
+    After "threshold" failed attempts in a row the circuit opens, and
+    "check" raises a FetchError straight away for "reset_timeout"
+    seconds. One attempt is then let through: if it succeeds the circuit
+    closes, and if it fails the circuit opens again. It is safe to use
+    from several threads.
+    """
+    def __init__(self, threshold=5, reset_timeout=300):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def check(self):
+        """
+        Raises a FetchError if calls should not be made now.
+
+        Returns True if the call is the one let through an open circuit,
+        whose outcome has to be given to "success", "failure" or
+        "release".
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if self._trial or \
+                    time.time() - self.opened_at < self.reset_timeout:
+                raise FetchError('GOCDB is failing, not calling it until '
+                                 'the circuit breaker resets')
+            self._trial = True
+            return True
+
+    def release(self):
+        """Gives back a trial call that ended without an outcome"""
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        """Records a successful call, closing the circuit"""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        """Records a failed call, opening the circuit if there are enough"""
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+
+def iter_chunked_elements(chunks, tag, links=None):
+    """
+    This function streams records out of a GOCDB reply as it downloads.
+
+    Params
+    ------
+    chunks: iterable
+            The raw XML of the reply, in chunks of bytes
+    tag: string
+         The tag of the records to yield, such as SITE or EGEE_USER
+    links: dict
+           If given, the links of the reply's meta block are added to it,
+           keyed by their "rel"
+    Returns
+    -------
+    A generator of ElementTree elements, one per record.
+
+    Notes
+    -----
+    Each chunk is fed to an XMLPullParser as soon as it arrives, so
+    records are yielded while the rest of the reply is still on its way,
+    and each one is cleared once the caller has finished with it, as in
+    "iter_elements".
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == 'end':
+                if element.tag == tag:
+                    yield element
+                    element.clear()
+                    root.clear()
+                elif element.tag == 'link' and links is not None:
+                    links[element.get('rel')] = element.get('href')
+            elif root is None:
+                root = element
+    parser.close()
+
+
+def parse_streamed(page, name, parse, version=1, load=None):
+    """
+    This function parses a "StreamedPage", reusing the cached result.
+
+    Params
+    ------
+    page: StreamedPage
+          The page to parse
+    name: string
+          Identifies the parse function, as in "parse_cached"
+    parse: function
+           Takes the page, reads its records and returns a JSON
+           serialisable result
+    version, load: int, function
+                   As in "parse_cached"
+    Returns
+    -------
+    The result of parse(page)
+
+    Notes
+    -----
+    A page that GOCDB said is unchanged is not parsed at all when its
+    result is cached. Results are stored against the sha1 of the body,
+    as "parse_cached" does, so either can reuse the other's results.
+    """
+    cache = page.client.cache
+    if cache is not None and page.digest is not None:
+        result = cache.load_parsed_for(page.url, page.digest, name, version)
+        if result is not None and _load_cached(name, result, load):
+            return result
+    result = parse(page)
+    if cache is not None and page.digest is not None:
+        cache.store_parsed_for(page.url, page.digest, name, result, version)
+    if load is not None:
+        load(result)
+    return result
+
+
+class GOCDBClient(object):
+    """
+    This class fetches data from GOCDBPI over a pooled keep-alive session.
+
+    Each request has a connect and a read timeout. Connection errors,
+    timeouts and 5xx replies are retried up to "retries" times, after an
+    exponential backoff of "backoff" seconds with full jitter. Every
+    attempt also has to finish before the deadline set by "set_deadline",
+    and a "CircuitBreaker" shared by every request fails them quickly
+    while GOCDB is down. A request that cannot succeed raises FetchError.
+    """
+    def __init__(self, verify=True, cert=None, pool_size=4, cache=None,
+                 base_url=None, timeout=(10, 60), retries=3, backoff=1.0,
+                 breaker=None):
+        self.verify = verify
+        self.cache = cache
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.deadline = None
+        self.session = requests.Session()
+        self.session.cert = cert
+        # One pool shared by every thread, so concurrent calls reuse the
+        # same keep-alive connections instead of opening new ones.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def set_deadline(self, seconds):
+        """Makes every request fail once "seconds" from now have passed"""
+        self.deadline = time.time() + seconds if seconds else None
+
+    def _timeout(self):
+        """Returns the timeout of the next attempt, within the deadline"""
+        if self.deadline is None:
+            return self.timeout
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise FetchError('The deadline of this run has passed')
+        return (min(self.timeout[0], remaining),
+                min(self.timeout[1], remaining))
+
+    def _send(self, url, headers, stream=False):
+        """
+        Sends a GET request, retrying transient failures.
+
+        Returns the first response that is not a 5xx reply, and raises a
+        FetchError once the retries or the time run out. With "stream",
+        only the headers have been read when it returns.
+        """
+        attempt = 0
+        while True:
+            # Running out of time is checked first, so it never takes the
+            # breaker's trial call
+            timeout = self._timeout()
+            trial = self.breaker.check()
+            recorded = False
+            try:
+                try:
+                    response = self.session.get(url, headers=headers,
+                                                verify=self.verify,
+                                                timeout=timeout,
+                                                stream=stream)
+                except TRANSIENT_ERRORS as error:
+                    failure = error
+                else:
+                    if response.status_code < 500:
+                        self.breaker.success()
+                        recorded = True
+                        return response
+                    response.close()
+                    failure = FetchError('GOCDB replied %d' %
+                                         response.status_code)
+                self.breaker.failure()
+                recorded = True
+            finally:
+                # Any other exception leaves the circuit as it was, rather
+                # than holding the trial for good
+                if trial and not recorded:
+                    self.breaker.release()
+
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if attempt >= self.retries or (
+                    self.deadline is not None and
+                    time.time() + delay >= self.deadline):
+                raise FetchError('Giving up on %s: %s' % (url, failure))
+            logger.warning('Request to GOCDB failed, retrying in %.1fs: %s',
+                           delay, failure)
+            time.sleep(delay)
+            attempt += 1
+
+    def method_url(self, method, scope='public', **params):
+        """Returns the url of a GOCDBPI method call"""
+        query = {'method': method}
+        query.update(params)
+        base_url = self.base_url or GOCDB_URL
+        return requests.Request('GET', base_url + scope + '/',
+                                params=query).prepare().url
+
+    def get(self, method, scope='public', stats=None, **params):
+        """
+        This function calls a GOCDBPI method and returns the response.
+
+        If a "RunStats" is given, the request is timed as a "fetch".
+        """
+        return self.get_url(self.method_url(method, scope, **params), stats)
+
+    def get_url(self, url, stats=None):
+        """
+        This function fetches a full GOCDBPI url, such as a page link.
+
+        When the client has a cache, the request is revalidated against the
+        stored copy and a 304 reply is answered from it. Every response
+        gets a "from_cache" attribute saying which happened. A FetchError
+        is raised if GOCDB cannot be reached in time.
+        """
+        meta = None
+        headers = {}
+        if self.cache is not None:
+            meta = self.cache.lookup(url)
+            if meta is not None:
+                headers = self.cache.conditional_headers(meta)
+
+        with run_phase(stats, 'fetch') as record:
+            response = self._send(url, headers)
+            record['bytes'] = len(response.content)
+        response.from_cache = False
+        if self.cache is not None:
+            if response.status_code == 304 and meta is not None:
+                response = self.cache.cached_response(url, meta, response)
+                response.from_cache = True
+            elif response.status_code == 200:
+                self.cache.store(url, response)
+        return response
+
+    def stream_url(self, url, stats=None):
+        """
+        This function starts fetching a GOCDBPI url as a "StreamedPage".
+
+        Only the headers have been read when it returns. An unchanged
+        reply is read back from the cache, and any reply other than 200
+        or 304 raises a FetchError.
+        """
+        meta = None
+        headers = {}
+        if self.cache is not None:
+            meta = self.cache.lookup(url)
+            if meta is not None:
+                headers = self.cache.conditional_headers(meta)
+
+        with run_phase(stats, 'fetch'):
+            response = self._send(url, headers, stream=True)
+        if response.status_code == 304 and meta is not None:
+            response.close()
+            self.cache.touch(url)
+            return StreamedPage(self, url, digest=meta['digest'],
+                                body_path=self.cache.body_path(url))
+        if response.status_code != 200:
+            response.close()
+            raise FetchError('GOCDB replied %d to %s' %
+                             (response.status_code, url))
+        writer = None
+        if self.cache is not None:
+            writer = self.cache.writer(url, response)
+        return StreamedPage(self, url, response=response, writer=writer)
+
+    def stream_pages(self, method, scope='public', stats=None, **params):
+        """
+        This function yields a "StreamedPage" for every page of a method.
+
+        The "next" link in each page's meta block is followed until there
+        are no pages left. The meta block comes first, so the next page is
+        requested in the background as soon as the caller has read the
+        first record of the current one, and its headers arrive while the
+        current page is still streaming.
+        """
+        url = self.method_url(method, scope, **params)
+        seen = set([url])
+        prefetched = {}
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        def prefetch(next_url):
+            if next_url not in seen and next_url not in prefetched:
+                prefetched[next_url] = executor.submit(self.stream_url,
+                                                       next_url, stats)
+
+        def close_unused(future):
+            if not future.cancelled() and future.exception() is None:
+                future.result().close()
+
+        page = None
         try:
-            info = \
-                self.location.getElementsByTagName(self.data.upper())[0]\
-                .firstChild.nodeValue
-                # finds the sitename and stores it
-            return info
-        except IndexError:
-            logger.warning('Index error when requesting '
-                           +self.data.upper() + 'from' + self.url)
+            page = self.stream_url(url, stats)
+            while True:
+                page.on_next = prefetch
+                try:
+                    yield page
+                    url = page.next_url()
+                finally:
+                    page.close()
+                if url is None or url in seen:
+                    return
+                seen.add(url)
+                future = prefetched.pop(url, None)
+                if future is None:
+                    page = self.stream_url(url, stats)
+                else:
+                    page = future.result()
+        finally:
+            # A page fetched for a caller that stopped early is let go
+            if page is not None:
+                page.on_next = None
+            for future in prefetched.values():
+                future.add_done_callback(close_unused)
+            executor.shutdown(wait=False)
 
+    def iter_pages(self, method, scope='public', stats=None, **params):
+        """
+        This function yields the response for every page of a GOCDBPI method.
 
-class ModLogger(object):
-    """This class is used to modify the logger"""
-    def __init__(self, LogName):
-        self.LogName = LogName
+        The "next" link in each page's meta block is followed until there
+        are no pages left. The next page is requested in the background
+        while the caller parses the current one, so downloads overlap
+        parsing. Methods that are not paged simply yield one response.
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            future = executor.submit(self.get, method, scope, stats,
+                                     **params)
+            seen = set()
+            while future is not None:
+                response = future.result()
+                next_url = next_page_url(response.content)
+                future = None
+                if next_url is not None and next_url not in seen:
+                    seen.add(next_url)
+                    future = executor.submit(self.get_url, next_url, stats)
+                yield response
+        finally:
+            executor.shutdown(wait=False)
 
-    def logger_mod(self):
-        """Sets up the logger"""
-        # sets the logger
 
-        #logger = logging.getLogger(__name__)
-        logger.setLevel(logging.INFO)
+class StreamedPage(object):
+    """
+    This class is one GOCDBPI reply, parsed while it downloads.
+
+    "records" feeds the body to "iter_chunked_elements" a chunk at a time
+    and yields each record as soon as it is complete, so the whole body
+    is never held in memory. A body coming from the network is written
+    to the cache as it is read, and one GOCDB said is unchanged is read
+    back from the cache instead. "digest" is the sha1 of the body, known
+    at once for a cached body and once the records have been read for
+    the others.
+    """
+    def __init__(self, client, url, response=None, writer=None, digest=None,
+                 body_path=None, chunk_size=65536):
+        self.client = client
+        self.url = url
+        self.response = response
+        self.writer = writer
+        self.digest = digest
+        self.body_path = body_path
+        self.chunk_size = chunk_size
+        self.from_cache = body_path is not None
+        self.bytes_read = 0
+        self.links = {}
+        # Called with the "next" link once it has been parsed
+        self.on_next = None
+        self._read = False
+
+    def _network_chunks(self):
+        """Yields the body from the network, storing it in the cache"""
+        sha1 = hashlib.sha1()
+        chunks = self.response.iter_content(self.chunk_size)
+        while True:
+            try:
+                chunk = next(chunks, None)
+            except TRANSIENT_ERRORS as error:
+                self.client.breaker.failure()
+                raise FetchError('Reading %s failed: %s' % (self.url, error))
+            if chunk is None:
+                break
+            # The read timeout applies to each chunk, so the deadline is
+            # checked between them; running out of time is not GOCDB's
+            # failure, so it is kept out of the breaker's count
+            self.client._timeout()
+            sha1.update(chunk)
+            if self.writer is not None:
+                self.writer.write(chunk)
+            yield chunk
+        self.digest = sha1.hexdigest()
+        if self.writer is not None:
+            self.writer.commit()
+            self.writer = None
+
+    def _cached_chunks(self):
+        """Yields the body from the cache"""
+        with open(self.body_path, 'rb') as body_file:
+            for chunk in iter(lambda: body_file.read(self.chunk_size), b''):
+                yield chunk
+
+    def _chunks(self):
+        """Yields the body once, counting the bytes read"""
+        if self._read:
+            raise ValueError('The records of a page can only be read once')
+        self._read = True
+        chunks = self._cached_chunks() if self.from_cache \
+            else self._network_chunks()
+        for chunk in chunks:
+            self.bytes_read += len(chunk)
+            yield chunk
+
+    def records(self, tag):
+        """Yields the records with a given tag as they are parsed"""
+        records = iter_chunked_elements(self._chunks(), tag, self.links)
+        for record in records:
+            # The meta block comes before the first record, so its
+            # "next" link is known by now
+            if self.on_next is not None and 'next' in self.links:
+                self.on_next(self.links['next'])
+            yield record
+            break
+        for record in records:
+            yield record
+
+    def next_url(self):
+        """Returns the url of the next page, or None on the last page"""
+        if not self._read:
+            if self.from_cache:
+                with open(self.body_path, 'rb') as body_file:
+                    return next_page_url(body_file.read(self.chunk_size))
+            # The meta block has to be read, so read everything
+            for _ in self.records(None):
+                pass
+        return self.links.get('next')
+
+    def close(self):
+        """Releases the connection, and drops a body that was cut short"""
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+        if self.response is not None:
+            self.response.close()
+
+
+def next_page_url(content, chunk_size=65536):
+    """
+    This function finds the "next" link in the meta block of a GOCDBPI page.
+
+    Params
+    ------
+    content: bytes
+             The raw XML of a GOCDBPI page
+    chunk_size: int
+                How many bytes to parse at a time
+    Returns
+    -------
+    url: string
+         The url of the next page, or None if this is the last page
+
+    Notes
+    -----
+    The meta block comes first in the document, so parsing stops as soon
+    as it has been read rather than going through the whole page.
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    depth = 0
+    for offset in range(0, len(content), chunk_size):
+        parser.feed(content[offset:offset + chunk_size])
+        for event, element in parser.read_events():
+            if event == 'start':
+                depth += 1
+                if depth == 2 and element.tag != 'meta':
+                    return None
+            else:
+                depth -= 1
+                if element.tag == 'link' and element.get('rel') == 'next':
+                    return element.get('href')
+                if element.tag == 'meta':
+                    return None
+    return None
+
+
+class RunStats(object):
+    """
+    This class records where the time of a single collection goes.
+
+    Each fetch, parse, aggregate, read or write step runs inside "phase",
+    which adds up its calls, wall time, bytes and element counts by name.
+    Phases may run in several threads at once. The totals, with the peak
+    RSS of the process, are reported by "to_dict" for indexing next to
+    the metrics, or by "write_prometheus" for node_exporter's textfile
+    collector. The peak RSS is that of the whole process, so in the
+    daemon it is the highest of all runs so far, not of this one.
+    """
+    def __init__(self, collector):
+        self.collector = collector
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the block it wraps as one call of the phase "name".
+
+        The block is given a dictionary in which it can set the "bytes"
+        and "elements" it handled.
+        """
+        record = {'bytes': 0, 'elements': 0}
+        started = time.time()
+        try:
+            yield record
+        finally:
+            seconds = time.time() - started
+            with self._lock:
+                phase = self.phases.setdefault(
+                    name, {'calls': 0, 'seconds': 0.0, 'bytes': 0,
+                           'elements': 0})
+                phase['calls'] += 1
+                phase['seconds'] += seconds
+                phase['bytes'] += record['bytes']
+                phase['elements'] += record['elements']
+
+    def to_dict(self):
+        """Returns the totals as the "_collector_stats" sub-document"""
+        with self._lock:
+            phases = [dict(phase, name=name)
+                      for name, phase in self.phases.items()]
+        return {
+            'collector': self.collector,
+            'seconds': time.time() - self.started,
+            'process_peak_rss_bytes': peak_rss(),
+            'phases': phases,
+        }
+
+    def write_prometheus(self, path):
+        """
+        Writes the totals to "path" in the Prometheus text format.
+
+        The file is written next to "path" and then renamed over it, so
+        the textfile collector never reads half a file.
+        """
+        stats = self.to_dict()
+        collector = 'collector="%s"' % self.collector
+        lines = []
+
+        def gauge(name, help_text, samples):
+            lines.append('# HELP gridtools_%s %s' % (name, help_text))
+            lines.append('# TYPE gridtools_%s gauge' % name)
+            for labels, value in samples:
+                lines.append('gridtools_%s{%s} %s' % (name, labels,
+                                                      repr(value)))
+
+        gauge('collector_last_run_timestamp_seconds',
+              'When the last collection started.',
+              [(collector, self.started)])
+        gauge('collector_seconds', 'Wall time of the last collection.',
+              [(collector, stats['seconds'])])
+        if stats['process_peak_rss_bytes'] is not None:
+            gauge('collector_process_peak_rss_bytes',
+                  'Peak resident memory of the collecting process since '
+                  'it started, across runs.',
+                  [(collector, stats['process_peak_rss_bytes'])])
+        for field, help_text in (
+                ('calls', 'Steps run in each phase of the last collection.'),
+                ('seconds', 'Wall time of each phase of the last collection.'),
+                ('bytes', 'Bytes handled by each phase of the last '
+                          'collection.'),
+                ('elements', 'Elements handled by each phase of the last '
+                             'collection.')):
+            gauge('collector_phase_' + field, help_text, [
+                ('%s,phase="%s"' % (collector, phase['name']), phase[field])
+                for phase in stats['phases']])
 
-        # sets the a file handler
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as prometheus_file:
+            prometheus_file.write('\n'.join(lines) + '\n')
+        os.replace(temporary_path, path)
 
-        handler = logging.FileHandler(self.LogName)
+
+@contextmanager
+def run_phase(stats, name):
+    """Runs "stats.phase(name)", or nothing when "stats" is None"""
+    if stats is None:
+        yield {'bytes': 0, 'elements': 0}
+    else:
+        with stats.phase(name) as record:
+            yield record
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory of this process in bytes, if known.
+
+    This is the peak since the process started, not since a run did.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+class SnapshotStore(object):
+    """
+    This class keeps the entity sets of a collector's last run on disk.
+
+    Each set, such as the sites running an endpoint type or the countries
+    using GOCDB, is stored sorted along with a hash of its content. The
+    next run "record"s its own sets and "apply"s them to its metrics: what
+    was added to and removed from each set is listed under "changes", and
+    in delta mode the full lists are left out of the document unless a
+    full one is due, so an unchanged run only indexes its counters. A
+    full document is due every "full_interval" seconds, and whenever a
+    set has no previous snapshot to be compared against.
+    """
+    def __init__(self, path, full_interval=24 * 3600):
+        self.path = path
+        self.full_interval = full_interval
+        self.recorded = {}
+        self.full = False
+        try:
+            with open(path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (IOError, ValueError):
+            snapshot = {}
+        self.last_full = snapshot.get('last_full')
+        self.sets = snapshot.get('sets', {})
+
+    @staticmethod
+    def content_hash(members):
+        """Returns the hash of a sorted set of members"""
+        digest = hashlib.sha1()
+        for member in members:
+            digest.update(member.encode('utf-8') + b'\n')
+        return digest.hexdigest()
+
+    def record(self, name, members, field=None, counts_only=False):
+        """
+        Records this run's members of the set "name".
+
+        "field" is the metrics key the full list is held under, if any.
+        With "counts_only", only the number of members added and removed
+        is indexed, for sets such as users that should stay private. Sets
+        that are not recorded, as their fetch failed, keep their previous
+        snapshot.
+        """
+        members = sorted(set(member for member in members
+                             if member is not None))
+        self.recorded[name] = {'members': members,
+                               'hash': self.content_hash(members),
+                               'field': field, 'counts_only': counts_only}
+
+    def diff(self, name):
+        """Returns the members added to and removed from a recorded set"""
+        members = self.recorded[name]['members']
+        previous = self.sets.get(name)
+        if previous is None:
+            return members, []
+        if previous['hash'] == self.recorded[name]['hash']:
+            return [], []
+        old = set(previous['members'])
+        new = set(members)
+        return sorted(new - old), sorted(old - new)
+
+    def full_due(self, now=None):
+        """Returns True if the next document should hold the full lists"""
+        if now is None:
+            now = time.time()
+        if self.last_full is None or \
+                now - self.last_full >= self.full_interval:
+            return True
+        return any(name not in self.sets for name in self.recorded)
+
+    def apply(self, metrics_dict, delta_only=False, now=None):
+        """
+        Adds the changes since the last run to a metrics document.
+
+        Params
+        ------
+        metrics_dict: dict
+                      The document being built, holding the full lists
+        delta_only: bool
+                    If True, the full lists are removed unless a full
+                    document is due
+        Returns
+        -------
+        True if the document is a full one, False if it is a delta.
+        """
+        full = not delta_only or self.full_due(now)
+        changes = []
+        for name in sorted(self.recorded):
+            recorded = self.recorded[name]
+            added, removed = self.diff(name)
+            if added or removed:
+                change = {'set': name, 'added_count': len(added),
+                          'removed_count': len(removed)}
+                if not recorded['counts_only']:
+                    change.update(added=added, removed=removed)
+                changes.append(change)
+            if not full and recorded['field'] is not None:
+                metrics_dict.pop(recorded['field'], None)
+        if changes:
+            metrics_dict['changes'] = changes
+        metrics_dict['document'] = 'full' if full else 'delta'
+        self.full = full
+        return full
+
+    def save(self, now=None):
+        """Stores the recorded sets as the snapshot for the next run"""
+        if now is None:
+            now = time.time()
+        for name, recorded in self.recorded.items():
+            self.sets[name] = {'hash': recorded['hash'],
+                               'members': recorded['members']}
+        if self.full:
+            self.last_full = now
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        temporary_path = self.path + '.%d.tmp' % os.getpid()
+        handle = os.open(temporary_path,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(handle, 'w') as snapshot_file:
+            json.dump({'last_full': self.last_full, 'sets': self.sets},
+                      snapshot_file, separators=(',', ':'))
+        os.replace(temporary_path, self.path)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    This class stops a repeated log message from flooding the log.
+
+    At most "burst" records with the same logger, level and message
+    template are let through in each "interval" seconds. The number held
+    back is added to the next record of that kind that gets through.
+    """
+    def __init__(self, burst=10, interval=60):
+        super(RateLimitFilter, self).__init__()
+        self.burst = burst
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._windows = {}
+
+    def filter(self, record):
+        """Returns whether a record may be logged"""
+        key = (record.name, record.levelno, record.msg)
+        now = time.time()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = '%s (%d similar messages suppressed)' % (
+                        record.msg, suppressed)
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+# One queue handler and listener per log file, shared by every logger
+# that writes to it
+_log_lock = threading.Lock()
+_log_queues = {}
+
+
+def _stop_log_listeners():
+    """Writes out every queued log record, at exit"""
+    with _log_lock:
+        for _, listener in _log_queues.values():
+            listener.stop()
+        _log_queues.clear()
+
+
+atexit.register(_stop_log_listeners)
+
+
+class ModLogger(object):
+    """
+    This class is used to modify the logger.
+
+    Records are put on a queue by the logging thread and written to a
+    rotating log file by a background listener, so logging never waits
+    on the disk. The file rotates once it reaches "max_bytes", or every
+    "when" (such as "midnight") if given, keeping "backup_count" old
+    files. Setting up the same file again only adds its handler to any
+    logger that lacks it, so a long-lived process can call "logger_mod"
+    on every run.
+    """
+    def __init__(self, LogName, name=None, max_bytes=10 * 2**20,
+                 backup_count=5, when=None):
+        self.LogName = LogName
+        self.name = name
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.when = when
+
+    def _file_handler(self):
+        """Returns the rotating file handler the listener writes with"""
+        if self.when:
+            handler = logging.handlers.TimedRotatingFileHandler(
+                self.LogName, when=self.when, backupCount=self.backup_count)
+        else:
+            handler = logging.handlers.RotatingFileHandler(
+                self.LogName, maxBytes=self.max_bytes,
+                backupCount=self.backup_count)
         handler.setLevel(logging.INFO)
 
         # create a logging format
@@ -52,52 +1548,581 @@ class ModLogger(object):
             logging.Formatter('%(asctime)s - %(name)s - %(levelname)s\
                               - %(message)s')
         handler.setFormatter(formatter)
+        return handler
+
+    def logger_mod(self):
+        """Sets up the logger, and the named logger if there is one"""
+        path = os.path.abspath(self.LogName)
+        with _log_lock:
+            first_setup = path not in _log_queues
+            if first_setup:
+                queue_handler = logging.handlers.QueueHandler(
+                    queue.SimpleQueue())
+                queue_handler.addFilter(RateLimitFilter())
+                listener = logging.handlers.QueueListener(
+                    queue_handler.queue, self._file_handler(),
+                    respect_handler_level=True)
+                listener.start()
+                _log_queues[path] = (queue_handler, listener)
+            queue_handler = _log_queues[path][0]
+
+        loggers = [logger]
+        if self.name is not None:
+            loggers.append(logging.getLogger(self.name))
+        for named_logger in loggers:
+            named_logger.setLevel(logging.INFO)
+            if queue_handler not in named_logger.handlers:
+                named_logger.addHandler(queue_handler)
+        if first_setup:
+            logger.info('Hello world')
+
+
+ES_SETTINGS = {
+    'hosts': [
+        {'host': 'elasticsearch1.gridpp.rl.ac.uk', 'port': 9200},
+        {'host': 'elasticsearch5.gridpp.rl.ac.uk', 'port': 9200},
+        {'host': 'elasticsearch6.gridpp.rl.ac.uk', 'port': 9200},
+        {'host': 'elasticsearch7.gridpp.rl.ac.uk', 'port': 9200},
+        {'host': 'elasticsearch8.gridpp.rl.ac.uk', 'port': 9200},
+    ],
+    'use_ssl': True,
+    'verify_certs': False,
+    'maxsize': 4,
+    'timeout': 30,
+    'http_compress': False,
+}
+
+_elastic_lock = threading.Lock()
+_elastic_client = None
+
+
+def configure_elastic(**settings):
+    """
+    This function changes the settings of the shared Elasticsearch client.
+
+    Params
+    ------
+    settings: keyword arguments
+              Any of the keys of ES_SETTINGS, such as hosts, maxsize (the
+              connection pool size per host), timeout or http_compress
+
+    Notes
+    -----
+    If the settings change, the current client is dropped so the next
+    call to "get_elastic" builds one with the new settings.
+    """
+    global _elastic_client
+    with _elastic_lock:
+        changed = any(ES_SETTINGS.get(key) != value
+                      for key, value in settings.items())
+        ES_SETTINGS.update(settings)
+        if changed:
+            _elastic_client = None
+
+
+def parse_es_hosts(hosts):
+    """
+    This function turns a comma separated list of urls into ES hosts.
+
+    Params
+    ------
+    hosts: string
+           Such as "https://es1.example.org:9200,http://localhost:9200"
+    Returns
+    -------
+    hosts: list
+           Host dictionaries for "configure_elastic", each using SSL only
+           if its url is https
+    """
+    parsed = []
+    for host in hosts.split(','):
+        url = urlparse(host.strip())
+        parsed.append({
+            'host': url.hostname,
+            'port': url.port or 9200,
+            'use_ssl': url.scheme == 'https',
+        })
+    return parsed
+
+
+def get_elastic():
+    """
+    This function returns the process-wide Elasticsearch client.
+
+    The client is built from ES_SETTINGS on first use and then shared by
+    every reader and writer, so its connection pools are set up only once.
+    """
+    global _elastic_client
+    with _elastic_lock:
+        if _elastic_client is None:
+            settings = dict(ES_SETTINGS)
+            hosts = settings.pop('hosts')
+            _elastic_client = Elasticsearch(hosts, **settings)
+        return _elastic_client
+
+
+def elastic_stats():
+    """
+    This function reports how well the shared client reuses its connections.
+
+    Returns
+    -------
+    stats: dict
+           For each host, the number of connections opened, the number of
+           requests sent and how many of those reused an open connection
+    """
+    stats = {}
+    with _elastic_lock:
+        if _elastic_client is None:
+            return stats
+        connections = _elastic_client.transport.connection_pool.connections
+    for connection in connections:
+        pool = getattr(connection, 'pool', None)
+        if pool is None:
+            continue
+        stats[connection.host] = {
+            'connections': pool.num_connections,
+            'requests': pool.num_requests,
+            'reused': max(pool.num_requests - pool.num_connections, 0),
+        }
+    return stats
+
+
+SPOOL_PATH = os.path.expanduser('~/.cache/grid-tools-metrics/es-spool.ndjson')
+
+# Held with the spool's file lock, which does not exclude other threads of
+# this process where fcntl is missing
+_spool_lock = threading.Lock()
+
+
+def metrics_index(dictionary):
+    """Returns the daily metrics index for a metrics dictionary"""
+    timestamp = dictionary.get('@timestamp')
+    if timestamp:
+        date = timestamp[:10].replace('-', '.')
+    else:
+        date = datetime.strftime(datetime.now(), '%Y.%m.%d')
+    return "logstash-gridtools-metrics-%s" % date
+
+
+class BulkSink(object):
+    """
+    This class writes metrics documents to Elasticsearch through _bulk.
+
+    Documents are buffered and sent once "max_docs" documents or
+    "max_bytes" bytes are waiting, or when "flush" is called. A batch
+    that cannot be indexed is appended to a local spool file, in _bulk
+    format, and "replay" sends it again on a later run. Every document
+    gets an id derived from its index and content, so replaying a batch
+    that partly reached the cluster overwrites rather than duplicates.
+    """
+    def __init__(self, spool_path=SPOOL_PATH, max_docs=500,
+                 max_bytes=5 * 2**20, elastic=None):
+        self.spool_path = spool_path
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.elastic = elastic
+        self.lines = []
+        self.size = 0
+        self._lock_file = None
+
+    @staticmethod
+    def document_id(index, source):
+        """Returns the deterministic id of a serialised document"""
+        return hashlib.sha1((index + source).encode('utf-8')).hexdigest()
+
+    def add(self, dictionary, index=None):
+        """
+        Buffers a metrics dictionary, flushing if a threshold is reached.
 
-        # add the handlers to the logger
+        Returns the number of documents indexed by that flush, if any.
+        """
+        if index is None:
+            index = metrics_index(dictionary)
+        source = json.dumps(dictionary, sort_keys=True)
+        action = json.dumps({'index': {
+            '_index': index,
+            '_type': 'doc',
+            '_id': self.document_id(index, source),
+        }})
+        return self._add_lines(action, source)
 
-        logger.addHandler(handler)
-        logger.info('Hello world')
+    def _add_lines(self, action, source):
+        """Buffers an action and source line pair"""
+        self.lines.append((action, source))
+        self.size = self.size + len(action) + len(source) + 2
+        if len(self.lines) >= self.max_docs or self.size >= self.max_bytes:
+            return self.flush()
+        return 0
+
+    def flush(self):
+        """
+        This function sends the buffered documents in one _bulk request.
+
+        Returns
+        -------
+        indexed: int
+                 The number of documents the cluster accepted. The others
+                 are written to the spool file.
+        """
+        lines, self.lines, self.size = self.lines, [], 0
+        if not lines:
+            return 0
+        body = ''.join(action + '\n' + source + '\n'
+                       for action, source in lines)
+        elastic = self.elastic if self.elastic is not None else get_elastic()
+        try:
+            result = elastic.bulk(body=body)
+        except ElasticsearchException as error:
+            logger.error('Bulk request of %d documents failed, spooling: %s',
+                         len(lines), error)
+            self._spool(lines)
+            return 0
+
+        failed = []
+        for pair, item in zip(lines, result.get('items', [])):
+            status = item.get('index', {}).get('status', 500)
+            if status >= 300:
+                failed.append(pair)
+        if failed:
+            logger.error('%d of %d documents were not indexed, spooling',
+                         len(failed), len(lines))
+            self._spool(failed)
+        return len(lines) - len(failed)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Holds the spool to this sink, against other threads and processes.
+
+        The daemon writes the APEL and GOCDB metrics at the same time, to
+        the same spool. The lock is taken once per sink, so "replay" can
+        spool what fails again while it holds it.
+        """
+        if self._lock_file is not None:
+            yield
+            return
+        directory = os.path.dirname(self.spool_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with _spool_lock, open(self.spool_path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._lock_file = lock_file
+            try:
+                yield
+            finally:
+                self._lock_file = None
+
+    def _spool(self, lines):
+        """Appends action and source line pairs to the spool file"""
+        if self.spool_path is None:
+            return
+        with self._locked(), open(self.spool_path, 'a') as spool_file:
+            for action, source in lines:
+                spool_file.write(action + '\n' + source + '\n')
+
+    def _read_pairs(self, path):
+        """
+        Returns the action and source line pairs of a spool file.
+
+        A line that is not part of a whole pair, as left by a run killed
+        while spooling, is moved to a ".torn" file next to the spool
+        rather than sent, so it cannot stop later replays.
+        """
+        pairs = []
+        torn = []
+        action = None
+        with open(path) as spool_file:
+            for line in spool_file:
+                line = line.rstrip('\n')
+                try:
+                    parsed = json.loads(line)
+                except ValueError:
+                    parsed = None
+                is_action = isinstance(parsed, dict) and \
+                    list(parsed) == ['index']
+                if action is not None and isinstance(parsed, dict) and \
+                        not is_action:
+                    pairs.append((action, line))
+                    action = None
+                    continue
+                if action is not None:
+                    torn.append(action)
+                action = None
+                if is_action:
+                    action = line
+                else:
+                    torn.append(line)
+        if action is not None:
+            torn.append(action)
+        if torn:
+            logger.error('%d incomplete lines of the spool were moved to '
+                         '%s.torn', len(torn), self.spool_path)
+            with open(self.spool_path + '.torn', 'a') as torn_file:
+                torn_file.write(''.join(line + '\n' for line in torn))
+        return pairs
+
+    def replay(self):
+        """
+        This function sends the documents left in the spool by earlier runs.
+
+        The spooled documents are sent along with anything already
+        buffered.
+
+        Returns
+        -------
+        indexed: int
+                 The number of documents the cluster accepted
+        """
+        if self.spool_path is None:
+            return 0
+        replay_path = self.spool_path + '.replay'
+        with self._locked():
+            if not (os.path.exists(self.spool_path) or
+                    os.path.exists(replay_path)):
+                return self.flush()
+            # Move the spool aside first, so anything failing again is
+            # appended to a fresh spool rather than the one being read. A
+            # replay file left by an interrupted run is replayed as well.
+            if os.path.exists(self.spool_path):
+                with open(self.spool_path) as spool_file, \
+                        open(replay_path, 'a') as replay_file:
+                    replay_file.write(spool_file.read())
+                os.remove(self.spool_path)
+
+            indexed = 0
+            for action, source in self._read_pairs(replay_path):
+                self.lines.append((action, source))
+                self.size = self.size + len(action) + len(source) + 2
+                if len(self.lines) >= self.max_docs or \
+                        self.size >= self.max_bytes:
+                    indexed = indexed + self.flush()
+            indexed = indexed + self.flush()
+            os.remove(replay_path)
+        return indexed
 
 
 class ESWrite(object):
     """This class writes to elastic search"""
-    def __init__(self, dictionary):
+    def __init__(self, dictionary, spool_path=SPOOL_PATH):
         self.dictionary = dictionary
-        self.elastic = Elasticsearch(
-            [
-                {
-                    'host': 'elasticsearch1.gridpp.rl.ac.uk',
-                    'port': 9200,
-                },
-                {
-                    'host': 'elasticsearch5.gridpp.rl.ac.uk',
-                    'port': 9200,
-                },
-                {
-                    'host': 'elasticsearch6.gridpp.rl.ac.uk',
-                    'port': 9200,
-                },
-                {
-                    'host': 'elasticsearch7.gridpp.rl.ac.uk',
-                    'port': 9200,
-                },
-                {
-                    'host': 'elasticsearch8.gridpp.rl.ac.uk',
-                    'port': 9200,
-                },
-            ],
-            use_ssl=True,
-            verify_certs=False,
-        )
+        self.spool_path = spool_path
+        self.elastic = get_elastic()
 
     def write(self):
-        """This function writes the data to elastic search"""
-        data = json.dumps(self.dictionary)
+        """
+        This function writes the data to elastic search.
 
-        date = datetime.strftime(datetime.now(), '%Y.%m.%d')
+        The document is sent, or spooled, first. Documents spooled by
+        earlier runs that could not reach the cluster are then sent if it
+        was indexed.
+        """
+        sink = BulkSink(spool_path=self.spool_path, elastic=self.elastic)
+        sink.add(self.dictionary)
+        indexed = sink.flush()
+        if indexed:
+            indexed = indexed + sink.replay()
+        return indexed
+
+
+ARCHIVE_DIR = os.path.expanduser('~/.local/share/grid-tools-metrics/archive')
+CACHE_DIR = os.path.expanduser('~/.cache/grid-tools-metrics')
+
+
+def add_collector_options(parser, snapshot_name):
+    """
+    This function adds the options both collectors share to a parser.
+
+    Params
+    ------
+    parser: OptionParser
+            The parser of a collector's own options
+    snapshot_name: string
+                   The file name of the collector's snapshot, such as
+                   apel-snapshot.json
+    Returns
+    -------
+    parser: OptionParser
+            The parser passed in
+    """
+    parser.add_option("-p", "--parser", dest="parser",
+                      default="stream",
+                      help=("The XML parser to use: stream (parsed while "
+                            "it downloads), iterparse (streaming, once "
+                            "downloaded), parallel (iterparse, sharded "
+                            "across processes) or minidom."))
+    parser.add_option("--parse-workers", dest="parse_workers",
+                      default="0",
+                      help=("With the parallel parser, how many processes "
+                            "to parse a reply with, 0 for one per core."))
+    parser.add_option("--parallel-threshold", dest="parallel_threshold",
+                      default="8",
+                      help=("With the parallel parser, the size in MB "
+                            "below which a reply is parsed in a single "
+                            "process."))
+    parser.add_option("--gocdb-url", dest="gocdb_url",
+                      default=GOCDB_URL,
+                      help="The base url of GOCDBPI.")
+    parser.add_option("--es-hosts", dest="es_hosts",
+                      default=None,
+                      help=("Comma separated ElasticSearch urls to use "
+                            "instead of the gridpp cluster."))
+    parser.add_option("--connect-timeout", dest="connect_timeout",
+                      default="10",
+                      help="Seconds to wait for a connection to GOCDB.")
+    parser.add_option("--read-timeout", dest="read_timeout",
+                      default="60",
+                      help="Seconds to wait for GOCDB to send data.")
+    parser.add_option("--retries", dest="retries",
+                      default="3",
+                      help=("How many times to retry a GOCDB request that "
+                            "failed or timed out."))
+    parser.add_option("--deadline", dest="deadline",
+                      default="1800",
+                      help=("Seconds a run may spend fetching from GOCDB, "
+                            "0 for no limit. Metrics not fetched by then "
+                            "are listed in missing_metrics."))
+    parser.add_option("--collector-stats", dest="collector_stats",
+                      default="False",
+                      help=("Wether to add the timings of this run to the "
+                            "metrics, as _collector_stats. They are taken "
+                            "before the metrics are written, so they hold "
+                            "the write and archive time of the previous "
+                            "run instead, as previous_write, and the peak "
+                            "RSS of the process since it started, which "
+                            "in the daemon covers every run so far."))
+    parser.add_option("--prometheus-file", dest="prometheus_file",
+                      default=None,
+                      help=("Where to write the timings of this run for the "
+                            "Prometheus textfile collector."))
+    parser.add_option("--output-mode", dest="output_mode",
+                      default="full",
+                      help=("full (every list, every run) or delta (only "
+                            "the counters and what was added or removed, "
+                            "with a full document every --full-interval)."))
+    parser.add_option("--full-interval", dest="full_interval",
+                      default="24",
+                      help=("In delta output mode, the hours between two "
+                            "full documents."))
+    parser.add_option("--snapshot-file", dest="snapshot_file",
+                      default=None,
+                      help=("Where to keep the lists of the last run, "
+                            "%s in --cache-dir by default." %
+                            snapshot_name))
+    parser.add_option("--archive-dir", dest="archive_dir",
+                      default=ARCHIVE_DIR,
+                      help=("Where to archive every document written, for "
+                            "metrics_archive.py. Empty to not archive."))
+    parser.add_option("--spool-file", dest="spool_file",
+                      default=None,
+                      help=("Where to keep documents ElasticSearch did not "
+                            "accept until the next run, es-spool.ndjson in "
+                            "--cache-dir by default."))
+    parser.add_option("--no-cache", dest="no_cache", action="store_true",
+                      default=False,
+                      help="Do not cache GOCDB replies between runs.")
+    parser.add_option("--cache-dir", dest="cache_dir",
+                      default=CACHE_DIR,
+                      help="Where to cache GOCDB replies between runs.")
+    return parser
+
+
+def spool_path(options):
+    """Returns the spool file of a collector's options"""
+    return options.spool_file or \
+        os.path.join(options.cache_dir, 'es-spool.ndjson')
+
+
+def configure_collector(options):
+    """Applies a collector's ElasticSearch and parser options"""
+    if options.es_hosts:
+        configure_elastic(hosts=parse_es_hosts(options.es_hosts))
+    if options.parser == "parallel":
+        configure_parallel(
+            workers=int(options.parse_workers) or None,
+            threshold=float(options.parallel_threshold) * 2**20)
+
+
+class CollectorRun(object):
+    """
+    This class sets up and finishes a single run of a collector.
+
+    Creating it applies the options shared by both collectors, starts
+    the run's "RunStats", loads its "SnapshotStore", starts the client's
+    deadline and trims its cache, which a daemon reuses between runs.
+    "finish" then writes, archives or prints the metrics document, and
+    records in the cache how long writing and archiving it took.
+    """
+    def __init__(self, name, options, client, log):
+        self.name = name
+        self.options = options
+        self.log = log
+        self.cache = client.cache
+        configure_collector(options)
+        self.stats = RunStats(name)
+        self.snapshot = SnapshotStore(
+            options.snapshot_file or
+            os.path.join(options.cache_dir, name + '-snapshot.json'),
+            full_interval=float(options.full_interval) * 3600)
+        client.set_deadline(float(options.deadline))
+        if client.cache is not None:
+            client.cache.evict()
+
+    def finish(self, metrics_dict, missing_metrics):
+        """
+        This function writes the metrics document of the run.
+
+        Params
+        ------
+        metrics_dict: dict
+                      The metrics document
+        missing_metrics: list
+                         Metrics that could not be collected in time. They
+                         are listed in the document, so a gap in a graph
+                         can be told apart from a real zero.
+        """
+        # metrics_archive imports this module, so it cannot be imported
+        # at the top of it
+        from metrics_archive import MetricsArchive
+
+        options = self.options
+        stats = self.stats
+        if missing_metrics:
+            metrics_dict['missing_metrics'] = missing_metrics
+        if options.collector_stats == "True":
+            collector_stats = stats.to_dict()
+            # This run's write is not done yet, so the previous one's is
+            # the latest there is
+            previous_write = None
+            if self.cache is not None:
+                previous_write = self.cache.load_timing(
+                    self.name + '-write')
+            if previous_write is not None:
+                collector_stats['previous_write'] = previous_write
+            metrics_dict['_collector_stats'] = collector_stats
+
+        self.snapshot.apply(metrics_dict, options.output_mode == "delta")
+
+        if options.write == "True":
+            with stats.phase('write') as record:
+                record['elements'] = ESWrite(
+                    metrics_dict, spool_path(options)).write()
+            if options.archive_dir:
+                with stats.phase('archive'):
+                    MetricsArchive(options.archive_dir).append(metrics_dict)
+            # Only what was indexed becomes the base of the next delta
+            self.snapshot.save()
+            if self.cache is not None:
+                self.cache.store_timing(self.name + '-write', sum(
+                    stats.phases[name]['seconds']
+                    for name in ('write', 'archive') if name in stats.phases))
+            self.log.info('ElasticSearch updated')
+        else:
+            # This can be used for testing
+            print(metrics_dict)
 
-        self.elastic.index(
-            index="logstash-gridtools-metrics-%s" % date,
-            doc_type='doc',
-            body=data,
-        )
+        if options.prometheus_file:
+            stats.write_prometheus(options.prometheus_file)
+        self.log.info('Elasticsearch connection use: ' +
+                      json.dumps(elastic_stats()))
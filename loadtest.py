@@ -0,0 +1,494 @@
+"""This script runs the collectors end to end against local stand-ins"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+from urllib.parse import parse_qs, urlencode, urlparse
+from xml.sax.saxutils import escape
+from xml.etree import ElementTree
+import benchmark_parsers
+import metrics_apel
+import metrics_gocdb
+
+
+class FakeGOCDB(object):
+    """
+    This class serves GOCDBPI replies from memory on a local port.
+
+    Each method's reply is either generated with "benchmark_parsers" or
+    loaded from "<method>.xml" in a directory of recorded replies. The
+    server can page replies, adding the meta block and next links GOCDBPI
+    uses, answer get_service_endpoint's service_type filter, add latency
+    to every request, fail a share of them, and revalidate ETags. Every
+    request is counted by method and outcome.
+    """
+    def __init__(self, replies, page_size=0, latency=0.0, failure_rate=0.0,
+                 failure='error', seed=0):
+        self.records = {}
+        for method, reply in replies.items():
+            self.records[method] = [
+                ElementTree.tostring(record)
+                for record in ElementTree.fromstring(reply)
+            ]
+        self.page_size = page_size
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure = failure
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        """The base url to pass to the collectors as --gocdb-url"""
+        return 'http://127.0.0.1:%d/gocdbpi/' % self.server.server_port
+
+    def count(self, method, outcome, sent=0):
+        """Records one request"""
+        with self.lock:
+            stats = self.stats.setdefault(method, {'bytes': 0})
+            stats[outcome] = stats.get(outcome, 0) + 1
+            stats['bytes'] += sent
+
+    def reply(self, path):
+        """Returns the method and reply body for a request path"""
+        url = urlparse(path)
+        query = dict((key, values[0])
+                     for key, values in parse_qs(url.query).items())
+        method = query.get('method')
+        records = self.records.get(method)
+        if records is None:
+            return method, None
+        service_type = query.get('service_type')
+        if service_type:
+            marker = ('<SERVICE_TYPE>%s</SERVICE_TYPE>' %
+                      service_type).encode('utf-8')
+            records = [record for record in records if marker in record]
+
+        meta = b''
+        if self.page_size:
+            page = int(query.get('page', 1))
+            pages = max((len(records) + self.page_size - 1) //
+                        self.page_size, 1)
+            records = records[(page - 1) * self.page_size:
+                              page * self.page_size]
+            links = []
+            if page < pages:
+                query['page'] = str(page + 1)
+                links.append('<link rel="next" href="%s%s/?%s"/>' % (
+                    self.url, url.path.strip('/').split('/')[-1],
+                    escape(urlencode(query))))
+            meta = ('<meta>%s<count>%d</count><max_page_size>%d'
+                    '</max_page_size></meta>' % (''.join(links),
+                                                 len(records),
+                                                 self.page_size)
+                    ).encode('utf-8')
+        return method, b'<results>' + meta + b''.join(records) + \
+            b'</results>'
+
+    def _handler_class(self):
+        """Returns the request handler class bound to this server"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """This class answers GOCDBPI requests"""
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                method, body = fake.reply(self.path)
+                if body is None:
+                    fake.count(method, 'unknown')
+                    self.send_error(404)
+                    return
+                if fake.random.random() < fake.failure_rate:
+                    fake.count(method, 'failed')
+                    if fake.failure == 'stall':
+                        time.sleep(3600)
+                    elif fake.failure == 'reset':
+                        self.close_connection = True
+                        return
+                    self.send_error(503)
+                    return
+
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    fake.count(method, 'not_modified')
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                fake.count(method, 'ok', len(body))
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """Starts serving in a background thread"""
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving"""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeElasticsearch(object):
+    """
+    This class stands in for an Elasticsearch cluster on a local port.
+
+    Index, _bulk, _search and _msearch calls are recorded and answered
+    with plausible replies. Searches for the records loaded aggregation
+    are answered from "records", a dictionary of totals per APEL type.
+    """
+    def __init__(self, records=None, latency=0.0):
+        self.records = records or {}
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = []
+        self.documents = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        """The url to pass to the collectors as --es-hosts"""
+        return 'http://127.0.0.1:%d' % self.server.server_port
+
+    def search(self, body):
+        """Returns the reply to a search body"""
+        aggs = body.get('aggs', {})
+        buckets = [{'key': key, 'doc_count': 1,
+                    'total_number_loaded': {'value': value}}
+                   for key, value in self.records.items()]
+        if 'apel_types' in aggs:
+            return {'hits': {'total': 0, 'hits': []},
+                    'aggregations': {'apel_types': {'buckets': buckets}}}
+        if 'days' in aggs:
+            bounds = aggs['days']['date_histogram']['extended_bounds']
+            day = time.strptime(bounds['min'], '%Y-%m-%d')
+            last = time.strptime(bounds['max'], '%Y-%m-%d')
+            days = []
+            stamp = time.mktime(day)
+            while stamp <= time.mktime(last):
+                days.append({
+                    'key_as_string': time.strftime('%Y-%m-%d',
+                                                   time.localtime(stamp)),
+                    'apel_types': {'buckets': buckets},
+                })
+                stamp += 86400
+            return {'hits': {'total': 0, 'hits': []},
+                    'aggregations': {'days': {'buckets': days}}}
+        value = sum(self.records.values())
+        return {'hits': {'total': 0, 'hits': []},
+                'aggregations': {'total_number_loaded': {'value': value}}}
+
+    def _handler_class(self):
+        """Returns the request handler class bound to this server"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """This class answers Elasticsearch requests"""
+            protocol_version = 'HTTP/1.1'
+
+            def _reply(self, status, reply):
+                body = json.dumps(reply).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8')
+                path = urlparse(self.path).path
+                with fake.lock:
+                    fake.calls.append((self.command, path, len(body)))
+
+                if path.endswith('/_bulk'):
+                    lines = [json.loads(line)
+                             for line in body.splitlines() if line]
+                    with fake.lock:
+                        fake.documents.extend(lines[1::2])
+                    self._reply(200, {'took': 1, 'errors': False, 'items': [
+                        {'index': {'_id': action['index'].get('_id'),
+                                   'status': 201}}
+                        for action in lines[0::2]]})
+                elif path.endswith('/_msearch'):
+                    queries = [json.loads(line)
+                               for line in body.splitlines() if line]
+                    self._reply(200, {'responses': [
+                        fake.search(query) for query in queries[1::2]]})
+                elif path.endswith('/_search'):
+                    self._reply(200, fake.search(json.loads(body or '{}')))
+                elif self.command in ('PUT', 'POST') and body:
+                    with fake.lock:
+                        fake.documents.append(json.loads(body))
+                    self._reply(201, {'result': 'created'})
+                else:
+                    self._reply(200, {'version': {'number': '6.8.0'}})
+
+            do_GET = do_PUT = do_POST = _handle
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """Starts serving in a background thread"""
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def calls_by_kind(self):
+        """Returns the number of calls of each kind"""
+        kinds = {}
+        for command, path, _ in self.calls:
+            kind = path.rsplit('/', 1)[-1] if '/_' in path else command
+            kinds[kind] = kinds.get(kind, 0) + 1
+        return kinds
+
+
+def generate_replies(endpoints, sites, users):
+    """Returns generated replies for every method the collectors call"""
+    return {
+        'get_service_endpoint':
+            benchmark_parsers.generate_service_endpoints(endpoints),
+        'get_site_list': benchmark_parsers.generate_sites(sites),
+        'get_site_count_per_country':
+            benchmark_parsers.generate_site_counts(sites),
+        'get_user': benchmark_parsers.generate_users(users),
+    }
+
+
+def load_replies(directory):
+    """Returns the recorded replies, one "<method>.xml" file per method"""
+    replies = {}
+    for name in os.listdir(directory):
+        if name.endswith('.xml'):
+            with open(os.path.join(directory, name), 'rb') as reply_file:
+                replies[name[:-len('.xml')]] = reply_file.read()
+    return replies
+
+
+def read_prometheus(path, name):
+    """Returns the samples of the metric "name" in a Prometheus textfile"""
+    samples = {}
+    with open(path) as prometheus_file:
+        for line in prometheus_file:
+            if not line.startswith(name + '{'):
+                continue
+            labels, value = line[len(name) + 1:].rsplit('} ', 1)
+            samples[labels] = float(value)
+    return samples
+
+
+def run_collector(name, run, gocdb, elastic, prometheus_file):
+    """
+    This function runs one collection and reports where its time went.
+
+    Params
+    ------
+    name: string
+          APEL or GOCDB
+    run: function
+         Runs the collection
+    gocdb: FakeGOCDB
+           The GOCDB stand-in
+    elastic: FakeElasticsearch
+             The Elasticsearch stand-in
+    prometheus_file: string
+                     Where the collection writes its timings
+    Returns
+    -------
+    report: dict
+            The wall time of the run, the time the collector spent in each
+            phase, the requests each stand-in received, the size of the
+            documents it indexed and the metrics the collector could not
+            fetch
+    """
+    gocdb.stats = {}
+    elastic.calls = []
+    elastic.documents = []
+    started = time.time()
+    run()
+    wall_seconds = time.time() - started
+    phases = {}
+    for labels, seconds in read_prometheus(
+            prometheus_file, 'gridtools_collector_phase_seconds').items():
+        phases[labels.split('phase="')[1].rstrip('"')] = seconds
+    return {
+        'collector': name,
+        'wall_seconds': wall_seconds,
+        'phases': phases,
+        'gocdb_requests': gocdb.stats,
+        'elasticsearch_calls': elastic.calls_by_kind(),
+        'indexed_bytes': sum(len(json.dumps(document))
+                             for document in elastic.documents),
+        'missing_metrics': sum((document.get('missing_metrics', [])
+                                for document in elastic.documents), []),
+    }
+
+
+def run_harness(options):
+    """
+    This function drives full collector runs against the stand-ins.
+
+    Params
+    ------
+    options: optparse Values
+             The command line options of the harness
+    Returns
+    -------
+    reports: list
+             One "run_collector" report per collection
+    """
+    if options.replies:
+        replies = load_replies(options.replies)
+    else:
+        replies = generate_replies(int(options.endpoints),
+                                   int(options.sites), int(options.users))
+    gocdb = FakeGOCDB(replies, page_size=int(options.page_size),
+                      latency=float(options.latency),
+                      failure_rate=float(options.failure_rate),
+                      failure=options.failure).start()
+    elastic = FakeElasticsearch(
+        records={'storage': 10.0, 'cloud': 20.0, 'grid': 30.0}).start()
+    work_dir = tempfile.mkdtemp()
+    # metrics_gocdb needs a certificate and key that exist, although they
+    # are not used over plain http
+    certificate = os.path.join(work_dir, 'hostcert.pem')
+    open(certificate, 'w').close()
+
+    prometheus_file = os.path.join(work_dir, 'collector.prom')
+    common_args = ['--gocdb-url', gocdb.url, '--es-hosts', elastic.url,
+                   '-w', options.write, '--prometheus-file', prometheus_file,
+                   '--cache-dir', os.path.join(work_dir, 'cache'),
+                   '--archive-dir', os.path.join(work_dir, 'archive'),
+                   '--spool-file', os.path.join(work_dir, 'es-spool.ndjson'),
+                   '--read-timeout', options.read_timeout,
+                   '--retries', options.retries,
+                   '--deadline', options.deadline,
+                   '--output-mode', options.output_mode]
+    if options.no_cache:
+        common_args.append('--no-cache')
+    apel_options, _ = metrics_apel.build_parser().parse_args(
+        common_args + ['-n', options.concurrency, '-f', options.fetch_mode])
+    gocdb_options, _ = metrics_gocdb.build_parser().parse_args(
+        common_args + ['-c', certificate, '-k', certificate, '-v', 'False'])
+
+    reports = []
+    try:
+        for _ in range(int(options.runs)):
+            reports.append(run_collector(
+                'APEL', lambda: metrics_apel.main(apel_options),
+                gocdb, elastic, prometheus_file))
+            reports.append(run_collector(
+                'GOCDB', lambda: metrics_gocdb.__main__(gocdb_options),
+                gocdb, elastic, prometheus_file))
+    finally:
+        gocdb.stop()
+        elastic.stop()
+        shutil.rmtree(work_dir)
+    return reports
+
+
+def build_parser():
+    """Returns the command line option parser of this script"""
+    parser = OptionParser()
+    parser.add_option("-r", "--runs", dest="runs", default="2",
+                      help="How many times to run each collector.")
+    parser.add_option("--replies", dest="replies", default=None,
+                      help=("A directory of recorded <method>.xml replies "
+                            "to serve instead of generated ones."))
+    parser.add_option("--endpoints", dest="endpoints", default="10000",
+                      help="How many service endpoints to generate.")
+    parser.add_option("--sites", dest="sites", default="1000",
+                      help="How many sites to generate.")
+    parser.add_option("--users", dest="users", default="10000",
+                      help="How many users to generate.")
+    parser.add_option("--page-size", dest="page_size", default="0",
+                      help="Records per page, 0 to serve unpaged replies.")
+    parser.add_option("--latency", dest="latency", default="0",
+                      help="Seconds of latency added to each GOCDB request.")
+    parser.add_option("--failure-rate", dest="failure_rate", default="0",
+                      help="The share of GOCDB requests that fail.")
+    parser.add_option("--failure", dest="failure", default="error",
+                      help=("How requests fail: error (503), reset "
+                            "(connection closed) or stall."))
+    parser.add_option("--read-timeout", dest="read_timeout", default="60",
+                      help="The collectors' --read-timeout.")
+    parser.add_option("--retries", dest="retries", default="3",
+                      help="The collectors' --retries.")
+    parser.add_option("--deadline", dest="deadline", default="1800",
+                      help="The collectors' --deadline.")
+    parser.add_option("-n", "--concurrency", dest="concurrency", default="4",
+                      help="The APEL collector's --concurrency.")
+    parser.add_option("--output-mode", dest="output_mode", default="full",
+                      help="The collectors' --output-mode, full or delta.")
+    parser.add_option("-f", "--fetch-mode", dest="fetch_mode",
+                      default="auto",
+                      help="The APEL collector's --fetch-mode.")
+    parser.add_option("-w", "--write-to-elastic", dest="write",
+                      default="True",
+                      help="Whether the collectors write their metrics.")
+    parser.add_option("--no-cache", dest="no_cache", action="store_true",
+                      default=False,
+                      help="Run the collectors without their GOCDB cache.")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Where to write the reports as JSON.")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    (options, args) = parser.parse_args()
+    reports = run_harness(options)
+    for report in reports:
+        print('%-6s %8.3fs  %s' % (
+            report['collector'], report['wall_seconds'],
+            ', '.join('%s %.3fs' % phase
+                      for phase in sorted(report['phases'].items()))))
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(reports, output_file, indent=2)
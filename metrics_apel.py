@@ -1,15 +1,439 @@
 """This script collects metrics from APEL (Alex T/SCD/2018)"""
+import io
+import threading
+import time
 import requests
+from array import array
 import xml.dom.minidom
 from datetime import datetime, timedelta
-from elasticsearch import Elasticsearch
 import logging
-from common import GetData, ModLogger, ESWrite
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from elasticsearch.exceptions import ElasticsearchException, RequestError
+from common import SPOOL_PATH, BulkSink, CollectorRun, FieldExtractor, \
+    GOCDBClient, ModLogger, ResponseCache, add_collector_options, \
+    configure_collector, get_elastic, iter_elements, log_missing, \
+    parse_cached, parse_sharded, parse_streamed, run_phase, spool_path
 from optparse import OptionParser
+from metrics_archive import MetricsArchive
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 logger = logging.getLogger('APEL logger')
-country_list = []
+# Added once, as the daemon runs the collector many times
+logger.addHandler(logging.NullHandler())
+
+# The loader documents' field holding the APEL accounting type
+APEL_TYPE_FIELD = 'fields.apel_type'
+
+
+# The fields of a SERVICE_ENDPOINT the consumers below read
+ENDPOINT_FIELDS = FieldExtractor(
+    ('SITENAME', 'COUNTRY_NAME', 'ROC_NAME', 'SERVICE_TYPE', 'IN_PRODUCTION',
+     'BETA', 'NODE_MONITORED', 'HOSTDN'),
+    lists={'SCOPES': 'SCOPE'})
+
+
+class EndpointConsumer(object):
+    """
+    This class feeds SERVICE_ENDPOINT nodes or elements to "add_fields".
+
+    Subclasses only need to implement "add_fields", which receives a
+    dictionary of the fields of a single endpoint.
+    """
+    # The format of "to_state", raised whenever it changes so states
+    # cached in an older format are not merged
+    STATE_VERSION = 1
+
+    def add_fields(self, fields):
+        """Adds the fields of a single endpoint"""
+        raise NotImplementedError
+
+    def empty(self):
+        """Returns a new, empty consumer of the same kind"""
+        raise NotImplementedError
+
+    def to_state(self):
+        """Returns the counters as a JSON serialisable object"""
+        raise NotImplementedError
+
+    def merge_state(self, state):
+        """
+        Adds counters returned by "to_state" to this consumer.
+
+        A state it cannot read raises KeyError before anything is added.
+        """
+        raise NotImplementedError
+
+    def count(self):
+        """Returns the number of endpoints added"""
+        raise NotImplementedError
+
+    def add_endpoint(self, service_endpoint):
+        """Adds a SERVICE_ENDPOINT, a minidom node or ElementTree element"""
+        self.add_fields(ENDPOINT_FIELDS.extract(service_endpoint))
+
+    def add_elements(self, elements):
+        """Adds every node of a NodeList, or "iter_service_endpoints" item"""
+        for service_endpoint in elements:
+            self.add_endpoint(service_endpoint)
+        return self
+
+    # "FieldExtractor" reads minidom nodes and elements alike
+    add_nodes = add_elements
+
+
+class EndpointAggregator(EndpointConsumer):
+    """
+    This class collects the metrics for one endpoint type in a single pass.
+
+    Every SERVICE_ENDPOINT is read once and its site, country, service
+    type, ROC and scopes are added to set-based counters, along with how
+    many endpoints are in production, in beta and monitored. "get_sites",
+    "get_services", "get_countries" and "get_breakdown" are then answered
+    from those counters.
+    """
+    FLAGS = ('in_production', 'beta', 'monitored')
+    # rocs, scopes and flags were added to the state
+    STATE_VERSION = 2
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.sites = Counter()
+        self.countries = Counter()
+        self.service_types = Counter()
+        self.rocs = Counter()
+        self.scopes = Counter()
+        self.flags = Counter(dict.fromkeys(self.FLAGS, 0))
+
+    def add(self, sitename, country, service_type, has_hostdn, roc=None,
+            scopes=(), in_production=False, beta=False, monitored=False):
+        """Adds a single endpoint to the counters"""
+        self.sites[sitename] += 1
+        self.countries[country] += 1
+        self.rocs[roc] += 1
+        for scope in scopes:
+            self.scopes[scope] += 1
+        self.flags['in_production'] += in_production
+        self.flags['beta'] += beta
+        self.flags['monitored'] += monitored
+        if has_hostdn:
+            self.service_types[service_type] += 1
+
+    def add_fields(self, fields):
+        """Passes the fields of a single endpoint on to "add" """
+        self.add(fields.get('SITENAME'), fields.get('COUNTRY_NAME'),
+                 fields.get('SERVICE_TYPE'), 'HOSTDN' in fields,
+                 fields.get('ROC_NAME'),
+                 fields.get('SCOPES', ()),
+                 fields.get('IN_PRODUCTION') == 'Y',
+                 fields.get('BETA') == 'Y',
+                 fields.get('NODE_MONITORED') == 'Y')
+
+    def empty(self):
+        """Returns a new, empty aggregator for the same endpoint type"""
+        return EndpointAggregator(self.endpoint)
+
+    def to_state(self):
+        """Returns the counters as a JSON serialisable object"""
+        # Pairs rather than objects, as a missing name is kept as None
+        return {
+            'endpoint': self.endpoint,
+            'sites': list(self.sites.items()),
+            'countries': list(self.countries.items()),
+            'service_types': list(self.service_types.items()),
+            'rocs': list(self.rocs.items()),
+            'scopes': list(self.scopes.items()),
+            'flags': list(self.flags.items()),
+        }
+
+    def merge_state(self, state):
+        """Adds counters returned by "to_state" to this aggregator"""
+        counts = [(getattr(self, name), state[name])
+                  for name in ('sites', 'countries', 'service_types',
+                               'rocs', 'scopes', 'flags')]
+        for counter, pairs in counts:
+            for key, count in pairs:
+                counter[key] += count
+        return self
+
+    def count(self):
+        """Returns the number of endpoints added"""
+        return sum(self.sites.values())
+
+    def get_sites(self):
+        """Returns the (number, list) of sites, as "get_sites" does"""
+        return (len(self.sites), list(self.sites))
+
+    def get_services(self):
+        """Returns the number of endpoints, as "get_services" does"""
+        return self.service_types[self.endpoint]
+
+    def get_countries(self, context=None):
+        """
+        Returns the (list, number) of countries, as "get_countries" does.
+
+        If an "ApelRunContext" is given, the countries are also added to
+        its set of countries across every endpoint type.
+        """
+        if context is not None:
+            context.add_countries(self.countries)
+        return (list(self.countries), len(self.countries))
+
+    def get_missing(self):
+        """
+        Returns how many endpoints lacked each field the metrics need.
+
+        A missing SITENAME or COUNTRY_NAME is counted under None, and an
+        endpoint without a HOSTDN is not counted as a service, so these
+        come from the counters rather than being logged endpoint by
+        endpoint.
+        """
+        return {
+            'SITENAME': self.sites[None],
+            'COUNTRY_NAME': self.countries[None],
+            'HOSTDN': self.count() - sum(self.service_types.values()),
+        }
+
+    def get_breakdown(self):
+        """
+        Returns the ROC, scope and status counts of this endpoint type.
+
+        Returns
+        -------
+        breakdown: dict
+                   The number of endpoints, how many are in production,
+                   in beta and monitored, and lists of {name, count}
+                   objects for the ROCs and scopes the endpoints are in
+        """
+        breakdown = {
+            'service_type': self.endpoint,
+            'endpoints': self.count(),
+            'rocs': [{'name': name, 'count': count}
+                     for name, count in self.rocs.items()],
+            'scopes': [{'name': name, 'count': count}
+                       for name, count in self.scopes.items()],
+        }
+        for flag in self.FLAGS:
+            breakdown[flag] = self.flags[flag]
+        return breakdown
+
+
+class EndpointTable(EndpointConsumer):
+    """
+    This class holds every endpoint of a reply in compact columns.
+
+    Each string column is dictionary-encoded: its distinct values are
+    kept once, in "values", and every row stores an integer code in an
+    "array". Yes/no fields take one byte per row, and the scopes of all
+    rows share one code array that "scope_offsets" slices per row. The
+    metrics are group-by counts over those arrays, vectorised with NumPy
+    when it is installed, so one load answers every endpoint type.
+    """
+    COLUMNS = (('site', 'SITENAME'), ('country', 'COUNTRY_NAME'),
+               ('roc', 'ROC_NAME'), ('service_type', 'SERVICE_TYPE'))
+    FLAGS = (('in_production', 'IN_PRODUCTION'), ('beta', 'BETA'),
+             ('monitored', 'NODE_MONITORED'), ('has_hostdn', 'HOSTDN'))
+
+    def __init__(self):
+        self.values = {}
+        self._codes = {}
+        self.columns = {}
+        for column, _ in self.COLUMNS + (('scope', 'SCOPE'),):
+            self.values[column] = []
+            self._codes[column] = {}
+            self.columns[column] = array('i')
+        for flag, _ in self.FLAGS:
+            self.columns[flag] = array('b')
+        self.scope_offsets = array('i', [0])
+
+    def encode(self, column, value):
+        """Returns the code of a value, adding it to the column if new"""
+        codes = self._codes[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.values[column])
+            self.values[column].append(value)
+        return code
+
+    def add_fields(self, fields):
+        """Appends the fields of a single endpoint as a new row"""
+        for column, tag in self.COLUMNS:
+            self.columns[column].append(self.encode(column, fields.get(tag)))
+        for flag, tag in self.FLAGS:
+            if flag == 'has_hostdn':
+                self.columns[flag].append(tag in fields)
+            else:
+                self.columns[flag].append(fields.get(tag) == 'Y')
+        for scope in fields.get('SCOPES', ()):
+            self.columns['scope'].append(self.encode('scope', scope))
+        self.scope_offsets.append(len(self.columns['scope']))
+
+    def empty(self):
+        """Returns a new, empty table"""
+        return EndpointTable()
+
+    def to_state(self):
+        """Returns the columns as a JSON serialisable object"""
+        return {
+            'values': self.values,
+            'columns': dict((name, list(codes))
+                            for name, codes in self.columns.items()),
+            'scope_offsets': list(self.scope_offsets),
+        }
+
+    def merge_state(self, state):
+        """Appends the rows returned by "to_state" to this table"""
+        values = dict((column, state['values'][column])
+                      for column in self.values)
+        columns = dict((column, state['columns'][column])
+                       for column in self.columns)
+        offsets = state['scope_offsets']
+        for column in self.values:
+            translate = [self.encode(column, value)
+                         for value in values[column]]
+            self.columns[column].extend(
+                translate[code] for code in columns[column])
+        for flag, _ in self.FLAGS:
+            self.columns[flag].extend(columns[flag])
+        base = self.scope_offsets[-1]
+        self.scope_offsets.extend(base + offset for offset in offsets[1:])
+        return self
+
+    def count(self):
+        """Returns the number of endpoints added"""
+        return len(self.columns['site'])
+
+    def _rows(self, where):
+        """
+        Returns the rows whose columns hold the values in "where".
+
+        This is a boolean NumPy mask, or a list of row numbers without
+        NumPy.
+        """
+        if numpy is not None:
+            mask = numpy.ones(self.count(), dtype=bool)
+            for column, value in where.items():
+                code = self._codes[column].get(value, -1)
+                mask &= numpy.frombuffer(self.columns[column],
+                                         dtype=numpy.intc) == code
+            return mask
+        rows = range(self.count())
+        for column, value in where.items():
+            code = self._codes[column].get(value, -1)
+            codes = self.columns[column]
+            rows = [row for row in rows if codes[row] == code]
+        return list(rows)
+
+    def _count_codes(self, column, codes):
+        """Counts the values of some codes, in the order first seen"""
+        values = self.values[column]
+        if numpy is not None:
+            counts = numpy.bincount(codes, minlength=len(values))
+            unique, first = numpy.unique(codes, return_index=True)
+            return Counter(dict(
+                (values[code], int(counts[code]))
+                for code in unique[numpy.argsort(first)]))
+        counter = Counter()
+        for code in codes:
+            counter[values[code]] += 1
+        return counter
+
+    def group_count(self, column, **where):
+        """
+        Returns the number of rows per value of a column.
+
+        Params
+        ------
+        column: string
+                One of "site", "country", "roc", "service_type" or "scope"
+        where: keyword arguments
+               Only count the rows whose columns hold these values, such
+               as service_type="APEL"
+        Returns
+        -------
+        counts: Counter
+                The rows per value, in the order values were first seen
+
+        Notes
+        -----
+        A row is counted once for each of its scopes.
+        """
+        rows = self._rows(where)
+        if column == 'scope':
+            return self._count_codes(column, self._scope_codes(rows))
+        if numpy is not None:
+            codes = numpy.frombuffer(self.columns[column],
+                                     dtype=numpy.intc)[rows]
+        else:
+            codes = [self.columns[column][row] for row in rows]
+        return self._count_codes(column, codes)
+
+    def _scope_codes(self, rows):
+        """Returns the scope codes of some rows"""
+        scopes = self.columns['scope']
+        if numpy is not None:
+            offsets = numpy.frombuffer(self.scope_offsets, dtype=numpy.intc)
+            owners = numpy.repeat(numpy.arange(self.count()),
+                                  numpy.diff(offsets))
+            return numpy.frombuffer(scopes, dtype=numpy.intc)[rows[owners]]
+        offsets = self.scope_offsets
+        return [code for row in rows
+                for code in scopes[offsets[row]:offsets[row + 1]]]
+
+    def flag_count(self, flag, **where):
+        """Returns the number of rows with a yes/no column set to yes"""
+        rows = self._rows(where)
+        if numpy is not None:
+            return int(numpy.frombuffer(self.columns[flag],
+                                        dtype=numpy.int8)[rows].sum())
+        flags = self.columns[flag]
+        return sum(flags[row] for row in rows)
+
+    def aggregator_for(self, endpoint):
+        """Returns the "EndpointAggregator" of an endpoint type"""
+        aggregator = EndpointAggregator(endpoint)
+        aggregator.sites = self.group_count('site', service_type=endpoint)
+        aggregator.countries = self.group_count('country',
+                                                service_type=endpoint)
+        aggregator.rocs = self.group_count('roc', service_type=endpoint)
+        aggregator.scopes = self.group_count('scope', service_type=endpoint)
+        for flag in aggregator.FLAGS:
+            aggregator.flags[flag] = self.flag_count(flag,
+                                                     service_type=endpoint)
+        with_hostdn = self.flag_count('has_hostdn', service_type=endpoint)
+        if with_hostdn:
+            aggregator.service_types[endpoint] = with_hostdn
+        return aggregator
+
+
+class ApelRunContext(object):
+    """
+    This class holds the aggregation state of a single APEL collection.
+
+    A new context is made for every run and passed to the functions that
+    collect metrics across endpoint types, so repeated or concurrent
+    collections in one process never share state. It is safe to update
+    from several threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.countries = Counter()
+
+    def add_countries(self, countries):
+        """Adds the countries using one endpoint type"""
+        with self._lock:
+            for country in countries:
+                self.countries[country] += 1
+
+    def get_countries(self):
+        """Returns the (list, number) of countries across endpoint types"""
+        with self._lock:
+            return (list(self.countries), len(self.countries))
 
 
 def get_sites(endpoint, data_obj):
@@ -31,21 +455,9 @@ def get_sites(endpoint, data_obj):
                    This is a list of all the sites using an endpoint
     Notes
     -----
-    This function uses the "GetData" class.
+    This function is a view over the "EndpointAggregator" class.
     """
-    sitename_list = []
-    for service_endpoint in data_obj:
-        gocdb_portal_url = service_endpoint.getElementsByTagName(
-            'GOCDB_PORTAL_URL'
-        )[0].firstChild.nodeValue
-
-        sitename = GetData('SITENAME', service_endpoint, gocdb_portal_url)
-        sitename = sitename.data_finder()
-        # Adds the sitenames to a list if they are not already in it
-        if sitename not in sitename_list:
-            sitename_list.append(sitename)
-
-    return(len(sitename_list), sitename_list)
+    return EndpointAggregator(endpoint).add_nodes(data_obj).get_sites()
 
 
 def get_services(endpoint, data_obj):
@@ -64,35 +476,13 @@ def get_services(endpoint, data_obj):
              This is the number of times each endpoint is used
     Notes
     -----
-    This fucntion also uses the "GetData" class. The function also logs errors
-    when a HOSTDN is missing.
+    This function is a view over the "EndpointAggregator" class. Endpoints
+    without a HOSTDN are not counted.
     """
-    counter = 0
-    for service_endpoint in data_obj:
-        gocdb_portal_url = service_endpoint.getElementsByTagName(
-            'GOCDB_PORTAL_URL'
-        )[0].firstChild.nodeValue
-
-        service_type = GetData('SERVICE_TYPE', service_endpoint,
-                               gocdb_portal_url)
-
-        service_type = service_type.data_finder()
-
-        try:
-            hostdn = service_endpoint.getElementsByTagName(
-                'HOSTDN'
-            )[0].firstChild.nodeValue
+    return EndpointAggregator(endpoint).add_nodes(data_obj).get_services()
 
-            if service_type == endpoint:
-                counter = counter + 1
 
-        except IndexError:
-            logger.warning('Index error when requesting HOSTDN from ' + gocdb_portal_url)
-
-    return counter
-
-
-def get_countries(endpoint, data_obj):
+def get_countries(endpoint, data_obj, context=None):
     """
     This function finds the countries using each endpoint.
 
@@ -102,6 +492,8 @@ def get_countries(endpoint, data_obj):
               This is the endpoint for which the metrics are collected
     data_obj: xml minidom object
               This is where the data needed for the function is stored
+    context: ApelRunContext
+             The run the countries are also collected for, if any
     Returns
     -------
     country_list_temp: list
@@ -110,32 +502,149 @@ def get_countries(endpoint, data_obj):
                             This is the number of countries using an endpoint
     Notes
     -----
-    This function uses the global variable "country_list" in order to be able to
-    collect metrics across all APEL endpoint types.
+    This function is a view over the "EndpointAggregator" class. The
+    countries are added to "context" in order to be able to collect
+    metrics across all APEL endpoint types.
     """
-    country_list_temp = []
-    global country_list
-    for service_endpoint in data_obj:
-        gocdb_portal_url = service_endpoint.getElementsByTagName(
-            'GOCDB_PORTAL_URL'
-        )[0].firstChild.nodeValue
+    return EndpointAggregator(endpoint).add_nodes(data_obj).get_countries(
+        context)
 
-        country = GetData('COUNTRY_NAME', service_endpoint, gocdb_portal_url)
-        country = country.data_finder()
 
-        try:
-            if country not in country_list:
-                country_list.append(country)
+def iter_service_endpoints(source):
+    """
+    This function streams the SERVICE_ENDPOINT elements out of a GOCDB reply.
+
+    Params
+    ------
+    source: file-like object
+            This holds the raw XML returned by get_service_endpoint
+    Returns
+    -------
+    A generator of ElementTree elements, one per SERVICE_ENDPOINT.
+
+    Notes
+    -----
+    This function uses "iter_elements", so each element is cleared once
+    the caller has finished with it.
+    """
+    return iter_elements(source, 'SERVICE_ENDPOINT')
+
+
+def get_endpoint_metrics_stream(endpoint, source, context=None):
+    """
+    This function collects the site, service and country metrics in one pass.
+
+    Params
+    ------
+    endpoint: string
+              This is the endpoint for which the metrics are collected
+    source: file-like object
+            This holds the raw XML returned by get_service_endpoint
+    context: ApelRunContext
+             The run the countries are also collected for, if any
+    Returns
+    -------
+    sites: tuple
+           The same (number, list) pair that "get_sites" returns
+    services: int
+              The same counter that "get_services" returns
+    countries: tuple
+               The same (list, number) pair that "get_countries" returns
+
+    Notes
+    -----
+    This is the streaming counterpart of "get_sites", "get_services" and
+    "get_countries", and gives the same results without building a DOM.
+    """
+    aggregator = EndpointAggregator(endpoint)
+    aggregator.add_elements(iter_service_endpoints(source))
+    return (aggregator.get_sites(), aggregator.get_services(),
+            aggregator.get_countries(context))
+
+
+def _records_query(query_type):
+    """Returns the search body for the records loaded for one query type"""
+    return {
+        "query": {
+            "bool": {
+                "must": [
+                    {"match": {APEL_TYPE_FIELD: query_type}},
+                    {"match": {"fields.process": "loader"}}
+                ]
+            }
+        },
+        "size": 0,
+        "aggs": {
+            "total_number_loaded": {"sum": {"field": "numberloaded"}}
+        }
+    }
+
+
+def get_records_totals(query_types, elastic=None):
+    """
+    This function gets the records loaded for every query type in one request
 
-            if country not in country_list_temp:
-                country_list_temp.append(country)
+    Params
+    ------
+    query_types: list
+                 The query types for which the data should be collected
+    elastic: Elasticsearch client
+             The client to use, the shared one from "get_elastic" if None
+    Returns
+    -------
+    totals: dict
+            The number of records loaded for each query type. Query types
+            with no loader documents are given an explicit zero.
 
-        except IndexError:
-            logger.error("Index error when requesting country name from" +
-                         gocdb_portal_url)
+    Notes
+    -----
+    A terms aggregation on APEL_TYPE_FIELD with a sum sub-aggregation
+    answers every query type in one pass over yesterday's index. If the
+    cluster cannot aggregate on that field (for example because it is
+    mapped as analysed text), the per-type queries are sent together in a
+    single msearch instead.
+    """
+    if elastic is None:
+        elastic = get_elastic()
+    index = "logstash-" + datetime.strftime(datetime.now() - timedelta(1),
+                                            '%Y.%m.%d')
+    totals = dict((query_type, 0.0) for query_type in query_types)
+    params_dict = {
+        "query": {"match": {"fields.process": "loader"}},
+        "size": 0,
+        "aggs": {
+            "apel_types": {
+                "terms": {
+                    "field": APEL_TYPE_FIELD,
+                    "include": list(query_types),
+                    "size": len(query_types),
+                },
+                "aggs": {
+                    "total_number_loaded": {"sum": {"field": "numberloaded"}}
+                }
+            }
+        }
+    }
 
+    try:
+        result = elastic.search(index=index, body=params_dict)
+        for bucket in result["aggregations"]["apel_types"]["buckets"]:
+            totals[bucket["key"]] = bucket["total_number_loaded"]["value"]
+        return totals
+    except RequestError as error:
+        logger.warning('Terms aggregation on ' + APEL_TYPE_FIELD +
+                       ' failed, falling back to msearch: ' + str(error))
 
-    return(country_list_temp, len(country_list_temp))
+    body = []
+    for query_type in query_types:
+        body.append({"index": index})
+        body.append(_records_query(query_type))
+    result = elastic.msearch(body=body)
+    for query_type, response in zip(query_types, result["responses"]):
+        if "aggregations" in response:
+            totals[query_type] = \
+                response["aggregations"]["total_number_loaded"]["value"]
+    return totals
 
 
 def get_records(query_type):
@@ -154,34 +663,393 @@ def get_records(query_type):
 
     Notes
     -----
-    The function has been written to work with ElasticSearch 1.5.
-    When the cluster is updated the code may have to be changed,
-    to allow it to interact with the new cluster.
-    This function also makes use of the Elasticsearch module.
+    This function is a view over "get_records_totals", which should be
+    used directly when more than one query type is needed.
     """
-    date = datetime.strftime(datetime.now() - timedelta(1), '%Y.%m.%d')
+    return get_records_totals([query_type])[query_type]
+
+
+def get_records_histogram(query_types, start, end, elastic=None):
+    """
+    This function gets the records loaded for every day of a date range
+
+    Params
+    ------
+    query_types: list
+                 The query types for which the data should be collected
+    start: datetime
+           The first day to collect
+    end: datetime
+         The last day to collect, inclusive
+    elastic: Elasticsearch client
+             The client to use, the shared one from "get_elastic" if None
+    Returns
+    -------
+    days: list
+          (day, totals) pairs in date order, where totals holds the number
+          of records loaded for each query type that day, zero if none
+
+    Notes
+    -----
+    A single date_histogram by day with a terms aggregation on
+    APEL_TYPE_FIELD below it is run across every logstash-* index.
+    """
+    if elastic is None:
+        elastic = get_elastic()
+    first_day = start.strftime('%Y-%m-%d')
+    last_day = end.strftime('%Y-%m-%d')
     params_dict = {
         "query": {
             "bool": {
-                "must": [
-                    {"match": {"fields.apel_type": query_type}},
-                    {"match": {"fields.process": "loader"}}
-                ]
+                "must": [{"match": {"fields.process": "loader"}}],
+                "filter": [{"range": {"@timestamp": {
+                    "gte": first_day,
+                    "lt": (end + timedelta(1)).strftime('%Y-%m-%d'),
+                    "format": "yyyy-MM-dd",
+                }}}],
             }
         },
         "size": 0,
         "aggs": {
-            "total_number_loaded": {"sum": {"field": "numberloaded"}}
+            "days": {
+                "date_histogram": {
+                    "field": "@timestamp",
+                    "interval": "day",
+                    "format": "yyyy-MM-dd",
+                    "min_doc_count": 0,
+                    "extended_bounds": {"min": first_day, "max": last_day},
+                },
+                "aggs": {
+                    "apel_types": {
+                        "terms": {
+                            "field": APEL_TYPE_FIELD,
+                            "include": list(query_types),
+                            "size": len(query_types),
+                        },
+                        "aggs": {
+                            "total_number_loaded": {
+                                "sum": {"field": "numberloaded"}
+                            }
+                        }
+                    }
+                }
+            }
         }
     }
 
-    result = ESWrite({}).elastic.search(index="logstash-" + date, body=params_dict)
+    result = elastic.search(index="logstash-*", body=params_dict)
+
+    days = []
+    for day_bucket in result["aggregations"]["days"]["buckets"]:
+        totals = dict((query_type, 0.0) for query_type in query_types)
+        for bucket in day_bucket["apel_types"]["buckets"]:
+            totals[bucket["key"]] = bucket["total_number_loaded"]["value"]
+        day = datetime.strptime(day_bucket["key_as_string"], '%Y-%m-%d')
+        days.append((day, totals))
+    return days
+
+
+def backfill_records(query_types, start, end, write, elastic=None,
+                     spool_path=SPOOL_PATH, archive=None):
+    """
+    This function rebuilds the records loaded metrics for a date range
+
+    Params
+    ------
+    query_types: list
+                 The query types for which the data should be collected
+    start: datetime
+           The first day of records to collect
+    end: datetime
+         The last day of records to collect, inclusive
+    write: bool
+           Whether to write the documents to ElasticSearch or print them
+    elastic: Elasticsearch client
+             The client to use, the shared one from "get_elastic" if None
+    spool_path: string
+                Where to keep the documents the cluster did not accept
+    archive: MetricsArchive
+             Where to archive the documents written, if not None
+    Returns
+    -------
+    documents: list
+               One metrics dictionary per day
+
+    Notes
+    -----
+    A normal run reports the records loaded the day before, so the
+    document for each day is timestamped at midnight of the following day,
+    just as the daily run would have written it. All of the documents are
+    written in a single bulk request.
+    """
+    documents = []
+    for day, totals in get_records_histogram(query_types, start, end,
+                                             elastic):
+        document = {
+            'type': 'apel_metric',
+            '@timestamp': (day + timedelta(1)).isoformat(),
+            'backfill': True,
+        }
+        for query_type in query_types:
+            document['Number of records loaded for ' + query_type
+                     + ' accounting'] = totals[query_type]
+        documents.append(document)
+
+    if write:
+        sink = BulkSink(spool_path, max_docs=len(documents) + 1,
+                        elastic=elastic)
+        for document in documents:
+            sink.add(document)
+        sink.flush()
+        if archive is not None:
+            # Older than what is archived already, so each is sorted into
+            # its segment's index
+            for document in documents:
+                archive.append(document)
+    else:
+        for document in documents:
+            print(document)
+    return documents
+
 
-    total = result["aggregations"]["total_number_loaded"]["value"]
-    return total
+def endpoint_state(consumer, endpoints):
+    """
+    Returns the state of an empty consumer once fed some endpoints.
+
+    This is what each worker of a sharded parse runs, so it is defined
+    here rather than as a lambda, which could not be pickled.
+    """
+    return consumer.add_elements(endpoints).to_state()
 
 
-def main(options):
+def parse_endpoint_response(response, consumer, parser="iterparse"):
+    """
+    This function feeds a get_service_endpoint reply to a consumer.
+
+    Params
+    ------
+    response: requests response object
+              This is the reply from GOCDBPI
+    consumer: EndpointConsumer
+              Either an "EndpointAggregator" or an "EndpointTable"
+    parser: string
+            Either "iterparse" (streaming), "parallel" (sharded across
+            processes once over the PARALLEL_SETTINGS threshold) or
+            "minidom"
+    Returns
+    -------
+    consumer: EndpointConsumer
+              The consumer passed in, now holding the metrics
+    """
+    if parser == "parallel":
+        for state in parse_sharded(response.content, 'SERVICE_ENDPOINT',
+                                   partial(endpoint_state, consumer.empty())):
+            consumer.merge_state(state)
+    elif parser == "minidom":
+        context = xml.dom.minidom.parseString(response.text)
+        consumer.add_nodes(context.getElementsByTagName('SERVICE_ENDPOINT'))
+    else:
+        consumer.add_elements(
+            iter_service_endpoints(io.BytesIO(response.content))
+        )
+    return consumer
+
+
+def collect_endpoints(client, consumer, parser="iterparse", stats=None,
+                      **params):
+    """
+    This function feeds every get_service_endpoint page to a consumer.
+
+    Params
+    ------
+    client: GOCDBClient
+            The client used to talk to GOCDBPI
+    consumer: EndpointConsumer
+              Either an "EndpointAggregator" or an "EndpointTable"
+    parser: string
+            Either "stream" (parsed while it downloads), "iterparse"
+            (streaming, once downloaded), "parallel" (sharded across
+            processes, once downloaded) or "minidom"
+    stats: RunStats
+           Times the fetch and parse of each page, if given
+    params: keyword arguments
+            Extra query parameters, such as service_type
+    Returns
+    -------
+    consumer: EndpointConsumer
+              The consumer passed in, now holding the metrics
+
+    Notes
+    -----
+    When the client has a cache, the counters of each page are cached too,
+    so a page that has not changed since the last run is not parsed again.
+    With "stream", the parse phase also includes the download.
+    """
+    name = type(consumer).__name__
+    if parser == "stream":
+        for page in client.stream_pages('get_service_endpoint', stats=stats,
+                                        **params):
+            with run_phase(stats, 'parse') as record:
+                before = consumer.count()
+                if client.cache is None:
+                    consumer.add_elements(page.records('SERVICE_ENDPOINT'))
+                else:
+                    parse_streamed(
+                        page, name,
+                        lambda page: consumer.empty().add_elements(
+                            page.records('SERVICE_ENDPOINT')).to_state(),
+                        consumer.STATE_VERSION, consumer.merge_state)
+                record['bytes'] = page.bytes_read
+                record['elements'] = consumer.count() - before
+        return consumer
+
+    def parse_page(response):
+        """Returns the counters of a single page"""
+        return parse_endpoint_response(response, consumer.empty(),
+                                       parser).to_state()
+
+    for response in client.iter_pages('get_service_endpoint', stats=stats,
+                                      **params):
+        with run_phase(stats, 'parse') as record:
+            before = consumer.count()
+            if client.cache is None:
+                parse_endpoint_response(response, consumer, parser)
+            else:
+                parse_cached(client.cache, response, name, parse_page,
+                             consumer.STATE_VERSION, consumer.merge_state)
+            record['bytes'] = len(response.content)
+            record['elements'] = consumer.count() - before
+    return consumer
+
+
+def choose_fetch_mode(fetch_mode, timings, max_age=24 * 3600, now=None):
+    """
+    This function decides how to fetch the endpoints for this run.
+
+    Params
+    ------
+    fetch_mode: string
+                One of "auto", "snapshot" or "filtered"
+    timings: dict
+             The last timing ResponseCache recorded for each mode, for
+             "auto" mode
+    max_age: float
+             Seconds after which a timing is measured again
+    now: float
+         The time of the run, the current time if None
+    Returns
+    -------
+    fetch_mode: string
+                Either "snapshot" or "filtered"
+
+    Notes
+    -----
+    A filtered query costs a round trip and a parse per endpoint type, while
+    the snapshot costs one larger round trip and parse whatever the number
+    of types. Which is cheaper depends on GOCDB and the link to it, so
+    "auto" mode measures both: a mode with no timing younger than
+    "max_age" is tried, filtered first, then the one that was faster is
+    used.
+    """
+    if fetch_mode != "auto":
+        return fetch_mode
+    if now is None:
+        now = time.time()
+    seconds = {}
+    for mode, timing in timings.items():
+        if timing is not None and now - timing['stored_at'] < max_age:
+            seconds[mode] = timing['seconds']
+    for mode in ("filtered", "snapshot"):
+        if mode not in seconds:
+            return mode
+    return min(seconds, key=seconds.get)
+
+
+def fetch_endpoint_aggregators(client, endpoint_types, options, stats=None):
+    """
+    This function fetches and aggregates the endpoints of each type.
+
+    Params
+    ------
+    client: GOCDBClient
+            The client used to talk to GOCDBPI
+    endpoint_types: list
+                    The endpoint types metrics are collected for
+    options: optparse Values
+             The command line options of the run
+    stats: RunStats
+           Times the fetch and parse of each page, if given
+    Returns
+    -------
+    A generator of (endpoint, EndpointAggregator) pairs, in the order the
+    replies are parsed.
+    """
+    cache = client.cache
+    timings = {}
+    if cache is not None:
+        for mode in ("filtered", "snapshot"):
+            timings[mode] = cache.load_timing('apel-fetch-' + mode)
+    fetch_mode = choose_fetch_mode(options.fetch_mode, timings)
+    logger.info('Fetching endpoints in ' + fetch_mode + ' mode')
+    start = time.time()
+
+    if fetch_mode == "snapshot":
+        try:
+            index = collect_endpoints(client, EndpointTable(),
+                                      options.parser, stats)
+        except requests.exceptions.ConnectionError:
+            logger.error("Error connecting to GOCDB, "
+                         "some metrics may not be fetched.")
+            return
+        for endpoint in endpoint_types:
+            yield endpoint, index.aggregator_for(endpoint)
+        if cache is not None:
+            cache.store_timing('apel-fetch-snapshot', time.time() - start)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=int(options.concurrency))
+    # Each worker parses its pages as they arrive
+    futures = dict(
+        (executor.submit(collect_endpoints, client,
+                         EndpointAggregator(endpoint), options.parser,
+                         stats, service_type=endpoint), endpoint)
+        for endpoint in endpoint_types
+    )
+    failed = False
+    for future in as_completed(futures):
+        endpoint = futures[future]
+        try:
+            yield endpoint, future.result()
+        except requests.exceptions.ConnectionError:
+            failed = True
+            logger.error("Error connecting to GOCDB, "
+                         "some metrics may not be fetched.")
+    executor.shutdown()
+    # A fetch cut short by an error says nothing about its usual cost
+    if cache is not None and not failed:
+        cache.store_timing('apel-fetch-filtered', time.time() - start)
+
+
+def build_client(options):
+    """
+    Builds the GOCDBClient used by "main" from the command line options.
+
+    A long-lived process can build the client once and pass it to every
+    call of "main", so its connections and cache stay warm between runs.
+    """
+    verify_server_cert = bool(options.verify == "True")
+    cache = None
+    if not options.no_cache:
+        cache = ResponseCache(options.cache_dir)
+    return GOCDBClient(verify=verify_server_cert,
+                       pool_size=int(options.concurrency), cache=cache,
+                       base_url=options.gocdb_url,
+                       timeout=(float(options.connect_timeout),
+                                float(options.read_timeout)),
+                       retries=int(options.retries))
+
+
+def main(options, client=None):
     """
     Runs all of the functions above to generate metrics for APEL.
 
@@ -189,12 +1057,10 @@ def main(options):
     implement in one of the two if statements. This function also
     checks if ElasticSearch is up and if it isn't skips metrics related to
     data within ElasticSearch. If options.write is set to "True",
-    the data will also be written to ElasticSearch.
+    the data will also be written to ElasticSearch. A GOCDBClient from
+    "build_client" can be passed in to reuse its connections.
     """
-    verify_server_cert = bool(options.verify == "True")
-
-    logger.addHandler(logging.NullHandler())
-    ModLogger('APEL.log').logger_mod()
+    ModLogger('APEL.log', logger.name).logger_mod()
 
     logger.info('Service has started')
 
@@ -203,62 +1069,95 @@ def main(options):
                       'eu.egi.storage.accounting']
     query_type_list = ['storage', 'cloud', 'grid']
 
+    if options.backfill:
+        configure_collector(options)
+        start, end = [datetime.strptime(day, '%Y-%m-%d')
+                      for day in options.backfill.split(':')]
+        logger.info('Backfilling records loaded from ' + options.backfill)
+        archive = None
+        if options.archive_dir:
+            archive = MetricsArchive(options.archive_dir)
+        backfill_records(query_type_list, start, end,
+                         options.write == "True",
+                         spool_path=spool_path(options), archive=archive)
+        logger.info('Service has ended')
+        return
+
     # master dictionary
     apel_metrics_dict = {
         'type': 'apel_metric',
         '@timestamp': datetime.now().isoformat()
     }
 
-    all_countries = set()
-    try:
-        # Get the number of sites running atleast one of our endpoints
-        for endpoint in endpoint_types:
-            response = requests.get(
-                'https://goc.egi.eu/gocdbpi/public/?method=get_service_endpoint&service_type=' + endpoint,
-                verify=verify_server_cert
-            )
-
-            data = response.text
-            context = xml.dom.minidom.parseString(data)
-            service_endpoint_obj = context.getElementsByTagName(
-                'SERVICE_ENDPOINT'
-            )
-
-            site_number, site_list = get_sites(endpoint, service_endpoint_obj)
+    context = ApelRunContext()
+    if client is None:
+        client = build_client(options)
+    run = CollectorRun('apel', options, client, logger)
+    stats = run.stats
+    snapshot = run.snapshot
+    fetched = set()
+    # Get the number of sites running atleast one of our endpoints
+    for endpoint, aggregator in fetch_endpoint_aggregators(client,
+                                                           endpoint_types,
+                                                           options, stats):
+        fetched.add(endpoint)
+        with stats.phase('aggregate') as record:
+            record['elements'] = aggregator.count()
+            site_number, site_list = aggregator.get_sites()
 
             apel_metrics_dict['Number of sites runnning at least one ' + endpoint + " endpoint"] = site_number
             apel_metrics_dict['List of sites runnning at least one ' + endpoint + " endpoint"] = site_list
 
-            apel_metrics_dict['Number of ' + endpoint + ' endpoints'] = get_services(endpoint, service_endpoint_obj)
+            apel_metrics_dict['Number of ' + endpoint + ' endpoints'] = aggregator.get_services()
 
-            country_list, country_number = get_countries(endpoint,
-                                                         service_endpoint_obj)
+            endpoint_countries, country_number = aggregator.get_countries(context)
 
             apel_metrics_dict['List of countries with at least one ' + endpoint + ' endpoint'] = country_number
-            apel_metrics_dict['Number of countries with at least one '+ endpoint + ' endpoint'] = country_list
+            apel_metrics_dict['Number of countries with at least one '+ endpoint + ' endpoint'] = endpoint_countries
 
-            all_countries.update(country_list)
-            apel_metrics_dict['Total number of countries using APEL '] = len(all_countries)
-            apel_metrics_dict['Complete list of countries using APEL '] = list(all_countries)
+            all_countries, all_country_number = context.get_countries()
+            apel_metrics_dict['Total number of countries using APEL '] = all_country_number
+            apel_metrics_dict['Complete list of countries using APEL '] = all_countries
 
-    except requests.exceptions.ConnectionError:
-        logger.error("Error connecting to GOCDB, "
-                     "some metrics may not be fetched.")
+            snapshot.record(endpoint + ' sites', site_list,
+                            field='List of sites runnning at least one ' +
+                            endpoint + ' endpoint')
+            # The countries themselves are held under "Number of"
+            snapshot.record(endpoint + ' countries', endpoint_countries,
+                            field='Number of countries with at least one ' +
+                            endpoint + ' endpoint')
 
-    for query_type in query_type_list:
-        apel_metrics_dict['Number of records loaded for ' + query_type
-                          + ' accounting'] = get_records(query_type)
+            apel_metrics_dict.setdefault('endpoint_breakdown', []).append(
+                aggregator.get_breakdown())
+            log_missing(logger, aggregator.get_missing(),
+                        endpoint + ' endpoints')
 
+    missing_metrics = [endpoint + ' endpoints' for endpoint in endpoint_types
+                       if endpoint not in fetched]
+    if not missing_metrics:
+        # A partial list would look like countries were removed
+        snapshot.record('APEL countries', context.get_countries()[0],
+                        field='Complete list of countries using APEL ')
 
-    if options.write == "True":
-        ESWrite(apel_metrics_dict).write()
+    try:
+        with stats.phase('es_read') as record:
+            records_totals = get_records_totals(query_type_list)
+            record['elements'] = len(records_totals)
+    except ElasticsearchException as error:
+        logger.error('Error reading the records loaded from '
+                     'ElasticSearch: ' + str(error))
+        missing_metrics.append('records loaded')
     else:
-        print(apel_metrics_dict)
+        for query_type in query_type_list:
+            apel_metrics_dict['Number of records loaded for ' + query_type
+                              + ' accounting'] = records_totals[query_type]
 
+    run.finish(apel_metrics_dict, missing_metrics)
     logger.info('Service has ended')
 
 
-if __name__ == "__main__":
+def build_parser():
+    """Returns the command line option parser of this script"""
     parser = OptionParser()
     parser.add_option("-w", "--write-to-elastic", dest="write",
                       default="False",
@@ -266,6 +1165,25 @@ if __name__ == "__main__":
     parser.add_option("-v", "--verify-server-certificate", dest="verify",
                       default="True",
                       help="Wether to verify the server certificate or not.")
+    parser.add_option("-n", "--concurrency", dest="concurrency",
+                      default="4",
+                      help=("The maximum number of GOCDB requests "
+                            "to run at once."))
+    parser.add_option("-f", "--fetch-mode", dest="fetch_mode",
+                      default="auto",
+                      help=("How to fetch the endpoints: filtered (one "
+                            "query per endpoint type), snapshot (one "
+                            "unfiltered query) or auto (whichever was "
+                            "faster in recent runs; filtered without a "
+                            "cache)."))
+    parser.add_option("-b", "--backfill", dest="backfill",
+                      default=None,
+                      help=("Only rebuild the records loaded metrics for "
+                            "the days START:END (YYYY-MM-DD:YYYY-MM-DD)."))
+    return add_collector_options(parser, 'apel-snapshot.json')
+
 
+if __name__ == "__main__":
+    parser = build_parser()
     (options, args) = parser.parse_args()
     main(options)
@@ -0,0 +1,274 @@
+"""
+This script keeps a local, compressed archive of the metrics documents the
+collectors index, and queries or re-indexes date ranges of it.
+
+    python metrics_archive.py query --from 2018-06-01 --to 2018-07-01 \\
+        -t apel_metric -m "Number of APEL endpoints"
+    python metrics_archive.py rebuild --from 2018-06-01 --to 2018-07-01
+"""
+import bisect
+import gzip
+import json
+import mmap
+import os
+import struct
+import sys
+from datetime import datetime
+from optparse import OptionParser
+from common import ARCHIVE_DIR, BulkSink, configure_elastic, \
+    parse_es_hosts
+
+# Each index entry is the timestamp of a document, in seconds, and the
+# offset and length of the gzip member holding it in the segment
+INDEX_ENTRY = struct.Struct('<dQI')
+
+
+def timestamp_seconds(timestamp):
+    """
+    Returns the seconds since 1970 of an "@timestamp" or a date.
+
+    The collectors write local times without a zone, so they are read as
+    they are; only their order matters to the archive.
+    """
+    formats = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+    for time_format in formats:
+        try:
+            moment = datetime.strptime(timestamp[:19], time_format)
+        except ValueError:
+            continue
+        return (moment - datetime(1970, 1, 1)).total_seconds()
+    raise ValueError('Not a date or timestamp: ' + timestamp)
+
+
+class _Index(object):
+    """This class reads the timestamps of a segment index through mmap"""
+    def __init__(self, path):
+        self.path = path
+        self.mapping = None
+        self.length = 0
+
+    def __enter__(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        # A partly written last entry, from an interrupted run, is ignored
+        self.length = size // INDEX_ENTRY.size
+        if self.length:
+            with open(self.path, 'rb') as index_file:
+                self.mapping = mmap.mmap(index_file.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.mapping is not None:
+            self.mapping.close()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        # Only the timestamps are looked up by "bisect"
+        return self.entry(position)[0]
+
+    def entry(self, position):
+        """Returns the (seconds, offset, length) of an entry"""
+        return INDEX_ENTRY.unpack_from(self.mapping,
+                                       position * INDEX_ENTRY.size)
+
+    def entries(self, start=None, end=None):
+        """Returns the entries from "start" up to, not including, "end" """
+        first = 0 if start is None else bisect.bisect_left(self, start)
+        last = self.length if end is None else bisect.bisect_left(self, end)
+        return [self.entry(position) for position in range(first, last)]
+
+
+class MetricsArchive(object):
+    """
+    This class appends metrics documents to gzip compressed NDJSON segments.
+
+    There is one segment per document type and month, such as
+    apel_metric.2018-06.ndjson.gz. Every document is its own gzip member,
+    which gzip and zcat read as one stream, and an ".idx" file next to the
+    segment holds the timestamp, offset and length of each member, sorted
+    by time. A query only opens the segments of the months it covers,
+    finds the first and last document by bisecting their memory-mapped
+    index and decompresses just those members.
+    """
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+
+    def _segment_path(self, metric_type, month):
+        """Returns the path of the segment of a type and month"""
+        return os.path.join(self.directory,
+                            '%s.%s.ndjson.gz' % (metric_type, month))
+
+    def append(self, dictionary):
+        """
+        Appends a metrics document to the segment of its type and month.
+
+        Returns
+        -------
+        path: string
+              The segment the document was written to
+        """
+        timestamp = dictionary.get('@timestamp') or datetime.now().isoformat()
+        seconds = timestamp_seconds(timestamp)
+        path = self._segment_path(dictionary.get('type', 'metric'),
+                                  timestamp[:7])
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        member = gzip.compress(
+            (json.dumps(dictionary, sort_keys=True) + '\n').encode('utf-8'))
+        with open(path, 'ab') as segment:
+            offset = segment.seek(0, os.SEEK_END)
+            segment.write(member)
+        entry = INDEX_ENTRY.pack(seconds, offset, len(member))
+
+        index_path = path + '.idx'
+        with _Index(index_path) as index:
+            in_order = not len(index) or index[len(index) - 1] <= seconds
+            entries = [] if in_order else index.entries()
+        if in_order:
+            with open(index_path, 'ab') as index_file:
+                index_file.truncate(len(index) * INDEX_ENTRY.size)
+                index_file.seek(0, os.SEEK_END)
+                index_file.write(entry)
+        else:
+            # A document older than the last one, from a backfill, is
+            # sorted into place
+            entries.insert(bisect.bisect_right(
+                [entry_seconds for entry_seconds, _, _ in entries], seconds),
+                (seconds, offset, len(member)))
+            temporary_path = index_path + '.%d.tmp' % os.getpid()
+            with open(temporary_path, 'wb') as index_file:
+                for sorted_entry in entries:
+                    index_file.write(INDEX_ENTRY.pack(*sorted_entry))
+            os.replace(temporary_path, index_path)
+        return path
+
+    def segments(self, metric_type=None, start=None, end=None):
+        """
+        Returns the segments that may hold documents in a date range.
+
+        Params
+        ------
+        metric_type: string
+                     Only segments of this type, such as apel_metric
+        start, end: string
+                    Dates or timestamps; the range includes "start" and
+                    stops before "end"
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        segments = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.ndjson.gz'):
+                continue
+            segment_type, month = name[:-len('.ndjson.gz')].rsplit('.', 1)
+            if metric_type is not None and segment_type != metric_type:
+                continue
+            if start is not None and month < start[:7]:
+                continue
+            if end is not None and month > end[:7]:
+                continue
+            segments.append(os.path.join(self.directory, name))
+        return sorted(segments, key=lambda path: os.path.basename(path)
+                      .rsplit('.', 3)[1])
+
+    def query(self, start=None, end=None, metric_type=None, metrics=None):
+        """
+        This function reads the documents of a date range.
+
+        Params
+        ------
+        start, end: string
+                    Dates or timestamps; the range includes "start" and
+                    stops before "end". Either may be None.
+        metric_type: string
+                     Only documents of this type, such as gocdb_metric
+        metrics: list
+                 Only these fields are returned, with @timestamp and type.
+                 Every field is returned if this is None.
+        Returns
+        -------
+        A generator of metrics dictionaries, in time order within each
+        type and month.
+        """
+        start_seconds = None if start is None else timestamp_seconds(start)
+        end_seconds = None if end is None else timestamp_seconds(end)
+        for path in self.segments(metric_type, start, end):
+            with _Index(path + '.idx') as index:
+                entries = index.entries(start_seconds, end_seconds)
+            if not entries:
+                continue
+            with open(path, 'rb') as segment:
+                for _, offset, length in entries:
+                    segment.seek(offset)
+                    dictionary = json.loads(
+                        gzip.decompress(segment.read(length)))
+                    if metrics is not None:
+                        dictionary = dict(
+                            (key, dictionary[key]) for key in
+                            ['@timestamp', 'type'] + list(metrics)
+                            if key in dictionary)
+                    yield dictionary
+
+    def rebuild(self, start=None, end=None, metric_type=None, sink=None):
+        """
+        This function indexes the documents of a date range again.
+
+        Each document goes to the daily index it was first written to,
+        with the same id, so documents already in the cluster are
+        overwritten rather than duplicated.
+
+        Returns
+        -------
+        indexed: int
+                 The number of documents the cluster accepted
+        """
+        if sink is None:
+            sink = BulkSink(spool_path=None)
+        indexed = 0
+        for dictionary in self.query(start, end, metric_type):
+            indexed = indexed + sink.add(dictionary)
+        return indexed + sink.flush()
+
+
+def build_parser():
+    """Returns the command line option parser of this script"""
+    parser = OptionParser(usage="%prog query|rebuild [options]")
+    parser.add_option("-d", "--archive-dir", dest="archive_dir",
+                      default=ARCHIVE_DIR,
+                      help="Where the collectors archive their metrics.")
+    parser.add_option("--from", dest="start", default=None,
+                      help="The first date (YYYY-MM-DD) to read.")
+    parser.add_option("--to", dest="end", default=None,
+                      help="The date (YYYY-MM-DD) to stop reading before.")
+    parser.add_option("-t", "--type", dest="metric_type", default=None,
+                      help="Only read apel_metric or gocdb_metric documents.")
+    parser.add_option("-m", "--metric", dest="metrics", action="append",
+                      default=None,
+                      help=("A field to return, may be given more than "
+                            "once. Every field is returned by default."))
+    parser.add_option("--es-hosts", dest="es_hosts", default=None,
+                      help=("Comma separated ElasticSearch urls to rebuild "
+                            "into instead of the gridpp cluster."))
+    return parser
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in ('query', 'rebuild'):
+        parser.error('Give one command, query or rebuild')
+
+    archive = MetricsArchive(options.archive_dir)
+    if args[0] == 'query':
+        for dictionary in archive.query(options.start, options.end,
+                                        options.metric_type,
+                                        options.metrics):
+            sys.stdout.write(json.dumps(dictionary) + '\n')
+    else:
+        if options.es_hosts:
+            configure_elastic(hosts=parse_es_hosts(options.es_hosts))
+        print('Indexed %d documents' % archive.rebuild(
+            options.start, options.end, options.metric_type))
@@ -0,0 +1,187 @@
+"""This script runs the APEL and GOCDB collectors in one long-lived process"""
+import logging
+import random
+import shlex
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+import metrics_apel
+import metrics_gocdb
+from common import ModLogger
+
+
+logger = logging.getLogger('Daemon logger')
+
+
+class CollectorJob(object):
+    """
+    This class schedules one collector.
+
+    The collector runs every "interval" seconds, each run moved by up to
+    "jitter" seconds either way so that collectors sharing a host, or
+    several hosts sharing GOCDB, do not all fire at once. The lock stops
+    a run from starting while the previous one is still going.
+    """
+    def __init__(self, name, run, interval, jitter=0):
+        self.name = name
+        self.run = run
+        self.interval = interval
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.next_run = time.time() + random.uniform(0, jitter)
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+
+    def schedule_next(self, now):
+        """Sets the time of the next run after one due at "now" """
+        self.next_run = now + self.interval + \
+            random.uniform(-self.jitter, self.jitter)
+
+    def __call__(self):
+        """Runs the collector once, releasing the lock afterwards"""
+        started = time.time()
+        try:
+            self.run()
+            self.runs += 1
+            logger.info('%s run finished in %.1fs', self.name,
+                        time.time() - started)
+        except Exception:
+            self.failures += 1
+            logger.exception('%s run failed', self.name)
+        finally:
+            self.lock.release()
+
+
+class CollectorDaemon(object):
+    """
+    This class runs collector jobs on their schedules until stopped.
+
+    Jobs that fall due together run in parallel on a thread pool. A job
+    that is due while its previous run is still going is skipped rather
+    than queued. "stop" lets the running jobs finish before "serve"
+    returns.
+    """
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.stop_event = threading.Event()
+
+    def stop(self, *args):
+        """Asks the daemon to stop, usable as a signal handler"""
+        logger.info('Stopping once the running collectors finish')
+        self.stop_event.set()
+
+    def run_due(self, executor, now):
+        """Submits every job that is due at "now" """
+        for job in self.jobs:
+            if job.next_run > now:
+                continue
+            job.schedule_next(now)
+            if not job.lock.acquire(False):
+                job.skipped += 1
+                logger.warning('%s is still running, skipping this run',
+                               job.name)
+                continue
+            executor.submit(job)
+
+    def serve(self):
+        """Runs the jobs until "stop" is called"""
+        executor = ThreadPoolExecutor(max_workers=len(self.jobs))
+        try:
+            while not self.stop_event.is_set():
+                now = time.time()
+                self.run_due(executor, now)
+                next_run = min(job.next_run for job in self.jobs)
+                self.stop_event.wait(max(next_run - time.time(), 0))
+        finally:
+            executor.shutdown(wait=True)
+
+
+def build_jobs(options):
+    """
+    Builds the collector jobs from the command line options.
+
+    Params
+    ------
+    options: optparse Values
+             The command line options of the daemon
+    Returns
+    -------
+    jobs: list
+          A "CollectorJob" for each enabled collector
+
+    Notes
+    -----
+    Each collector's options are parsed once with its own option parser,
+    and its GOCDBClient is built once, so HTTP connections and the
+    response cache stay warm between runs. The Elasticsearch client is
+    shared process-wide by "common.get_elastic".
+    """
+    jobs = []
+    if float(options.apel_interval) > 0:
+        apel_options, _ = metrics_apel.build_parser().parse_args(
+            shlex.split(options.apel_args))
+        apel_client = metrics_apel.build_client(apel_options)
+        jobs.append(CollectorJob(
+            'APEL',
+            lambda: metrics_apel.main(apel_options, apel_client),
+            float(options.apel_interval), float(options.jitter)))
+
+    if float(options.gocdb_interval) > 0:
+        gocdb_options, _ = metrics_gocdb.build_parser().parse_args(
+            shlex.split(options.gocdb_args))
+        gocdb_client = metrics_gocdb.build_client(gocdb_options)
+        jobs.append(CollectorJob(
+            'GOCDB',
+            lambda: metrics_gocdb.__main__(gocdb_options, gocdb_client),
+            float(options.gocdb_interval), float(options.jitter)))
+    return jobs
+
+
+def build_parser():
+    """Returns the command line option parser of this script"""
+    parser = OptionParser()
+    parser.add_option("--apel-interval", dest="apel_interval",
+                      default="86400",
+                      help=("Seconds between APEL collections, "
+                            "0 to disable."))
+    parser.add_option("--gocdb-interval", dest="gocdb_interval",
+                      default="86400",
+                      help=("Seconds between GOCDB collections, "
+                            "0 to disable."))
+    parser.add_option("-j", "--jitter", dest="jitter",
+                      default="300",
+                      help="Seconds by which each run may be moved.")
+    parser.add_option("--apel-args", dest="apel_args",
+                      default="",
+                      help="The command line options for metrics_apel.")
+    parser.add_option("--gocdb-args", dest="gocdb_args",
+                      default="",
+                      help="The command line options for metrics_gocdb.")
+    return parser
+
+
+def main(options):
+    """Runs the collectors until SIGTERM or SIGINT is received."""
+    logger.addHandler(logging.NullHandler())
+    ModLogger('Daemon.log', logger.name).logger_mod()
+
+    daemon = CollectorDaemon(build_jobs(options))
+    if not daemon.jobs:
+        logger.error('No collectors are enabled')
+        return
+
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+
+    logger.info('Daemon has started')
+    daemon.serve()
+    logger.info('Daemon has ended')
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    (options, args) = parser.parse_args()
+    main(options)
@@ -1,12 +1,24 @@
 """This script is used to collect information about GOCDB -AT"""
+import io
 import requests
 import xml.dom.minidom
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
-from common import ESWrite, GetData, ModLogger
+from collections import Counter
+from common import CollectorRun, FieldExtractor, GOCDBClient, ModLogger, \
+    ResponseCache, add_collector_options, iter_elements, log_missing, \
+    parse_cached, parse_sharded, parse_streamed, run_phase
 from optparse import OptionParser
 
 
+logger = logging.getLogger('GOCDB logger')
+# Added once, as the daemon runs the collector many times
+logger.addHandler(logging.NullHandler())
+
+# The fields of a get_site_count_per_country SITE
+SITE_COUNT_FIELDS = FieldExtractor(('COUNTRY', 'COUNT'))
+
+
 def _parse_get_user_xml(xml_obj):
     """
     Parse XML from GOCDBPI endpoint get_users.
@@ -53,6 +65,224 @@ def _parse_get_user_xml_roles(xml_obj):
     return users_with_role_numer
 
 
+class UserStats(object):
+    """
+    This class computes the get_user statistics in a single pass.
+
+    Each EGEE_USER is counted once, along with whether it has at least one
+    USER_ROLE block, its home site and the entity type of each of its
+    roles. Only direct children of a user are looked at, so nothing is
+    searched twice, and with "parse" only one user is held in memory at a
+    time. The ID of each user is kept, so the users added and removed
+    since the last run can be counted.
+    """
+    def __init__(self):
+        self.users = 0
+        self.users_with_role = 0
+        self.home_sites = Counter()
+        self.roles_per_entity_type = Counter()
+        self.ids = []
+
+    # The format of "to_state", raised whenever it changes so states
+    # cached in an older format are not merged; ids were added in 2
+    STATE_VERSION = 2
+
+    def add(self, home_site, role_entity_types, user_id=None):
+        """Adds a single user to the statistics"""
+        self.users += 1
+        if user_id:
+            self.ids.append(user_id)
+        if role_entity_types:
+            self.users_with_role += 1
+        if home_site:
+            self.home_sites[home_site] += 1
+        for entity_type in role_entity_types:
+            self.roles_per_entity_type[entity_type] += 1
+
+    def add_element(self, user):
+        """Adds an EGEE_USER held as an ElementTree element"""
+        home_site = None
+        role_entity_types = []
+        for child in user:
+            if child.tag == 'HOMESITE':
+                home_site = child.text
+            elif child.tag == 'USER_ROLE':
+                role_entity_types.append(child.findtext('ENTITY_TYPE'))
+        self.add(home_site, role_entity_types, user.get('ID'))
+
+    def add_node(self, user):
+        """Adds an EGEE_USER held as a minidom node"""
+        home_site = None
+        role_entity_types = []
+        for child in user.childNodes:
+            if child.nodeType != child.ELEMENT_NODE:
+                continue
+            if child.tagName == 'HOMESITE' and child.firstChild:
+                home_site = child.firstChild.nodeValue
+            elif child.tagName == 'USER_ROLE':
+                entity_types = child.getElementsByTagName('ENTITY_TYPE')
+                entity_type = None
+                if entity_types and entity_types[0].firstChild:
+                    entity_type = entity_types[0].firstChild.nodeValue
+                role_entity_types.append(entity_type)
+        self.add(home_site, role_entity_types, user.getAttribute('ID'))
+
+    def add_records(self, users):
+        """Adds EGEE_USER records, either minidom nodes or ElementTree
+        elements"""
+        add = None
+        for user in users:
+            if add is None:
+                add = self.add_node if hasattr(user, 'childNodes') \
+                    else self.add_element
+            add(user)
+        return self
+
+    def parse(self, source):
+        """Streams every EGEE_USER of a get_user reply into the statistics"""
+        for user in iter_elements(source, 'EGEE_USER'):
+            self.add_element(user)
+        return self
+
+    def parse_xml(self, xml_obj):
+        """Adds every EGEE_USER of a minidom document"""
+        for user in xml_obj.getElementsByTagName('EGEE_USER'):
+            self.add_node(user)
+        return self
+
+    def to_state(self):
+        """Returns the statistics as a JSON serialisable object"""
+        return {
+            'users': self.users,
+            'users_with_role': self.users_with_role,
+            'home_sites': list(self.home_sites.items()),
+            'roles_per_entity_type':
+                list(self.roles_per_entity_type.items()),
+            'ids': self.ids,
+        }
+
+    def merge_state(self, state):
+        """
+        Adds statistics returned by "to_state" to these ones.
+
+        A state it cannot read raises KeyError before anything is added.
+        """
+        users, users_with_role, home_sites, roles, ids = [
+            state[key] for key in ('users', 'users_with_role', 'home_sites',
+                                   'roles_per_entity_type', 'ids')]
+        self.users += users
+        self.users_with_role += users_with_role
+        for key, count in home_sites:
+            self.home_sites[key] += count
+        for key, count in roles:
+            self.roles_per_entity_type[key] += count
+        self.ids.extend(ids)
+        return self
+
+
+def _site_names(sites):
+    """Returns the NAME of each SITE record, minidom node or element"""
+    return [site.getAttribute('NAME') if hasattr(site, 'getAttribute')
+            else site.get('NAME') for site in sites]
+
+
+def _page_records(response, tag, parser="iterparse"):
+    """Returns the records of a reply, as minidom nodes or ElementTree
+    elements"""
+    if parser == "minidom":
+        return xml.dom.minidom.parseString(
+            response.text).getElementsByTagName(tag)
+    return iter_elements(io.BytesIO(response.content), tag)
+
+
+def _parse_pages(client, method, tag, name, parse, parser, stats,
+                 scope='public', size=None, version=1, load=None):
+    """
+    Parse every page of a GOCDBPI method, one page at a time.
+
+    Parameters
+    ----------
+    client: GOCDBClient
+            The client used to talk to GOCDBPI
+    method: string
+            The GOCDBPI method, such as get_site_list
+    tag: string
+         The tag of the method's records, such as SITE
+    name: string
+          The name the parsed results are cached under
+    parse: function
+           Takes the records of a page, minidom nodes or ElementTree
+           elements, and returns a JSON serialisable result. It must be
+           defined at the top level of a module for the parallel parser.
+    parser: string
+            Either "stream" (parsed while it downloads), "iterparse"
+            (streaming, once downloaded), "parallel" (sharded across
+            processes, once downloaded) or "minidom"
+    stats: RunStats
+           Times the fetch and parse of each page
+    scope: string
+           Either "public" or "private"
+    size: function
+          Returns the number of records a result counts, for "stats"
+    version: int
+             The format of parse's results, as in "parse_cached"
+    load: function
+          Is called with each result, as in "parse_cached", so a cached
+          result that cannot be read is parsed again
+
+    Returns
+    --------
+    A generator of the result of each page, or with "parallel" of each
+    shard of a page. The result of a page that has not changed since it
+    was cached is reused without parsing it again.
+    """
+    if parser == "stream":
+        for page in client.stream_pages(method, scope, stats):
+            with run_phase(stats, 'parse') as record:
+                result = parse_streamed(
+                    page, name, lambda page: parse(page.records(tag)),
+                    version, load)
+                record['bytes'] = page.bytes_read
+                record['elements'] = size(result) if size else 0
+            yield result
+        return
+
+    if parser == "parallel":
+        load_shards = None
+        if load is not None:
+            def load_shards(results):
+                for result in results:
+                    load(result)
+        for response in client.iter_pages(method, scope, stats):
+            with run_phase(stats, 'parse') as record:
+                results = parse_cached(
+                    client.cache, response, name + '.shards',
+                    lambda response: parse_sharded(response.content, tag,
+                                                   parse),
+                    version, load_shards)
+                record['bytes'] = len(response.content)
+                record['elements'] = sum(size(result) for result in
+                                         results) if size else 0
+            for result in results:
+                yield result
+        return
+
+    for response in client.iter_pages(method, scope, stats):
+        with run_phase(stats, 'parse') as record:
+            result = parse_cached(
+                client.cache, response, name,
+                lambda response: parse(_page_records(response, tag, parser)),
+                version, load)
+            record['bytes'] = len(response.content)
+            record['elements'] = size(result) if size else 0
+        yield result
+
+
+def _user_state(users):
+    """Returns the statistics of some EGEE_USER records, as "to_state" """
+    return UserStats().add_records(users).to_state()
+
+
 def get_sites(xml_obj):
 
     """
@@ -103,35 +333,82 @@ def get_countries(xml_obj):
     -----
     The way this function accomplishes this task is by checking if a country
     has sites running in it. If it does and it is not already in the list it
-    is added to the list. "gocbd_portal_url" is set to "blank", as there is
-    no data to help identify the error, to allow the "GetData" class to be used.
+    is added to the list. Sites without a COUNTRY or a COUNT are counted
+    and logged once, rather than once each.
     """
 
-    # Gets all the data into an object
-    site_object = xml_obj.getElementsByTagName('SITE')
+    country_number, country_list, missing = count_countries(
+        xml_obj.getElementsByTagName('SITE'))
+    log_missing(logger, missing, 'site counts per country')
+    return (country_number, country_list)
+
 
+def count_countries(sites):
+    """
+    This function gets the number and list of countries from SITE records.
+
+    Parameters
+    ----------
+    sites: iterable
+           The SITE records of get_site_count_per_country, as minidom
+           nodes or ElementTree elements
+
+    Returns
+    -------
+    country_number: int
+                    Holds the number of countries using GOCDB
+
+    country_list: list
+                  Holds the list of countries using GOCDB
+
+    missing: dict
+             How many sites lacked a COUNTRY or a COUNT. They are returned
+             rather than logged, so the caller can log them once for every
+             page, shard and cached result of a run.
+    """
     country_list = []  # empty list made to hold countries
 
-    gocdb_portal_url = 'blank'
-    for site in site_object:
-        country = GetData('COUNTRY', site, gocdb_portal_url)
-        country = country.data_finder()
-        try:
-            count = site.getElementsByTagName(
-                'COUNT'
-            )[0].firstChild.nodeValue  # finds the count and stores it
+    missing = Counter()
+    for site in sites:
+        fields = SITE_COUNT_FIELDS.extract(site)
+        if 'COUNTRY' not in fields:
+            missing['COUNTRY'] += 1
+        if not fields.get('COUNT'):
+            missing['COUNT'] += 1
+            continue
 
-            if country not in country_list and int(count) != 0:
-                # Store the country if it is not in the list already
-                country_list.append(country)
+        country = fields.get('COUNTRY')
+        if country not in country_list and int(fields['COUNT']) != 0:
+            # Store the country if it is not in the list already
+            country_list.append(country)
 
-        except IndexError:
-            logger.error('Error when requesting count')
+    return (len(country_list), country_list, dict(missing))
 
-    return (len(country_list), country_list)
 
+def build_client(options):
+    """
+    Builds the GOCDBClient used by "__main__" from the command line options.
 
-def __main__(options):
+    A long-lived process can build the client once and pass it to every
+    call of "__main__", so its connections and cache stay warm between runs.
+    """
+    if options.verify == "False":
+        verify_server_cert = False
+    else:
+        verify_server_cert = options.verify
+
+    cache = None
+    if not options.no_cache:
+        cache = ResponseCache(options.cache_dir)
+    return GOCDBClient(verify=verify_server_cert,
+                       cert=(options.certificate, options.key), cache=cache,
+                       base_url=options.gocdb_url,
+                       timeout=(float(options.connect_timeout),
+                                float(options.read_timeout)),
+                       retries=int(options.retries))
+
+
+def __main__(options, client=None):
     """
     Runs all of the functions above to generate metrics for GOCDB.
 
@@ -139,20 +416,14 @@ def __main__(options):
     implement in one of the two if statements. This function also
     checks if ElasticSearch is up and if it isn't skips metrics related to
     data within ElasticSearch. If options.write is set to "True",
-    the data will also be written to ElasticSearch.
+    the data will also be written to ElasticSearch. A GOCDBClient from
+    "build_client" can be passed in to reuse its connections.
     """
 
-    if options.verify == "False":
-        verify_server_cert = False
-    else:
-        verify_server_cert = options.verify
+    if client is None:
+        client = build_client(options)
 
-    session = requests.Session()
-    session.cert = (options.certificate, options.key)
-
-    logger = logging.getLogger('GOCDB logger')
-    logger.addHandler(logging.NullHandler())
-    ModLogger('GOCDB.log').logger_mod()
+    ModLogger('GOCDB.log', logger.name).logger_mod()
     logger.info('service has started')
 
     gocdb_metrics_dict = {
@@ -160,59 +431,83 @@ def __main__(options):
         '@timestamp': datetime.now().isoformat()
     }
 
+    run = CollectorRun('gocdb', options, client, logger)
+    stats = run.stats
+    snapshot = run.snapshot
+    missing_metrics = []
+
     try:
         # Get the number of registered service providers (aka sites)
         # registered in GOCDB.
-        response = session.get(
-            'https://goc.egi.eu/gocdbpi/public/?method=get_site_list',
-            verify=verify_server_cert
-        )
-
-        response = response.text
-        response = xml.dom.minidom.parseString(response)
-        gocdb_metrics_dict['Number of sites in GOCDB'] = get_sites(response)
+        site_names = []
+        for page_names in _parse_pages(
+                client, 'get_site_list', 'SITE', 'site_names', _site_names,
+                options.parser, stats, size=len):
+            site_names.extend(page_names)
+        site_number = len(site_names)
+        snapshot.record('sites', site_names)
+        gocdb_metrics_dict['Number of sites in GOCDB'] = site_number
+    except requests.exceptions.ConnectionError as error:
+        logger.error("Error connecting to GOCDB, "
+                     "the sites are not fetched: " + str(error))
+        missing_metrics.append('sites')
 
+    try:
         # Get the number and names of the countries with atleast one site.
-        response = session.get(
-            'https://goc.egi.eu/gocdbpi/public/?method=get_site_count_per_country',
-            verify=verify_server_cert
-        )
-
-        response = response.text
-        response = xml.dom.minidom.parseString(response)
-        country_number, country_list = get_countries(response)
+        country_list = []
+        missing_fields = Counter()
+        for _, page_countries, page_missing in _parse_pages(
+                client, 'get_site_count_per_country', 'SITE', 'countries',
+                count_countries, options.parser, stats,
+                size=lambda result: result[0], version=2):
+            for country in page_countries:
+                if country not in country_list:
+                    country_list.append(country)
+            missing_fields.update(page_missing)
+        log_missing(logger, missing_fields, 'site counts per country')
+        country_number = len(country_list)
+        snapshot.record('countries', country_list,
+                        field='List of countries using GOCDB')
         gocdb_metrics_dict['Number of countries using GOCDB'] = country_number
         gocdb_metrics_dict['List of countries using GOCDB'] = country_list
-
-        # Get the number of users registered in GOCDB.
-        response = session.get("https://goc.egi.eu/gocdbpi/private/?method=get_user",
-                                verify=verify_server_cert)
-        response_text = response.text
-        response_xml = xml.dom.minidom.parseString(response_text)
-
-        user_number = _parse_get_user_xml(response_xml)
-        gocdb_metrics_dict['Number of registered GOCDB users'] = user_number
-
-        users_with_role_number = _parse_get_user_xml_roles(response_xml)
-        gocdb_metrics_dict['Number of registered GOCDB users with a role'] = users_with_role_number
-
     except requests.exceptions.ConnectionError as error:
-        print(error)
         logger.error("Error connecting to GOCDB, "
-                     "some metrics may not be fetched.")
+                     "the countries are not fetched: " + str(error))
+        missing_metrics.append('countries')
 
-    if options.write == "True":
-        date = datetime.strftime(datetime.now() - timedelta(1), '%Y.%m.%d')
-        ESWrite(gocdb_metrics_dict).write()
-        logger.info("Elastic Search updated for " + date)
-    else:
-        # This can be used for testing
-        print(gocdb_metrics_dict)
+    try:
+        # Get the number of users registered in GOCDB, a page at a time.
+        user_stats = UserStats()
+        for _ in _parse_pages(
+                client, 'get_user', 'EGEE_USER', 'users', _user_state,
+                options.parser, stats, scope='private',
+                size=lambda state: state['users'],
+                version=UserStats.STATE_VERSION,
+                load=user_stats.merge_state):
+            pass
+        snapshot.record('users', user_stats.ids, counts_only=True)
+
+        with stats.phase('aggregate') as record:
+            record['elements'] = user_stats.users
+            gocdb_metrics_dict['Number of registered GOCDB users'] = user_stats.users
+            gocdb_metrics_dict['Number of registered GOCDB users with a role'] = user_stats.users_with_role
+            gocdb_metrics_dict['users_per_home_site'] = [
+                {'name': name, 'count': count}
+                for name, count in user_stats.home_sites.items()
+            ]
+            gocdb_metrics_dict['user_roles_per_entity_type'] = \
+                dict(user_stats.roles_per_entity_type)
+    except requests.exceptions.ConnectionError as error:
+        logger.error("Error connecting to GOCDB, "
+                     "the users are not fetched: " + str(error))
+        missing_metrics.append('users')
 
+    run.finish(gocdb_metrics_dict, missing_metrics)
     logger.info('Service has ended')
 
 
-if __name__ == '__main__':
+def build_parser():
+    """Returns the command line option parser of this script"""
     parser = OptionParser()
     parser.add_option("-w", "--write-to-elastic", dest="write",
                       default="False",
@@ -232,6 +527,12 @@ if __name__ == '__main__':
                       help=("The CA path to validate the server certificate "
                             "against, or False (no verification)."))
 
+    return add_collector_options(parser, 'gocdb-snapshot.json')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = build_parser()
     (options, args) = parser.parse_args()
 
     __main__(options)
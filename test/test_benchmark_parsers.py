@@ -0,0 +1,36 @@
+"""This script is a unit test for benchmark_parsers"""
+import io
+import unittest
+import xml.dom.minidom
+from benchmark_parsers import generate_service_endpoints, generate_sites, \
+    generate_site_counts, generate_users, run_benchmarks
+from metrics_gocdb import UserStats, get_countries, get_sites
+from metrics_apel import EndpointTable, iter_service_endpoints
+
+
+class TestBenchmarkParsers(unittest.TestCase):
+    """This class holds the tests for benchmark_parsers"""
+    def test_generators(self):
+        """Test the generated XML holds the requested number of elements"""
+        table = EndpointTable().add_elements(
+            iter_service_endpoints(io.BytesIO(generate_service_endpoints(30))))
+        self.assertEqual(table.count(), 30)
+        self.assertEqual(len(table.values['service_type']), 10)
+        self.assertEqual(get_sites(xml.dom.minidom.parseString(
+            generate_sites(12))), 12)
+        self.assertEqual(get_countries(xml.dom.minidom.parseString(
+            generate_site_counts(9)))[0], 6)
+        self.assertEqual(UserStats().parse(
+            io.BytesIO(generate_users(21))).users, 21)
+
+    def test_run_benchmarks(self):
+        """Test a small run reports time and memory for each case"""
+        report = run_benchmarks([10], repeat=1, selected='UserStats')
+        self.assertEqual(len(report['results']), 4)
+        self.assertEqual([(speedup['case'], speedup['baseline'])
+                          for speedup in report['speedups']],
+                         [('metrics_gocdb.UserStats[parallel]',
+                           'metrics_gocdb.UserStats.parse')])
+        for result in report['results']:
+            self.assertEqual(result['elements'], 10)
+            self.assertGreater(result['peak_bytes'], 0)
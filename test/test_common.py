@@ -0,0 +1,465 @@
+"""This script is a unit test for common"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import xml.dom.minidom
+from xml.etree import ElementTree
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from optparse import OptionParser
+from elasticsearch.exceptions import ConnectionError
+import common
+from common import ES_SETTINGS, BulkSink, CollectorRun, FieldExtractor, \
+    GOCDBClient, ModLogger, RateLimitFilter, ResponseCache, RunStats, \
+    SnapshotStore, add_collector_options, configure_elastic, \
+    configure_parallel, elastic_stats, get_elastic, get_process_pool, \
+    iter_chunked_elements, log_missing, next_page_url, parse_cached, \
+    parse_sharded, split_records
+
+
+def site_names(records):
+    """Returns the NAME of each SITE record, in a worker process"""
+    return [record.get('NAME') for record in records]
+
+
+class FakeResponse(object):
+    """This class stands in for a requests response"""
+    def __init__(self, content):
+        self.content = content
+
+
+class PagedClient(GOCDBClient):
+    """This class serves PAGES instead of calling GOCDBPI"""
+    def get(self, method, scope='public', stats=None, **params):
+        return FakeResponse(PAGES['page1'])
+
+    def get_url(self, url, stats=None):
+        return FakeResponse(PAGES[url])
+
+
+class TestCommon(unittest.TestCase):
+    """This class holds the tests for common"""
+    def test_next_page_url(self):
+        """Test the next_page_url method"""
+        self.assertEqual(next_page_url(PAGES['page1']), 'page2')
+        self.assertEqual(next_page_url(PAGES['page2']), None)
+        self.assertEqual(next_page_url(b'<results><SITE/></results>'), None)
+
+    def test_iter_pages(self):
+        """Test the iter_pages method follows every next link"""
+        pages = [response.content for response in
+                 PagedClient().iter_pages('get_user', scope='private')]
+        self.assertEqual(pages, [PAGES['page1'], PAGES['page2']])
+
+    def test_iter_chunked_elements(self):
+        """Test records and links are read from a reply split anywhere"""
+        chunks = [PAGES['page1'][i:i + 7]
+                  for i in range(0, len(PAGES['page1']), 7)]
+        links = {}
+        users = [user.get('ID') for user in
+                 iter_chunked_elements(chunks, 'EGEE_USER', links)]
+        self.assertEqual(users, ['1G0'])
+        self.assertEqual(links, {'self': 'page1', 'next': 'page2'})
+
+    def test_split_records(self):
+        """Test a reply is cut only between whole records"""
+        content = (b'<?xml version="1.0"?><results><meta><count>3</count>'
+                   b'</meta><SITE NAME="A"><SITENAME>x</SITENAME></SITE>'
+                   b'<SITE NAME="B"/>\n<SITE NAME="C"></SITE></results>')
+        shards = split_records(content, 'SITE', 2)
+        self.assertEqual(shards, [
+            b'<results><SITE NAME="A"><SITENAME>x</SITENAME></SITE>'
+            b'</results>',
+            b'<results><SITE NAME="B"/>\n<SITE NAME="C"></SITE></results>'])
+        self.assertEqual(
+            [ElementTree.fromstring(shard)[0].get('NAME')
+             for shard in split_records(content, 'SITE', 5)],
+            ['A', 'B', 'C'])
+        self.assertEqual(split_records(b'<results/>', 'SITE', 2),
+                         [b'<results/>'])
+
+    def test_configure_parallel(self):
+        """Test a run keeps the pool, and parses serially if it is shut"""
+        saved = dict(common.PARALLEL_SETTINGS)
+        self.addCleanup(configure_parallel, **saved)
+        configure_parallel(workers=2, threshold=0)
+        pool = get_process_pool()
+        configure_parallel(workers=2, threshold=0)
+        self.assertIs(get_process_pool(), pool)
+
+        # Another run changes the settings after this one got the pool
+        pool.shutdown()
+        content = (b'<results><SITE NAME="A"/><SITE NAME="B"/>'
+                   b'<SITE NAME="C"/></results>')
+        self.assertEqual(parse_sharded(content, 'SITE', site_names),
+                         [['A', 'B', 'C']])
+        configure_parallel(workers=3)
+        self.assertIsNot(get_process_pool(), pool)
+
+    def test_response_cache(self):
+        """Test a 304 reply is answered from the cache"""
+        server = HTTPServer(('127.0.0.1', 0), ETagHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        cache_dir = tempfile.mkdtemp()
+        try:
+            url = 'http://127.0.0.1:%d/?method=get_site_list' % \
+                server.server_port
+            client = GOCDBClient(cache=ResponseCache(cache_dir))
+            calls = []
+
+            def parse(response):
+                calls.append(response)
+                return len(response.content)
+
+            first = client.get_url(url)
+            self.assertFalse(first.from_cache)
+            self.assertEqual(parse_cached(client.cache, first, 'n', parse),
+                             len(PAGES['page1']))
+
+            second = client.get_url(url)
+            self.assertTrue(second.from_cache)
+            self.assertEqual(second.content, PAGES['page1'])
+            self.assertEqual(parse_cached(client.cache, second, 'n', parse),
+                             len(PAGES['page1']))
+            self.assertEqual(len(calls), 1)
+
+            ResponseCache(cache_dir, ttl=-1).evict()
+            self.assertEqual(os.listdir(cache_dir), ['evict.lock'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            shutil.rmtree(cache_dir)
+
+    def test_response_cache_evict_concurrent(self):
+        """Test eviction passes over files another run is changing"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        key = 'a' * 40
+        names = [key + '.json', key + '.body', key + '.json.99.tmp',
+                 key + '.body.99.1.tmp']
+        for name in names:
+            with open(os.path.join(cache_dir, name), 'w') as cache_file:
+                cache_file.write('x')
+        # A body renamed away after the directory was listed
+        listed = names + ['b' * 40 + '.body']
+        with mock.patch('os.listdir', return_value=listed):
+            ResponseCache(cache_dir, ttl=-1).evict()
+        self.assertEqual(sorted(os.listdir(cache_dir)),
+                         sorted(names[2:] + ['evict.lock']))
+
+    def test_parse_cached_format(self):
+        """Test results cached in another format are parsed again"""
+        cache = ResponseCache(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, cache.directory)
+        response = FakeResponse(b'<results/>')
+        response.url = 'http://gocdb/?method=get_user'
+        cache.store_parsed(response, 'users', {'users': 3})
+        calls = []
+
+        def parse(response):
+            calls.append(response)
+            return {'users': 3, 'ids': ['1']}
+
+        # A new version is a different key
+        self.assertEqual(parse_cached(cache, response, 'users', parse, 2),
+                         {'users': 3, 'ids': ['1']})
+        self.assertEqual(len(calls), 1)
+
+        # A result the caller cannot load is a miss, then replaced
+        loaded = []
+
+        def load(state):
+            loaded.append(state['ids'])
+
+        self.assertEqual(
+            parse_cached(cache, response, 'users', parse, load=load),
+            {'users': 3, 'ids': ['1']})
+        self.assertEqual((len(calls), loaded), (2, [['1']]))
+        parse_cached(cache, response, 'users', parse, load=load)
+        self.assertEqual((len(calls), loaded), (2, [['1'], ['1']]))
+
+    def test_collector_run(self):
+        """Test the shared options and run scaffolding of the collectors"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        parser = add_collector_options(OptionParser(), 'test-snapshot.json')
+        parser.add_option("-w", dest="write", default="False")
+        options, _ = parser.parse_args(['--cache-dir', cache_dir,
+                                        '--collector-stats', 'True',
+                                        '--deadline', '60'])
+        client = GOCDBClient(cache=ResponseCache(cache_dir))
+        run = CollectorRun('test', options, client, logging.getLogger('test'))
+        self.assertIsNotNone(client.deadline)
+        self.assertEqual(run.snapshot.path,
+                         os.path.join(cache_dir, 'test-snapshot.json'))
+
+        metrics_dict = {'type': 'test_metric'}
+        with mock.patch('builtins.print') as printed:
+            run.finish(metrics_dict, ['sites'])
+        printed.assert_called_once_with(metrics_dict)
+        self.assertEqual(metrics_dict['missing_metrics'], ['sites'])
+        self.assertNotIn('previous_write', metrics_dict['_collector_stats'])
+
+        # The write of the run comes after its stats, so they carry the
+        # write time of the one before
+        client.cache.store_timing('test-write', 1.5)
+        metrics_dict = {'type': 'test_metric'}
+        with mock.patch('builtins.print'):
+            CollectorRun('test', options, client,
+                         logging.getLogger('test')).finish(metrics_dict, [])
+        self.assertEqual(
+            metrics_dict['_collector_stats']['previous_write']['seconds'],
+            1.5)
+
+    def test_field_extractor(self):
+        """Test fields are read from direct children of either tree"""
+        record = ('<SERVICE_ENDPOINT><SITENAME>SITE-A</SITENAME><BETA/>'
+                  '<SCOPES><SCOPE>EGI</SCOPE><SCOPE>wlcg</SCOPE></SCOPES>'
+                  '<ENDPOINTS><ENDPOINT><HOSTDN>nested</HOSTDN></ENDPOINT>'
+                  '</ENDPOINTS></SERVICE_ENDPOINT>')
+        extractor = FieldExtractor(('SITENAME', 'BETA', 'HOSTDN'),
+                                   lists={'SCOPES': 'SCOPE'})
+        expected = {'SITENAME': 'SITE-A', 'BETA': '',
+                    'SCOPES': ['EGI', 'wlcg']}
+        self.assertEqual(extractor.extract(
+            xml.dom.minidom.parseString(record).documentElement), expected)
+        self.assertEqual(extractor.extract(ElementTree.fromstring(record)),
+                         expected)
+
+        with self.assertLogs('test', 'WARNING') as logs:
+            log_missing(logging.getLogger('test'),
+                        {'HOSTDN': 3, 'SITENAME': 0}, 'APEL endpoints')
+        self.assertEqual(logs.output, [
+            'WARNING:test:Some APEL endpoints are incomplete: '
+            '3 without HOSTDN'])
+
+    def test_mod_logger(self):
+        """Test logging is set up once per file and floods are limited"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'test.log')
+        test_logger = logging.getLogger('ModLogger test')
+        ModLogger(path, test_logger.name).logger_mod()
+        ModLogger(path, test_logger.name).logger_mod()
+        queue_handler, listener = common._log_queues.pop(path)
+
+        def remove_handler():
+            for named_logger in (test_logger, common.logger):
+                named_logger.removeHandler(queue_handler)
+            listener.handlers[0].close()
+        self.addCleanup(remove_handler)
+        self.assertEqual(test_logger.handlers, [queue_handler])
+
+        for _ in range(15):
+            test_logger.warning('Endpoint %s is incomplete', 'a')
+        # Stopping the listener writes out everything queued
+        listener.stop()
+        with open(path) as log_file:
+            lines = log_file.read().splitlines()
+        self.assertEqual(sum('incomplete' in line for line in lines), 10)
+
+    def test_rate_limit_filter(self):
+        """Test held back records are counted on the next one let through"""
+        rate_limit = RateLimitFilter(burst=1, interval=0.05)
+        records = [logging.LogRecord('test', logging.WARNING, __file__, 1,
+                                     'Missing %s', ('HOSTDN',), None)
+                   for _ in range(4)]
+        self.assertEqual([rate_limit.filter(record)
+                          for record in records[:3]], [True, False, False])
+        time.sleep(0.06)
+        self.assertTrue(rate_limit.filter(records[3]))
+        self.assertEqual(records[3].getMessage(),
+                         'Missing HOSTDN (2 similar messages suppressed)')
+
+    def test_run_stats(self):
+        """Test phases add up across calls and reach the textfile"""
+        stats = RunStats('apel')
+        for elements in (3, 4):
+            with stats.phase('parse') as record:
+                record['bytes'] = 100
+                record['elements'] = elements
+        with stats.phase('write'):
+            pass
+
+        collector_stats = stats.to_dict()
+        self.assertEqual(collector_stats['collector'], 'apel')
+        self.assertIn('process_peak_rss_bytes', collector_stats)
+        self.assertEqual([phase['name']
+                          for phase in collector_stats['phases']],
+                         ['parse', 'write'])
+        parse = collector_stats['phases'][0]
+        self.assertEqual((parse['calls'], parse['bytes'], parse['elements']),
+                         (2, 200, 7))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'apel.prom')
+        stats.write_prometheus(path)
+        with open(path) as prometheus_file:
+            lines = prometheus_file.read().splitlines()
+        self.assertIn('gridtools_collector_phase_elements'
+                      '{collector="apel",phase="parse"} 7', lines)
+        self.assertIn('# TYPE gridtools_collector_seconds gauge', lines)
+        self.assertEqual(os.listdir(directory), ['apel.prom'])
+
+    def test_snapshot_store(self):
+        """Test only changes are kept until a full document is due"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'apel-snapshot.json')
+        snapshot = SnapshotStore(path, full_interval=3600)
+        snapshot.record('sites', ['SITE-B', 'SITE-A'], field='Sites')
+        snapshot.record('users', ['1G0'], counts_only=True)
+        metrics = {'Sites': ['SITE-A', 'SITE-B']}
+        self.assertTrue(snapshot.apply(metrics, delta_only=True, now=0))
+        snapshot.save(now=0)
+
+        snapshot = SnapshotStore(path, full_interval=3600)
+        snapshot.record('sites', ['SITE-A', 'SITE-C'], field='Sites')
+        snapshot.record('users', ['1G0', '2G0'], counts_only=True)
+        metrics = {'Sites': ['SITE-A', 'SITE-C'], 'Number of sites': 2}
+        self.assertFalse(snapshot.apply(metrics, delta_only=True, now=60))
+        self.assertEqual(metrics, {
+            'Number of sites': 2, 'document': 'delta',
+            'changes': [{'set': 'sites', 'added': ['SITE-C'],
+                         'added_count': 1, 'removed': ['SITE-B'],
+                         'removed_count': 1},
+                        {'set': 'users', 'added_count': 1,
+                         'removed_count': 0}]})
+        self.assertTrue(snapshot.full_due(now=3600))
+
+        # Evicting the response cache next to it leaves the snapshot alone
+        ResponseCache(directory, ttl=-1).evict()
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['apel-snapshot.json', 'evict.lock'])
+
+    def test_get_elastic(self):
+        """Test the Elasticsearch client is shared until reconfigured"""
+        saved = dict(ES_SETTINGS)
+        try:
+            configure_elastic(hosts=[{'host': 'localhost', 'port': 9200}],
+                              use_ssl=False)
+            client = get_elastic()
+            self.assertIs(get_elastic(), client)
+            self.assertEqual(elastic_stats()['http://localhost:9200'],
+                             {'connections': 0, 'requests': 0, 'reused': 0})
+            configure_elastic(maxsize=2)
+            self.assertIsNot(get_elastic(), client)
+        finally:
+            configure_elastic(**saved)
+
+    def test_bulk_sink_spool(self):
+        """Test failed bulk requests are spooled and replayed once"""
+        spool_dir = tempfile.mkdtemp()
+        try:
+            elastic = FakeElastic()
+            spool_path = os.path.join(spool_dir, 'spool.ndjson')
+            sink = BulkSink(spool_path=spool_path, max_docs=2,
+                            elastic=elastic)
+            elastic.down = True
+            sink.add({'@timestamp': '2018-06-01T00:00:00', 'a': 1})
+            sink.add({'@timestamp': '2018-06-01T00:00:00', 'a': 2})
+            self.assertEqual(len(elastic.bodies), 1)
+            self.assertTrue(os.path.exists(spool_path))
+
+            elastic.down = False
+            sink = BulkSink(spool_path=spool_path, elastic=elastic)
+            sink.add({'@timestamp': '2018-06-02T00:00:00', 'a': 3})
+            self.assertEqual(sink.replay(), 3)
+            self.assertEqual(len(elastic.bodies), 2)
+            self.assertFalse(os.path.exists(spool_path))
+            self.assertEqual(elastic.bodies[1].count('\n'), 6)
+            self.assertIn(elastic.bodies[0], elastic.bodies[1])
+            self.assertIn('logstash-gridtools-metrics-2018.06.01',
+                          elastic.bodies[0])
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_bulk_sink_torn_spool(self):
+        """Test an incomplete spooled pair is set aside, not replayed"""
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        spool_path = os.path.join(spool_dir, 'spool.ndjson')
+        elastic = FakeElastic()
+        elastic.down = True
+        sink = BulkSink(spool_path=spool_path, elastic=elastic)
+        sink.add({'@timestamp': '2018-06-01T00:00:00', 'a': 1})
+        sink.flush()
+        with open(spool_path) as spool_file:
+            action = spool_file.readline()
+        # A run killed between writing an action and its source
+        with open(spool_path, 'a') as spool_file:
+            spool_file.write(action)
+
+        elastic.down = False
+        for day in ('2018-06-02', '2018-06-03'):
+            sink = BulkSink(spool_path=spool_path, elastic=elastic)
+            sink.add({'@timestamp': day + 'T00:00:00', 'a': 2})
+            self.assertEqual(sink.flush(), 1)
+            sink.replay()
+        # The whole pair was replayed by the first run only
+        self.assertEqual([body.count('\n') for body in elastic.bodies],
+                         [2, 2, 2, 2])
+        self.assertEqual(sorted(os.listdir(spool_dir)),
+                         ['spool.ndjson.lock', 'spool.ndjson.torn'])
+        with open(spool_path + '.torn') as torn_file:
+            self.assertEqual(torn_file.read(), action)
+
+
+class FakeElastic(object):
+    """This class records _bulk bodies, failing while "down" is set"""
+    def __init__(self):
+        self.bodies = []
+        self.down = False
+
+    def bulk(self, body):
+        self.bodies.append(body)
+        if self.down:
+            raise ConnectionError('N/A', 'down', None)
+        return {'errors': False,
+                'items': [{'index': {'status': 201}}] * body.count('_id')}
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    """This class serves page1 with an ETag and answers revalidation"""
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(PAGES['page1'])))
+        self.end_headers()
+        self.wfile.write(PAGES['page1'])
+
+    def log_message(self, *args):
+        pass
+
+
+PAGES = {
+    'page1': b"""<results>
+<meta>
+<link rel="self" href="page1"/>
+<link rel="next" href="page2"/>
+<count>1</count>
+<max_page_size>1</max_page_size>
+</meta>
+<EGEE_USER ID="1G0"/>
+</results>""",
+    'page2': b"""<results>
+<meta>
+<link rel="self" href="page2"/>
+<link rel="prev" href="page1"/>
+<count>1</count>
+<max_page_size>1</max_page_size>
+</meta>
+<EGEE_USER ID="2G0"/>
+</results>""",
+}
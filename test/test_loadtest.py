@@ -0,0 +1,182 @@
+"""This script is a unit test for loadtest"""
+import logging
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+from common import CircuitBreaker, FetchError, GOCDBClient, ResponseCache, \
+    next_page_url, parse_streamed
+from loadtest import FakeGOCDB, build_parser, generate_replies, run_harness
+
+
+class TestLoadTest(unittest.TestCase):
+    """This class holds the tests for loadtest"""
+    def test_fake_gocdb_pages(self):
+        """Test the fake GOCDB pages and filters its replies"""
+        gocdb = FakeGOCDB(generate_replies(40, 5, 5), page_size=7).start()
+        try:
+            client = GOCDBClient(base_url=gocdb.url)
+            responses = list(client.iter_pages('get_service_endpoint'))
+            self.assertEqual(len(responses), 6)
+            self.assertIsNone(next_page_url(responses[-1].content))
+            self.assertEqual(gocdb.stats['get_service_endpoint']['ok'], 6)
+
+            response = client.get('get_service_endpoint',
+                                  service_type='gLite-APEL')
+            self.assertEqual(
+                response.content.count(b'<SERVICE_ENDPOINT'), 4)
+        finally:
+            gocdb.stop()
+
+    def test_stream_pages(self):
+        """Test streamed pages are parsed once, then reused from the cache"""
+        gocdb = FakeGOCDB(generate_replies(40, 5, 5), page_size=7).start()
+        cache_dir = tempfile.mkdtemp()
+        try:
+            client = GOCDBClient(base_url=gocdb.url,
+                                 cache=ResponseCache(cache_dir))
+            calls = []
+
+            def count(page):
+                calls.append(page.url)
+                return sum(1 for _ in page.records('SERVICE_ENDPOINT'))
+
+            for expected_calls in (6, 6):
+                counts = [parse_streamed(page, 'count', count) for page in
+                          client.stream_pages('get_service_endpoint')]
+                self.assertEqual(sum(counts), 40)
+                self.assertEqual(len(calls), expected_calls)
+            self.assertEqual(
+                gocdb.stats['get_service_endpoint']['not_modified'], 6)
+
+            # A cached page can still be read again, from its stored body
+            page = next(client.stream_pages('get_service_endpoint'))
+            self.assertTrue(page.from_cache)
+            self.assertEqual(
+                len(list(page.records('SERVICE_ENDPOINT'))), 7)
+            page.close()
+        finally:
+            gocdb.stop()
+            shutil.rmtree(cache_dir)
+
+    def test_stream_pages_prefetch(self):
+        """Test the next page is requested while the current one is read"""
+        gocdb = FakeGOCDB(generate_replies(40, 5, 5), page_size=7).start()
+        try:
+            client = GOCDBClient(base_url=gocdb.url)
+            pages = client.stream_pages('get_service_endpoint')
+            records = next(pages).records('SERVICE_ENDPOINT')
+            next(records)
+            stats = gocdb.stats['get_service_endpoint']
+            for _ in range(50):
+                if stats.get('ok') == 2:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(stats['ok'], 2)
+
+            self.assertEqual(
+                sum(1 for _ in records) +
+                sum(1 for page in pages
+                    for _ in page.records('SERVICE_ENDPOINT')), 39)
+            self.assertEqual(stats['ok'], 6)
+        finally:
+            gocdb.stop()
+
+    def test_stream_deadline(self):
+        """Test a deadline passing mid-page is not a breaker failure"""
+        gocdb = FakeGOCDB(generate_replies(40, 5, 5)).start()
+        try:
+            client = GOCDBClient(base_url=gocdb.url)
+            page = client.stream_url(
+                client.method_url('get_service_endpoint'))
+            page.chunk_size = 64
+            records = page.records('SERVICE_ENDPOINT')
+            next(records)
+            client.deadline = time.time() - 1
+            self.assertRaises(FetchError, list, records)
+            self.assertEqual(client.breaker.failures, 0)
+            page.close()
+        finally:
+            gocdb.stop()
+
+    def test_retries_and_circuit_breaker(self):
+        """Test failing requests are retried, then short-circuited"""
+        gocdb = FakeGOCDB(generate_replies(5, 5, 5), failure_rate=1.0,
+                          failure='stall').start()
+        try:
+            client = GOCDBClient(base_url=gocdb.url, timeout=(1, 0.2),
+                                 retries=1, backoff=0,
+                                 breaker=CircuitBreaker(threshold=3))
+            self.assertRaises(FetchError, client.get, 'get_site_list')
+            self.assertEqual(gocdb.stats['get_site_list']['failed'], 2)
+            self.assertRaises(FetchError, client.get, 'get_site_list')
+            # The breaker opened on the third failure
+            self.assertEqual(gocdb.stats['get_site_list']['failed'], 3)
+
+            client = GOCDBClient(base_url=gocdb.url)
+            client.set_deadline(-1)
+            self.assertRaises(FetchError, client.get, 'get_site_list')
+            self.assertEqual(gocdb.stats['get_site_list']['failed'], 3)
+        finally:
+            gocdb.stop()
+
+    def test_circuit_breaker_trial(self):
+        """Test a half-open breaker is not stuck by a call with no outcome"""
+        gocdb = FakeGOCDB(generate_replies(5, 5, 5)).start()
+        try:
+            breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+            client = GOCDBClient(base_url=gocdb.url, breaker=breaker)
+            breaker.failure()
+            client.set_deadline(-1)
+            self.assertRaises(FetchError, client.get, 'get_site_list')
+            self.assertFalse(breaker._trial)
+
+            # A bug rather than a GOCDB failure gives the trial back too
+            client.set_deadline(60)
+            with mock.patch.object(client.session, 'get',
+                                   side_effect=ValueError('bad url')):
+                self.assertRaises(ValueError, client.get, 'get_site_list')
+            self.assertFalse(breaker._trial)
+
+            self.assertEqual(client.get('get_site_list').status_code, 200)
+            self.assertIsNone(breaker.opened_at)
+        finally:
+            gocdb.stop()
+
+    def test_run_harness(self):
+        """Test both collectors run end to end against the stand-ins"""
+        options, _ = build_parser().parse_args(
+            ['-r', '2', '--endpoints', '50', '--sites', '10',
+             '--users', '10', '--page-size', '20'])
+        reports = run_harness(options)
+        self.assertEqual([report['collector'] for report in reports],
+                         ['APEL', 'GOCDB', 'APEL', 'GOCDB'])
+        for report in reports:
+            self.assertIn('fetch', report['phases'])
+            self.assertEqual(report['elasticsearch_calls'].get('_bulk'), 1)
+        self.assertIn('es_read', reports[0]['phases'])
+        self.assertIn('write', reports[1]['phases'])
+        # The second runs are revalidated from the GOCDB cache
+        self.assertEqual(set(reports[3]['gocdb_requests']['get_user']),
+                         {'bytes', 'not_modified'})
+        # Running a collector again adds no handlers to its logger
+        for name in ('APEL logger', 'GOCDB logger'):
+            self.assertEqual(
+                [type(handler).__name__
+                 for handler in logging.getLogger(name).handlers],
+                ['NullHandler', 'QueueHandler'])
+
+    def test_run_harness_failing(self):
+        """Test metrics are still written when GOCDB keeps failing"""
+        options, _ = build_parser().parse_args(
+            ['-r', '1', '--endpoints', '10', '--sites', '5', '--users', '5',
+             '--failure-rate', '1', '--retries', '1', '--no-cache'])
+        apel, gocdb = run_harness(options)
+        self.assertEqual(apel['missing_metrics'], [
+            'gLite-APEL endpoints', 'APEL endpoints',
+            'eu.egi.cloud.accounting endpoints',
+            'eu.egi.storage.accounting endpoints'])
+        self.assertEqual(gocdb['missing_metrics'],
+                         ['sites', 'countries', 'users'])
+        self.assertEqual(gocdb['elasticsearch_calls'].get('_bulk'), 1)
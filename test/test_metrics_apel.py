@@ -1,6 +1,19 @@
 """This script can be used to unit test metric_apel"""
+import io
+import shutil
+import tempfile
 import xml.dom.minidom
-from metrics_apel import get_sites, get_services, get_countries
+from unittest import mock
+import metrics_apel
+from metrics_apel import get_sites, get_services, get_countries, \
+    get_endpoint_metrics_stream, EndpointAggregator, \
+    EndpointTable, iter_service_endpoints, choose_fetch_mode, \
+    get_records_totals, backfill_records, ApelRunContext, \
+    parse_endpoint_response
+from common import PARALLEL_SETTINGS, configure_parallel
+from metrics_archive import MetricsArchive
+from datetime import datetime
+from elasticsearch.exceptions import ConnectionTimeout, RequestError
 import unittest
 
 
@@ -33,6 +46,214 @@ class TeestMetricsAPEL(unittest.TestCase):
         answer_list = ([u"CRETE"], 1)
         self.assertEquals(country_list, answer_list)
 
+    def test_get_endpoint_metrics_stream(self):
+        """Tests the streaming parser against the minidom functions"""
+        apel_xml_parsed = xml.dom.minidom.parseString(apel_xml)
+        xml_obj =\
+            apel_xml_parsed.getElementsByTagName('SERVICE_ENDPOINT')
+        expected = (get_sites("APEL", xml_obj),
+                    get_services("APEL", xml_obj),
+                    get_countries("APEL", xml_obj))
+        result = get_endpoint_metrics_stream(
+            "APEL", io.BytesIO(apel_xml.encode('utf-8')))
+        self.assertEquals(result, expected)
+
+    def test_endpoint_aggregator(self):
+        """Tests the EndpointAggregator class over several endpoints"""
+        apel_xml_parsed = xml.dom.minidom.parseString(multi_apel_xml)
+        xml_obj =\
+            apel_xml_parsed.getElementsByTagName('SERVICE_ENDPOINT')
+        aggregator = EndpointAggregator("APEL").add_nodes(xml_obj)
+        self.assertEqual(aggregator.get_sites(), (2, [u"SITE-A", u"SITE-B"]))
+        self.assertEqual(aggregator.get_services(), 2)
+        self.assertEqual(aggregator.get_countries(), ([u"UK", u"France"], 2))
+        self.assertEqual(aggregator.get_missing(),
+                         {'SITENAME': 0, 'COUNTRY_NAME': 0, 'HOSTDN': 1})
+
+    def test_run_context(self):
+        """Tests countries are collected per ApelRunContext"""
+        apel_xml_parsed = xml.dom.minidom.parseString(multi_apel_xml)
+        xml_obj =\
+            apel_xml_parsed.getElementsByTagName('SERVICE_ENDPOINT')
+        first, second = ApelRunContext(), ApelRunContext()
+        get_countries("APEL", xml_obj, first)
+        get_countries("gLite-APEL", xml_obj, first)
+        get_countries("APEL", xml_obj[:1], second)
+        self.assertEqual(first.get_countries(), ([u"UK", u"France"], 2))
+        self.assertEqual(second.get_countries(), ([u"UK"], 1))
+
+    def test_endpoint_table_partitions(self):
+        """Tests the EndpointTable class partitions by SERVICE_TYPE"""
+        mixed_xml = multi_apel_xml.replace(
+            "<SERVICE_TYPE>APEL</SERVICE_TYPE><SITENAME>SITE-B",
+            "<SERVICE_TYPE>gLite-APEL</SERVICE_TYPE><SITENAME>SITE-B")
+        apel_xml_parsed = xml.dom.minidom.parseString(mixed_xml)
+        xml_obj =\
+            apel_xml_parsed.getElementsByTagName('SERVICE_ENDPOINT')
+        table = EndpointTable().add_nodes(xml_obj)
+        self.assertEqual(table.aggregator_for("APEL").get_sites(),
+                         (1, [u"SITE-A"]))
+        self.assertEqual(table.aggregator_for("APEL").get_services(), 2)
+        self.assertEqual(table.aggregator_for("gLite-APEL").get_sites(),
+                         (1, [u"SITE-B"]))
+        self.assertEqual(table.aggregator_for("gLite-APEL").get_services(), 0)
+        self.assertEqual(table.aggregator_for("CREAM-CE").get_sites(),
+                         (0, []))
+
+    def test_endpoint_table(self):
+        """Tests the EndpointTable class, with and without NumPy"""
+        table_xml = multi_apel_xml.replace(
+            "<HOSTDN>A</HOSTDN>",
+            "<HOSTDN>A</HOSTDN><ROC_NAME>NGI_UK</ROC_NAME><BETA>Y</BETA>"
+            "<SCOPES><SCOPE>EGI</SCOPE><SCOPE>wlcg</SCOPE></SCOPES>")
+        def aggregator_for(endpoint):
+            return EndpointAggregator(endpoint).add_elements(
+                element for element in iter_service_endpoints(
+                    io.BytesIO(table_xml.encode('utf-8')))
+                if element.findtext('SERVICE_TYPE') == endpoint)
+
+        for numpy_module in (metrics_apel.numpy, None):
+            with mock.patch.object(metrics_apel, 'numpy', numpy_module):
+                table = EndpointTable().add_nodes(
+                    xml.dom.minidom.parseString(table_xml)
+                    .getElementsByTagName('SERVICE_ENDPOINT'))
+                # A round trip through the cached state keeps every row
+                table = EndpointTable().merge_state(table.to_state())
+                for endpoint in ("APEL", "gLite-APEL"):
+                    self.assertEqual(
+                        table.aggregator_for(endpoint).to_state(),
+                        aggregator_for(endpoint).to_state())
+                self.assertEqual(table.count(), 3)
+                self.assertEqual(dict(table.group_count('roc')),
+                                 {u"NGI_UK": 1, None: 2})
+                self.assertEqual(
+                    dict(table.group_count('scope', site=u"SITE-A")),
+                    {u"EGI": 1, u"wlcg": 1})
+                self.assertEqual(table.flag_count('beta'), 1)
+                self.assertEqual(table.flag_count('has_hostdn',
+                                                  country=u"UK"), 2)
+                self.assertEqual(
+                    table.aggregator_for("APEL").get_breakdown(),
+                    {'service_type': "APEL", 'endpoints': 3,
+                     'in_production': 0, 'beta': 1, 'monitored': 0,
+                     'rocs': [{'name': u"NGI_UK", 'count': 1},
+                              {'name': None, 'count': 2}],
+                     'scopes': [{'name': u"EGI", 'count': 1},
+                                {'name': u"wlcg", 'count': 1}]})
+
+    def test_parse_endpoint_response_parallel(self):
+        """Tests sharded parsing gives the same table as a serial parse"""
+        saved = dict(PARALLEL_SETTINGS)
+        self.addCleanup(configure_parallel, **saved)
+        configure_parallel(workers=2, threshold=0)
+        response = mock.Mock(content=multi_apel_xml.encode('utf-8'))
+        serial = parse_endpoint_response(response, EndpointTable())
+        parallel = parse_endpoint_response(response, EndpointTable(),
+                                           "parallel")
+        self.assertEqual(parallel.to_state(), serial.to_state())
+        self.assertEqual(parallel.aggregator_for("APEL").get_sites(),
+                         serial.aggregator_for("APEL").get_sites())
+
+    def test_choose_fetch_mode(self):
+        """Tests the choose_fetch_mode method"""
+        self.assertEqual(choose_fetch_mode("auto", {}), "filtered")
+        filtered = {'seconds': 4.0, 'stored_at': 0.0}
+        snapshot = {'seconds': 2.0, 'stored_at': 1000.0}
+        self.assertEqual(choose_fetch_mode(
+            "auto", {"filtered": filtered, "snapshot": None}, now=2000.0),
+            "snapshot")
+        self.assertEqual(choose_fetch_mode(
+            "auto", {"filtered": filtered, "snapshot": snapshot},
+            now=2000.0), "snapshot")
+        # The filtered timing is too old to go on, so it is measured again
+        self.assertEqual(choose_fetch_mode(
+            "auto", {"filtered": filtered, "snapshot": snapshot},
+            max_age=1500.0, now=2000.0), "filtered")
+        self.assertEqual(choose_fetch_mode("filtered", {}), "filtered")
+
+    def test_get_records_totals(self):
+        """Tests the get_records_totals method fills in missing types"""
+        totals = get_records_totals(['storage', 'cloud', 'grid'],
+                                    FakeElastic())
+        self.assertEqual(totals, {'storage': 5.0, 'cloud': 0.0,
+                                  'grid': 7.0})
+
+    def test_get_records_totals_msearch(self):
+        """Tests the get_records_totals method falls back to msearch"""
+        elastic = FakeElastic(fail_terms=True)
+        totals = get_records_totals(['storage', 'cloud'], elastic)
+        self.assertEqual(totals, {'storage': 3.0, 'cloud': 0.0})
+        self.assertEqual(len(elastic.msearches[0]), 4)
+
+        # An unreachable cluster is not asked again with an msearch
+        elastic = FakeElastic(timeout=True)
+        self.assertRaises(ConnectionTimeout, get_records_totals,
+                          ['storage'], elastic)
+        self.assertEqual(elastic.msearches, [])
+
+    def test_backfill_records(self):
+        """Tests the backfill_records method writes one document per day"""
+        elastic = FakeElastic()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        archive = MetricsArchive(directory)
+        documents = backfill_records(['storage', 'grid'],
+                                     datetime(2018, 6, 1),
+                                     datetime(2018, 6, 2), True, elastic,
+                                     spool_path=None, archive=archive)
+        self.assertEqual([document['@timestamp'] for document in documents],
+                         ['2018-06-02T00:00:00', '2018-06-03T00:00:00'])
+        self.assertEqual(
+            documents[1]['Number of records loaded for storage accounting'],
+            0.0)
+        self.assertEqual(
+            documents[1]['Number of records loaded for grid accounting'],
+            4.0)
+        self.assertEqual(len(elastic.bulks), 1)
+        self.assertEqual(elastic.bulks[0].count('_id'), 2)
+        self.assertEqual(list(archive.query()), documents)
+
+
+class FakeElastic(object):
+    """This class answers searches with canned aggregations"""
+    def __init__(self, fail_terms=False, timeout=False):
+        self.fail_terms = fail_terms
+        self.timeout = timeout
+        self.msearches = []
+        self.bulks = []
+
+    def search(self, index, body):
+        if self.timeout:
+            raise ConnectionTimeout('TIMEOUT', 'timed out', None)
+        if self.fail_terms:
+            raise RequestError(400, 'illegal_argument_exception')
+        if "days" in body["aggs"]:
+            return {"aggregations": {"days": {"buckets": [
+                {"key_as_string": "2018-06-01", "apel_types": {"buckets": [
+                    {"key": "storage",
+                     "total_number_loaded": {"value": 2.0}},
+                ]}},
+                {"key_as_string": "2018-06-02", "apel_types": {"buckets": [
+                    {"key": "grid", "total_number_loaded": {"value": 4.0}},
+                ]}},
+            ]}}}
+        return {"aggregations": {"apel_types": {"buckets": [
+            {"key": "grid", "total_number_loaded": {"value": 7.0}},
+            {"key": "storage", "total_number_loaded": {"value": 5.0}},
+        ]}}}
+
+    def bulk(self, body):
+        self.bulks.append(body)
+        return {"errors": False,
+                "items": [{"index": {"status": 201}}] * body.count('_id')}
+
+    def msearch(self, body):
+        self.msearches.append(body)
+        return {"responses": [
+            {"aggregations": {"total_number_loaded": {"value": 3.0}}},
+            {"error": {"type": "index_not_found_exception"}},
+        ]}
+
 
 apel_xml = """<results>
 <SERVICE_ENDPOINT PRIMARY_KEY="368G0">
@@ -59,3 +280,16 @@ apel_xml = """<results>
 <HOSTDN> ALEX TSELOS </HOSTDN>
 </SERVICE_ENDPOINT>
 </results>"""
+
+
+multi_apel_xml = """<results>
+<SERVICE_ENDPOINT><GOCDB_PORTAL_URL>a</GOCDB_PORTAL_URL>
+<SERVICE_TYPE>APEL</SERVICE_TYPE><SITENAME>SITE-A</SITENAME>
+<COUNTRY_NAME>UK</COUNTRY_NAME><HOSTDN>A</HOSTDN></SERVICE_ENDPOINT>
+<SERVICE_ENDPOINT><GOCDB_PORTAL_URL>b</GOCDB_PORTAL_URL>
+<SERVICE_TYPE>APEL</SERVICE_TYPE><SITENAME>SITE-A</SITENAME>
+<COUNTRY_NAME>UK</COUNTRY_NAME><HOSTDN>B</HOSTDN></SERVICE_ENDPOINT>
+<SERVICE_ENDPOINT><GOCDB_PORTAL_URL>c</GOCDB_PORTAL_URL>
+<SERVICE_TYPE>APEL</SERVICE_TYPE><SITENAME>SITE-B</SITENAME>
+<COUNTRY_NAME>France</COUNTRY_NAME></SERVICE_ENDPOINT>
+</results>"""
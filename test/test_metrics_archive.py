@@ -0,0 +1,95 @@
+"""This script is a unit test for metrics_archive"""
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from common import BulkSink
+from metrics_archive import INDEX_ENTRY, MetricsArchive
+
+
+class TestMetricsArchive(unittest.TestCase):
+    """This class holds the tests for metrics_archive"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.archive = MetricsArchive(self.directory)
+        # The 2018-06-02 document arrives last, as from a backfill
+        for day, endpoints in (('2018-06-01', 10), ('2018-06-03', 12),
+                               ('2018-07-01', 13), ('2018-06-02', 11)):
+            self.archive.append({'type': 'apel_metric',
+                                 '@timestamp': day + 'T01:00:00.000000',
+                                 'Number of APEL endpoints': endpoints,
+                                 'List of sites': ['SITE-A']})
+        self.archive.append({'type': 'gocdb_metric',
+                             '@timestamp': '2018-06-02T01:00:00.000000',
+                             'Number of sites in GOCDB': 5})
+
+    def test_append_out_of_order(self):
+        """Test an older document is sorted into the index, not appended"""
+        path = os.path.join(self.directory,
+                            'apel_metric.2018-06.ndjson.gz.idx')
+        with open(path, 'rb') as index_file:
+            entries = list(INDEX_ENTRY.iter_unpack(index_file.read()))
+        self.assertEqual(len(entries), 3)
+        self.assertEqual([seconds for seconds, _, _ in entries],
+                         sorted(seconds for seconds, _, _ in entries))
+        # The 2018-06-02 document is last in the segment but second in
+        # the index
+        self.assertEqual(entries[1][1], max(offset for _, offset, _ in
+                                            entries))
+
+        # A document at the same time as one archived goes after it
+        self.archive.append({'type': 'apel_metric',
+                             '@timestamp': '2018-06-02T01:00:00.000000',
+                             'Number of APEL endpoints': 14})
+        self.assertEqual(
+            [document['Number of APEL endpoints'] for document in
+             self.archive.query('2018-06-02', '2018-06-03', 'apel_metric')],
+            [11, 14])
+
+    def test_query(self):
+        """Test a date range is read in time order from its segments only"""
+        documents = list(self.archive.query(
+            '2018-06-02', '2018-07-01', 'apel_metric',
+            ['Number of APEL endpoints']))
+        self.assertEqual(documents, [
+            {'type': 'apel_metric', '@timestamp': '2018-06-02T01:00:00.000000',
+             'Number of APEL endpoints': 11},
+            {'type': 'apel_metric', '@timestamp': '2018-06-03T01:00:00.000000',
+             'Number of APEL endpoints': 12}])
+        self.assertEqual(len(list(self.archive.query(start='2018-06-02'))),
+                         4)
+        self.assertEqual(
+            [os.path.basename(path) for path in
+             self.archive.segments('apel_metric', '2018-07-01')],
+            ['apel_metric.2018-07.ndjson.gz'])
+
+        # A segment is still a plain gzip file of NDJSON
+        path = os.path.join(self.directory, 'apel_metric.2018-06.ndjson.gz')
+        with gzip.open(path, 'rt') as segment:
+            self.assertEqual(len([json.loads(line) for line in segment]), 3)
+
+    def test_rebuild(self):
+        """Test archived documents are indexed again to their own days"""
+        elastic = FakeElastic()
+        indexed = self.archive.rebuild(
+            '2018-06-01', '2018-08-01', 'apel_metric',
+            sink=BulkSink(spool_path=None, max_docs=3, elastic=elastic))
+        self.assertEqual(indexed, 4)
+        self.assertEqual(len(elastic.bodies), 2)
+        self.assertIn('logstash-gridtools-metrics-2018.07.01',
+                      elastic.bodies[1])
+
+
+class FakeElastic(object):
+    """This class accepts every _bulk body it is sent"""
+    def __init__(self):
+        self.bodies = []
+
+    def bulk(self, body):
+        self.bodies.append(body)
+        return {'errors': False,
+                'items': [{'index': {'status': 201}}] * body.count('_id')}
+
@@ -0,0 +1,40 @@
+"""This script is a unit test for metrics_daemon"""
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from metrics_daemon import CollectorDaemon, CollectorJob
+
+
+class TestMetricsDaemon(unittest.TestCase):
+    """This class holds the tests for metrics_daemon"""
+    def test_overlap_is_skipped(self):
+        """Test a job still running when due again is skipped"""
+        release = threading.Event()
+        job = CollectorJob('slow', release.wait, interval=0)
+        daemon = CollectorDaemon([job])
+        executor = ThreadPoolExecutor(max_workers=1)
+        daemon.run_due(executor, job.next_run)
+        daemon.run_due(executor, job.next_run)
+        release.set()
+        executor.shutdown(wait=True)
+        self.assertEqual(job.runs, 1)
+        self.assertEqual(job.skipped, 1)
+
+    def test_serve_until_stopped(self):
+        """Test jobs that fall due together both run, then serve returns"""
+        runs = []
+        daemon = CollectorDaemon([])
+
+        def run(name):
+            runs.append(name)
+            if len(runs) >= 4:
+                daemon.stop()
+
+        daemon.jobs = [
+            CollectorJob('APEL', lambda: run('APEL'), interval=0.01),
+            CollectorJob('GOCDB', lambda: run('GOCDB'), interval=0.01),
+        ]
+        daemon.serve()
+        self.assertIn('APEL', runs)
+        self.assertIn('GOCDB', runs)
+        self.assertEqual(sum(job.failures for job in daemon.jobs), 0)
@@ -1,7 +1,9 @@
 """This script is a unit test for metrics_gocdb"""
+import io
 import xml.dom.minidom
 import unittest
-from metrics_gocdb import _parse_get_user_xml, _parse_get_user_xml_roles, get_sites, get_countries
+from metrics_gocdb import _parse_get_user_xml, _parse_get_user_xml_roles, get_sites, get_countries, \
+    UserStats, count_countries
 
 class TestMetricsGOCDB(unittest.TestCase):
     """This class holds the functions needed to test metrics_GOCDBv4"""
@@ -17,6 +19,19 @@ class TestMetricsGOCDB(unittest.TestCase):
         number_of_user_with_roles = _parse_get_user_xml_roles(parsed_user_xml)
         self.assertEquals(number_of_user_with_roles, 1)
 
+    def test_user_stats(self):
+        """Test the streaming UserStats parser matches the minidom one"""
+        parsed_user_xml = xml.dom.minidom.parseString(GET_USER_XML)
+        dom_stats = UserStats().parse_xml(parsed_user_xml)
+        stream_stats = UserStats().parse(
+            io.BytesIO(GET_USER_XML.encode('utf-8')))
+        for user_stats in (dom_stats, stream_stats):
+            self.assertEqual(user_stats.users, 2)
+            self.assertEqual(user_stats.users_with_role, 1)
+            self.assertEqual(dict(user_stats.home_sites), {u"STFC RAL": 1})
+            self.assertEqual(dict(user_stats.roles_per_entity_type),
+                             {u"site": 1})
+
     def test_get_sites(self):
         """Test the get_sites method"""
         parsed_site_xml = xml.dom.minidom.parseString(GET_SITE_XML)
@@ -30,6 +45,16 @@ class TestMetricsGOCDB(unittest.TestCase):
         answer_list = (1, [u"Algeria"])
         self.assertEquals(country_list, answer_list)
 
+    def test_count_countries(self):
+        """Test incomplete sites are returned for the caller to log"""
+        parsed_country_xml = xml.dom.minidom.parseString(
+            GET_COUNTRY_XML.replace('<COUNTRY>Albania</COUNTRY>', ''))
+        sites = parsed_country_xml.getElementsByTagName('SITE')
+        with self.assertNoLogs('GOCDB logger'):
+            result = count_countries(sites)
+        self.assertEqual(result, (1, [u"Algeria"],
+                                  {'COUNTRY': 1}))
+
 
 GET_USER_XML = """<?xml version="1.0" encoding="UTF-8"?>
 <results>